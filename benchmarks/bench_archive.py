@@ -0,0 +1,115 @@
+'''
+Benchmarks of the on-disk metrics archive.
+
+Measures the server-side cost of archiving a heartbeat (buffering plus the
+amortized flush), then fills the archive with `--days` of synthetic data
+from `--engines` engines sending a heartbeat every `--interval` seconds and
+times a set of range queries. Results are printed as JSON.
+
+The default configuration (one week, 1000 engines, 5 s heartbeats) writes
+about 121M rows, i.e. ~3.4 GB of column files.
+'''
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from common import write_results
+from monitored_ipcluster.archive import MetricsArchive, query, DAY
+
+
+def bench_append(path, n_engines, n_heartbeats, flush_every):
+    archive = MetricsArchive(path, flush_interval=0)
+    uids = ['engine-{:05d}'.format(i) for i in range(n_engines)]
+    hb = [{'uid': u, 'host': 'node{:03d}'.format(i // 32), 'type': 'worker',
+           'net': 1e5, 'pcpu': 99.0, 'rss': 2e9, 'disk_io': 1e4} for i, u in enumerate(uids)]
+    now = time.time()
+    t0 = time.perf_counter()
+    for i in range(n_heartbeats):
+        archive.append(hb[i % n_engines], now + i * 1e-3)
+        if (i + 1) % flush_every == 0:
+            archive.flush()
+    archive.flush()
+    elapsed = time.perf_counter() - t0
+    return {
+        'heartbeats': n_heartbeats,
+        'flush_every': flush_every,
+        'us_per_heartbeat': elapsed / n_heartbeats * 1e6,
+    }
+
+
+def fill(path, n_engines, days, interval, end):
+    archive = MetricsArchive(path)
+    for i in range(n_engines):
+        archive.engine_id('engine-{:05d}'.format(i), 'node{:03d}'.format(i // 32), 'worker')
+    rng = np.random.default_rng(0)
+    start = end - days * DAY
+    chunk = 3600  # one hour of heartbeats at a time
+    n_rows = 0
+    t0 = time.perf_counter()
+    for c0 in np.arange(start, end, chunk):
+        ticks = np.arange(c0, min(c0 + chunk, end), interval)
+        t = np.repeat(ticks, n_engines) + np.tile(np.linspace(0, interval, n_engines, endpoint=False), len(ticks))
+        engine = np.tile(np.arange(n_engines, dtype=np.int32), len(ticks))
+        n = len(t)
+        values = [
+            rng.exponential(1e5, n),
+            rng.uniform(0, 100, n),
+            rng.normal(2e9, 1e8, n),
+            rng.exponential(1e4, n),
+        ]
+        archive.extend(t, engine, *values)
+        n_rows += n
+    elapsed = time.perf_counter() - t0
+    return {'rows': n_rows, 'fill_seconds': elapsed}
+
+
+def bench_queries(path, end, repeat):
+    hosts = ['node000']
+    cases = {
+        'last_hour_total': dict(start=end - 3600, end=end),
+        'last_day_hourly': dict(start=end - DAY, end=end, bucket=3600),
+        'week_daily': dict(start=end - 7 * DAY, end=end, bucket=DAY),
+        'week_hourly_one_host': dict(start=end - 7 * DAY, end=end, bucket=3600, hosts=hosts),
+        'week_one_engine_rss': dict(start=end - 7 * DAY, end=end, bucket=3600,
+                                    uids=['engine-00000'], metrics=['rss']),
+        'last_hour_by_engine': dict(start=end - 3600, end=end, by='engine'),
+    }
+    out = {}
+    for name, kwargs in cases.items():
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            r = query(path, **kwargs)
+            times.append(time.perf_counter() - t0)
+        out[name] = {'rows': r['rows'], 'best_ms': min(times) * 1e3, 'median_ms': float(np.median(times)) * 1e3}
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', type=int, default=1000)
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--interval', type=float, default=5.0, help='heartbeat interval in seconds')
+    parser.add_argument('--heartbeats', type=int, default=200000, help='heartbeats for the write benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--dir', type=str, help='archive directory (default: a temporary directory)')
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    path = args.dir or tempfile.mkdtemp(prefix='mipc-archive-bench-')
+    try:
+        end = (time.time() // DAY) * DAY  # align on a day boundary
+        results = {
+            'append': [bench_append(os.path.join(path, 'append'), args.engines, args.heartbeats, f)
+                       for f in (200, 5000)],
+            'fill': fill(os.path.join(path, 'data'), args.engines, args.days, args.interval, end),
+        }
+        results['query'] = bench_queries(os.path.join(path, 'data'), end, args.repeat)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    write_results('archive', vars(args), results, args.output)
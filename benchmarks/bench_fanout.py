@@ -0,0 +1,118 @@
+'''
+End-to-end benchmark of the control plane.
+
+Starts a server on free local ports and a synthetic fleet of clients,
+waits for every client to register, then issues a cluster-wide restart
+and measures how long it takes for the command to reach every client
+(the command is delivered with the reply to the next heartbeat, so the
+expected latency is bounded by the heartbeat interval). Also reports the
+heartbeat round trip times and the latency of info requests under load.
+'''
+import time
+import logging
+import argparse
+import tempfile
+from multiprocessing import Process
+
+import zmq
+
+from common import free_port, percentiles, write_results
+from simfleet import start_fleet, collect
+
+
+def run_server(addresses):
+    import monitored_ipcluster.server as server
+    server.logger.setLevel(logging.WARNING)
+    server.server_loop(addresses=addresses, monitor_ipyparallel=False)
+
+
+def start_server():
+    ports = [free_port() for _ in range(3)]
+    addresses = {
+        'clients': 'tcp://127.0.0.1:{}'.format(ports[0]),
+        'control': 'tcp://127.0.0.1:{}'.format(ports[1]),
+        'control_ipc': 'ipc://{}/mipc-bench.socket'.format(tempfile.mkdtemp()),
+        'events': 'tcp://127.0.0.1:{}'.format(ports[2]),
+    }
+    p = Process(target=run_server, args=(addresses,), daemon=True)
+    p.start()
+    return p, addresses
+
+
+def command(sock, msg, timeout=10.):
+    t0 = time.perf_counter()
+    sock.send_json(msg)
+    if not sock.poll(timeout * 1000):
+        raise RuntimeError('Timeout waiting for {}'.format(msg))
+    return sock.recv_json(), (time.perf_counter() - t0) * 1e3
+
+
+def run(n_clients, n_procs, interval, register_timeout=60.):
+    server, addresses = start_server()
+    context = zmq.Context()
+    ctl = context.socket(zmq.REQ)
+    ctl.setsockopt(zmq.LINGER, 0)
+    ctl.connect(addresses['control'])
+
+    duration = register_timeout + 3 * interval
+    t_start = time.time()
+    procs, out, uids, stop = start_fleet(addresses['clients'], n_clients, n_procs, interval, duration)
+    try:
+        # wait for registration
+        info_ms = []
+        while True:
+            reply, ms = command(ctl, {'type': 'command', 'cmd': 'info'})
+            info_ms.append(ms)
+            if reply['n_workers'] >= n_clients:
+                break
+            if time.time() - t_start > register_timeout:
+                raise RuntimeError('Only {} of {} clients registered'.format(reply['n_workers'], n_clients))
+            time.sleep(0.2)
+        t_registered = time.time() - t_start
+
+        t_cmd = time.time()
+        command(ctl, {'type': 'command', 'cmd': 'restart'})
+        # keep measuring info latency while the command fans out
+        while time.time() - t_cmd < 2 * interval:
+            info_ms.append(command(ctl, {'type': 'command', 'cmd': 'info'})[1])
+            time.sleep(0.1)
+
+        stop.set()
+        stats = collect(procs, out)
+    finally:
+        for p in procs:
+            p.terminate()
+        server.terminate()
+        ctl.close()
+        context.term()
+
+    first = {}
+    for uid, t, reply in stats.pop('commands'):
+        if t >= t_cmd and uid not in first:
+            first[uid] = t - t_cmd
+    latencies = sorted(first.values())
+    return {
+        'registration_s': t_registered,
+        'heartbeats_sent': stats['sent'],
+        'heartbeats_received': stats['received'],
+        'heartbeat_rtt_ms': stats['rtt_ms'],
+        'info_ms': percentiles(info_ms),
+        'fanout': {
+            'reached': len(latencies),
+            'clients': n_clients,
+            'latency_s': percentiles(latencies),
+            'complete_s': latencies[-1] if len(latencies) == n_clients else None,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 1000, 4000])
+    parser.add_argument('--procs', type=int, default=4, help='fleet processes')
+    parser.add_argument('--interval', type=float, default=5.0, help='heartbeat interval in seconds')
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {n: run(n, args.procs, args.interval) for n in args.clients}
+    write_results('fanout', vars(args), results, args.output)
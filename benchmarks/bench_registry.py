@@ -0,0 +1,105 @@
+'''
+Memory and heartbeat handling time of the worker registry of the server,
+against the plain dict of heartbeat dicts it replaces:
+
+    memory_per_engine  bytes allocated per registered engine
+    heartbeat          storing one heartbeat of a registered engine
+    handle_message     one worker heartbeat through the server, with the
+                       default analyzer
+
+Heartbeats are decoded from JSON as the server receives them, so that
+every one has its own key, uid, host and type strings.
+'''
+import json
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+
+from common import timeit, write_results
+from simfleet import heartbeat
+import monitored_ipcluster.server as server
+from monitored_ipcluster.registry import WorkerRegistry
+from monitored_ipcluster.analysis import Analyzer
+from monitored_ipcluster.cmdqueue import CommandQueue
+
+
+def decoded_beats(n, hosts_per_node, rng):
+    uids = ['engine-{:06d}'.format(i) for i in range(n)]
+    hosts = ['node{:04d}'.format(i // hosts_per_node) for i in range(n)]
+    return [json.dumps(heartbeat(uid, host, rng)) for uid, host in zip(uids, hosts)]
+
+
+def store_dict(workers, data):
+    data['_lastreq'] = time.time()
+    workers[data['uid']] = data
+
+
+def store_registry(workers, data):
+    data['_lastreq'] = time.time()
+    workers.heartbeat(data['uid'], data)
+
+
+def memory_per_engine(store, workers, raw):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for msg in raw:
+        store(workers, json.loads(msg))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / len(raw)
+
+
+def bench_handle_message(raw, number):
+    server.logger.setLevel(logging.WARNING)
+    server.workers.clear()
+    server.worker_index.clear()
+    server.request_queue = CommandQueue()
+    server.analyzer = Analyzer()
+    for msg in raw:
+        server.handle_message(json.loads(msg))
+    beats = [json.loads(msg) for msg in raw]
+    it = iter(range(10**12))
+
+    def one_heartbeat():
+        server.handle_message(dict(beats[next(it) % len(beats)]))
+
+    result = timeit(one_heartbeat, number=number)
+    server.workers.clear()
+    server.worker_index.clear()
+    server.analyzer = None
+    return result
+
+
+def run(n, hosts_per_node, number):
+    raw = decoded_beats(n, hosts_per_node, random.Random(0))
+    out = {}
+    for name, store, make in (('dict', store_dict, dict), ('registry', store_registry, WorkerRegistry)):
+        workers = make()
+        mem = memory_per_engine(store, workers, raw)
+        beats = [json.loads(msg) for msg in raw]
+        it = iter(range(10**12))
+
+        def one_heartbeat():
+            store(workers, dict(beats[next(it) % n]))
+
+        out[name] = {
+            'memory_per_engine': mem,
+            'heartbeat': timeit(one_heartbeat, number=number),
+        }
+    out['registry']['handle_message'] = bench_handle_message(raw, number)
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of registered engines')
+    parser.add_argument('--engines-per-host', type=int, default=32)
+    parser.add_argument('--number', type=int, default=20000, help='heartbeats per measurement')
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {n: run(n, args.engines_per_host, args.number) for n in args.engines}
+    write_results('registry', vars(args), results, args.output)
@@ -0,0 +1,106 @@
+'''
+Microbenchmarks of the control plane hot paths:
+
+    handle_message   one worker heartbeat, with the default analyzer
+    req_info         info command
+    cull_inactive    culling pass with nothing to cull
+    select_host      resolution of a host selector
+    get_pstree_data  sampling of a process tree (client side)
+
+Server functions are measured at increasing numbers of registered
+workers. Results are printed as JSON.
+'''
+import time
+import logging
+import random
+import argparse
+from subprocess import Popen
+
+from common import timeit, write_results, percentiles
+from simfleet import heartbeat
+import monitored_ipcluster.server as server
+from monitored_ipcluster.analysis import Analyzer
+from monitored_ipcluster.cmdqueue import CommandQueue
+
+
+def populate(n, rng):
+    server.logger.setLevel(logging.WARNING)
+    server.workers.clear()
+    server.worker_index.clear()
+    server.request_queue = CommandQueue()
+    server.analyzer = Analyzer()
+    uids = ['engine-{:06d}'.format(i) for i in range(n)]
+    hosts = ['node{:04d}'.format(i // 32) for i in range(n)]
+    for uid, host in zip(uids, hosts):
+        server.handle_message(heartbeat(uid, host, rng))
+    return uids, hosts
+
+
+def bench_server(sizes, number):
+    rng = random.Random(0)
+    out = {}
+    for n in sizes:
+        uids, hosts = populate(n, rng)
+        beats = [heartbeat(u, h, rng) for u, h in zip(uids, hosts)]
+        it = iter(range(10**12))
+
+        def one_heartbeat():
+            k = next(it) % n
+            # the server keeps the dict it receives: send a fresh copy
+            server.handle_message(dict(beats[k]))
+
+        out[n] = {
+            'handle_message': timeit(one_heartbeat, number=number),
+            'req_info': timeit(server.req_info, number=max(1, number // n), repeat=3),
+            'cull_inactive': timeit(server.cull_inactive, number=max(1, number // n), repeat=3),
+            'select_host': timeit(lambda: server.select(hosts[-1]), number=max(1, number // 10)),
+        }
+    server.workers.clear()
+    server.worker_index.clear()
+    server.request_queue = CommandQueue()
+    server.analyzer = None
+    return out
+
+
+def bench_pstree(n_children, samples):
+    from monitored_ipcluster import process
+    cmd = 'for i in $(seq {}); do sleep 60 & done; wait'.format(n_children)
+    proc = Popen(cmd, shell=True)
+    time.sleep(0.5)
+    out = {}
+    try:
+        for timeout in (1.0, 0.1):
+            process.set_params(timeout=timeout)
+            times = []
+            for _ in range(samples):
+                t0 = time.perf_counter()
+                process.get_pstree_data(proc.pid)
+                times.append((time.perf_counter() - t0) * 1e3)
+            out['timeout_{}'.format(timeout)] = {
+                'tree_size': n_children + 1,
+                'sample_ms': percentiles(times),
+                # time not spent waiting for the cpu measurement interval
+                'overhead_ms': min(times) - timeout * 1e3,
+            }
+    finally:
+        process.set_params()
+        proc.kill()
+        Popen('pkill -P {}'.format(proc.pid), shell=True).wait()
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='numbers of registered workers')
+    parser.add_argument('--number', type=int, default=20000, help='heartbeats per measurement')
+    parser.add_argument('--tree-size', type=int, default=8, help='children of the sampled process')
+    parser.add_argument('--samples', type=int, default=5, help='get_pstree_data samples')
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {
+        'server': bench_server(args.sizes, args.number),
+        'get_pstree_data': bench_pstree(args.tree_size, args.samples),
+    }
+    write_results('server', vars(args), results, args.output)
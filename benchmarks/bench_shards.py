@@ -0,0 +1,103 @@
+'''
+Scaling of the sharded control server.
+
+Runs the same synthetic fleet against the plain server and against the
+sharded server with an increasing number of shards, and reports the
+heartbeats handled per second, their round trip times and the latency of
+info requests (answered by merging the shards) under load. The fleet
+should offer more heartbeats than a single server loop can handle: many
+clients, short heartbeat interval.
+
+Each shard is a process: the scaling is bounded by the cores of the
+machine, which also runs the fleet.
+'''
+import time
+import logging
+import argparse
+import tempfile
+from multiprocessing import Process
+
+import zmq
+
+from common import free_port, percentiles, write_results
+from simfleet import start_fleet, collect
+from bench_fanout import command
+
+
+def run_server(addresses, n_shards):
+    import monitored_ipcluster.server as server
+    import monitored_ipcluster.sharding as sharding
+    server.logger.setLevel(logging.WARNING)
+    sharding.logger.setLevel(logging.WARNING)
+    if n_shards:
+        sharding.sharded_server(n_shards, addresses=addresses, monitor_ipyparallel=False)
+    else:
+        server.server_loop(addresses=addresses, monitor_ipyparallel=False)
+
+
+def start_server(n_shards):
+    ports = [free_port() for _ in range(3)]
+    addresses = {
+        'clients': 'tcp://127.0.0.1:{}'.format(ports[0]),
+        'control': 'tcp://127.0.0.1:{}'.format(ports[1]),
+        'control_ipc': 'ipc://{}/mipc-bench.socket'.format(tempfile.mkdtemp()),
+        'events': 'tcp://127.0.0.1:{}'.format(ports[2]),
+    }
+    # not a daemon: the sharded server starts the shard processes
+    p = Process(target=run_server, args=(addresses, n_shards))
+    p.start()
+    return p, addresses
+
+
+def run(n_shards, n_clients, n_procs, interval, duration):
+    server, addresses = start_server(n_shards)
+    context = zmq.Context()
+    ctl = context.socket(zmq.REQ)
+    ctl.setsockopt(zmq.LINGER, 0)
+    ctl.connect(addresses['control'])
+    time.sleep(1.)
+
+    t_start = time.time()
+    procs, out, _, stop = start_fleet(addresses['clients'], n_clients, n_procs, interval, duration)
+    try:
+        info_ms = []
+        registered = 0
+        while time.time() - t_start < duration:
+            reply, ms = command(ctl, {'type': 'command', 'cmd': 'info'}, timeout=30.)
+            info_ms.append(ms)
+            registered = reply['n_workers']
+            time.sleep(0.5)
+        stats = collect(procs, out)
+        elapsed = time.time() - t_start
+    finally:
+        for p in procs:
+            p.terminate()
+        server.terminate()
+        server.join()
+        ctl.close()
+        context.term()
+
+    return {
+        'registered': registered,
+        'heartbeats_sent': stats['sent'],
+        'heartbeats_received': stats['received'],
+        'heartbeats_per_s': stats['received'] / elapsed,
+        'offered_per_s': n_clients / interval,
+        'heartbeat_rtt_ms': stats['rtt_ms'],
+        'info_ms': percentiles(info_ms),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, nargs='+', default=[0, 1, 2, 4, 8],
+                        help='numbers of shards, 0 for the plain server (default: 0 1 2 4 8)')
+    parser.add_argument('--clients', type=int, default=8000)
+    parser.add_argument('--procs', type=int, default=4, help='fleet processes')
+    parser.add_argument('--interval', type=float, default=1.0, help='heartbeat interval in seconds')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = {n: run(n, args.clients, args.procs, args.interval, args.duration) for n in args.shards}
+    write_results('shards', vars(args), results, args.output)
@@ -0,0 +1,92 @@
+'''
+Helpers shared by the benchmark scripts: timing, percentiles and the
+machine-readable output format.
+
+Every benchmark writes a JSON document like:
+
+    {
+        "benchmark": "<name>",
+        "meta": {"time": ..., "host": ..., "python": ..., "commit": ...},
+        "config": {...},
+        "results": {...}
+    }
+
+so that results of different versions can be compared.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.time(),
+        'host': socket.getfqdn(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if not values:
+        return {'p{}'.format(p): None for p in ps}
+    values = sorted(values)
+    n = len(values)
+    return {'p{}'.format(p): values[min(n - 1, int(p / 100. * n))] for p in ps}
+
+
+def timeit(fn, number=1000, repeat=5):
+    '''
+    Per-call time of fn() in microseconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t0) / number * 1e6)
+    times.sort()
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best_us': times[0],
+        'median_us': times[len(times) // 2],
+    }
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def write_results(name, config, results, output=None):
+    doc = {
+        'benchmark': name,
+        'meta': metadata(),
+        'config': config,
+        'results': results,
+    }
+    out = json.dumps(doc, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+    return doc
@@ -0,0 +1,51 @@
+'''
+Runs the benchmark suite and writes one JSON file per benchmark in the
+output directory (default: bench_results/<commit or timestamp>).
+
+    python benchmarks/run_all.py [--quick] [--output DIR]
+
+--quick uses small configurations, for a smoke test of the suite.
+'''
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from common import metadata
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SUITE = {
+    'server': (['--sizes', '100', '1000', '10000'], ['--sizes', '100', '1000', '--number', '2000', '--samples', '1']),
+    'fanout': ([], ['--clients', '100', '1000', '--interval', '2']),
+    'archive': ([], ['--engines', '100', '--days', '1', '--heartbeats', '20000', '--repeat', '2']),
+    'shards': ([], ['--shards', '0', '1', '2', '--clients', '1000', '--duration', '5', '--procs', '2']),
+    'registry': ([], ['--engines', '1000', '--number', '2000']),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--output', type=str)
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    args = parser.parse_args()
+
+    tag = (metadata()['commit'] or '')[:10] or time.strftime('%Y%m%d-%H%M%S')
+    outdir = args.output or os.path.join('bench_results', tag)
+    os.makedirs(outdir, exist_ok=True)
+
+    failed = []
+    for name, (full, quick) in SUITE.items():
+        if args.names and name not in args.names:
+            continue
+        output = os.path.join(outdir, name + '.json')
+        cmd = [sys.executable, os.path.join(HERE, 'bench_{}.py'.format(name))] + (quick if args.quick else full)
+        print('Running {} -> {}'.format(name, output))
+        if subprocess.call(cmd + ['--output', output]) != 0:
+            failed.append(name)
+
+    if failed:
+        print('Failed: {}'.format(', '.join(failed)))
+        sys.exit(1)
@@ -0,0 +1,146 @@
+'''
+Synthetic client fleet for load tests of the control server.
+
+Each fleet process simulates many clients over a single DEALER socket:
+heartbeats of every simulated client are spread uniformly over the
+heartbeat interval, and replies are matched to requests in order. Clients
+acknowledge the requests they receive with the next heartbeat, as the
+real ones do. Every process records heartbeat round trip times and the
+commands received by its clients.
+
+Can be run against any server:
+
+    python benchmarks/simfleet.py --address tcp://localhost:5558 --clients 5000 --procs 4
+'''
+import time
+import uuid
+import random
+import argparse
+from collections import deque
+from multiprocessing import Process, Queue, Event
+
+import zmq
+
+from common import percentiles, write_results
+
+
+def heartbeat(uid, host, rng, ack=0):
+    return {
+        'uid': uid,
+        'type': 'worker',
+        'host': host,
+        'status': 'running',
+        'pid': 1000 + rng.randrange(30000),
+        'pcpu': rng.uniform(80, 100),
+        'rss': rng.gauss(2e9, 1e8),
+        'net': rng.expovariate(1e-5),
+        'disk_io': rng.expovariate(1e-4),
+        'n_crashes': 0,
+        'n_preempted': 0,
+        'n_warm_starts': 0,
+        'host_mem_total': 256e9,
+        'host_mem_available': 128e9,
+        'host_swap_used': 0,
+        'ack': ack,
+    }
+
+
+def fleet_process(address, uids, hosts_per_proc, interval, duration, out, stop, seed=0):
+    rng = random.Random(seed)
+    context = zmq.Context()
+    sock = context.socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(address)
+
+    n = len(uids)
+    hosts = ['simhost-{}-{}'.format(seed, i % hosts_per_proc) for i in range(n)]
+    start = time.time()
+    next_send = [start + i * interval / n for i in range(n)]
+    acked = [0] * n
+    inflight = deque()
+    rtts = []
+    commands = []
+    sent = 0
+    i = 0
+    end = start + duration
+    while True:
+        now = time.time()
+        if now < end and stop.is_set():
+            end = now
+        if now >= end and not inflight:
+            break
+        if now < end and next_send[i] <= now:
+            sock.send_multipart([b'', zmq.utils.jsonapi.dumps(heartbeat(uids[i], hosts[i], rng, acked[i]))])
+            inflight.append((i, time.perf_counter()))
+            next_send[i] += interval
+            sent += 1
+            i = (i + 1) % n
+            continue
+        timeout = max(0, min(next_send[i] - now, end - now)) * 1000 if now < end else 2000
+        if sock.poll(timeout, zmq.POLLIN):
+            while sock.poll(0, zmq.POLLIN):
+                _, msg = sock.recv_multipart()
+                k, t0 = inflight.popleft()
+                rtts.append((time.perf_counter() - t0) * 1e3)
+                reply = zmq.utils.jsonapi.loads(msg)
+                new = [x for x in reply if x['seq'] > acked[k]]
+                if new:
+                    commands.append((uids[k], time.time(), new))
+                    acked[k] = new[-1]['seq']
+        elif now >= end:
+            # replies lost, give up
+            break
+
+    out.put({'sent': sent, 'received': len(rtts), 'rtts': rtts, 'commands': commands})
+    sock.close()
+    context.term()
+
+
+def start_fleet(address, n_clients, n_procs=1, interval=5.0, duration=30.0, hosts_per_proc=16):
+    '''
+    Starts the fleet processes. Set the returned `stop` event to end the
+    run before `duration`.
+    '''
+    out = Queue()
+    stop = Event()
+    uids = [str(uuid.uuid4()) for _ in range(n_clients)]
+    procs = []
+    for k in range(n_procs):
+        p = Process(target=fleet_process,
+                    args=(address, uids[k::n_procs], hosts_per_proc, interval, duration, out, stop, k),
+                    daemon=True)
+        p.start()
+        procs.append(p)
+    return procs, out, uids, stop
+
+
+def collect(procs, out):
+    stats = [out.get() for _ in procs]
+    for p in procs:
+        p.join()
+    rtts = [x for s in stats for x in s['rtts']]
+    return {
+        'sent': sum(s['sent'] for s in stats),
+        'received': sum(s['received'] for s in stats),
+        'rtt_ms': percentiles(rtts),
+        'commands': [c for s in stats for c in s['commands']],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--address', type=str, default='tcp://localhost:5558')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--procs', type=int, default=2)
+    parser.add_argument('--interval', type=float, default=5.0, help='heartbeat interval in seconds')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--output', type=str, help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    t0 = time.time()
+    procs, out, _, _ = start_fleet(args.address, args.clients, args.procs, args.interval, args.duration)
+    res = collect(procs, out)
+    elapsed = time.time() - t0
+    res['heartbeats_per_s'] = res['received'] / elapsed
+    res['n_commands'] = len(res.pop('commands'))
+    write_results('simfleet', vars(args), res, args.output)
@@ -1,16 +1,237 @@
-import zmq
 import argparse
 import time
 import sys
+import os
+import json
 
-def get_info(s, poller, timeout):
-    s.send_json({'type': 'command', 'cmd': 'info'})
-    reply = wait_for_response(poller, s, timeout)
+# zmq (and uuid, the archive) are imported when needed: the help, the argument
+# errors and the archive queries don't pay for them
+
+
+def print_info(reply):
     if reply['status'] == 'ok':
         print('Control server running on: ', reply['host'])
         print('Scheduler running on: ', reply['shost'])
         print('Number of active workers: ', reply['n_workers'])
         print('Average cpu usage:', reply['ave_cpu'])
+        if 'flags' in reply:
+            print('Flagged workers: ', reply['n_flagged'])
+            for uid, flags in reply['flags'].items():
+                print('   {}: {}'.format(uid, ', '.join(flags)))
+        if 'tasks' in reply:
+            print_tasks(reply['tasks'])
+        if 'probe' in reply:
+            print_probe(reply['probe'])
+        if 'drain' in reply:
+            d = reply['drain']
+            print('Draining: {} ({} waiting their turn, {} stopping)'.format(
+                len(d['draining']), d['waiting'], d['stopping']))
+            for uid, x in d['draining'].items():
+                print('   {}: {} after {:.0f}s, deadline in {:.0f}s'.format(uid, x['action'], x['for'], x['left']))
+        if 'app' in reply:
+            print('Application metrics (cluster total):')
+            for name, value in sorted(reply['app'].items()):
+                print('   {}: {:.6g}'.format(name, value))
+        if 'selected' in reply:
+            print('Selected: ', len(reply['selected']))
+            for uid, host in sorted(reply['selected'].items(), key=lambda x: (x[1] or '', x[0])):
+                print('   {}: {}'.format(uid, host))
+    else:
+        print(reply['status'], reply.get('reason', ''))
+
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def print_probe(probe):
+    r = probe['rtt_ms']
+    print('Scheduler probe: {} (last {}), p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, {} timeouts in {} probes'.format(
+        probe['status'], '{:.1f} ms'.format(probe['last_ms']) if probe['last_ms'] is not None else 'N/A',
+        r['p50'], r['p90'], r['p99'], probe['timeouts'], probe['samples']))
+    slo = probe.get('slo')
+    if slo and slo['slo_ms'] is not None:
+        state = 'breached for {:.0f}s'.format(slo['breached_for']) if slo['breached_for'] is not None else 'met'
+        print('Scheduler SLO: p{} < {:.0f} ms, {}, {} restarts'.format(
+            slo['percentile'], slo['slo_ms'], state, slo['n_restarts']))
+
+
+def print_tasks(tasks):
+    if 'status' in tasks:
+        print('Task accounting', tasks['status'], tasks.get('reason', ''))
+        return
+    print('Tasks completed: {} ({:.2f}/s over the last {:.0f}s)'.format(
+        tasks['completed'], tasks['rate'], tasks['window']))
+    for key, label in (('wait_s', 'Queue wait'), ('runtime_s', 'Run time')):
+        p = tasks[key]
+        if p is not None:
+            print('{} (s): p50 {:.3g}  p90 {:.3g}  p99 {:.3g}  max {:.3g}'.format(
+                label, p['p50'], p['p90'], p['p99'], p['max']))
+    engines = tasks['engines']
+    if engines:
+        print('Engines by throughput (tasks/s, mean run time):')
+        shown = engines if len(engines) <= 10 else engines[:5] + [None] + engines[-5:]
+        for e in shown:
+            if e is None:
+                print('   ...')
+                continue
+            uid = ' ' + e['uid'] if e.get('uid') else ''
+            print('   {:>6}{}: {:.2f}/s, {:.3g}s'.format(str(e['engine']), uid, e['rate'], e['runtime_mean']))
+
+
+def parse_duration(x):
+    if x[-1] in DURATION_UNITS:
+        return float(x[:-1]) * DURATION_UNITS[x[-1]]
+    return float(x)
+
+
+def parse_time(x, now):
+    # -1d, -6h... are relative to now, otherwise epoch or ISO date
+    if x.startswith('-'):
+        return now - parse_duration(x[1:])
+    try:
+        return float(x)
+    except ValueError:
+        from datetime import datetime
+        return datetime.fromisoformat(x).timestamp()
+
+
+def history_request(args):
+    now = time.time()
+    req = {
+        'type': 'command',
+        'cmd': 'history',
+        'start': parse_time(args.start, now),
+        'end': parse_time(args.end, now) if args.end else now,
+        'bucket': parse_duration(args.bucket) if args.bucket else None,
+        'by': args.by,
+        'metrics': args.metric,
+        'uids': args.uid,
+        'hosts': args.host,
+    }
+    return req
+
+
+def print_history(reply):
+    if reply['status'] != 'ok':
+        print(reply['status'], reply.get('reason', ''))
+        return
+    metrics = [m for m in ('pcpu', 'rss', 'net', 'disk_io') if m in reply]
+    print('{:>20s} {:>10s}'.format('time' if reply['by'] == 'time' else 'engine', 'samples') +
+          ''.join(' {:>24s}'.format(m + ' mean/max') for m in metrics))
+    for i, g in enumerate(reply['groups']):
+        if reply['by'] == 'time':
+            g = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(g))
+        else:
+            g = g[:20]
+        line = '{:>20s} {:>10d}'.format(g, reply[metrics[0]]['count'][i] if metrics else 0)
+        for m in metrics:
+            mean, hi = reply[m]['mean'][i], reply[m]['max'][i]
+            line += ' {:>24s}'.format('{:.4g}/{:.4g}'.format(mean, hi) if mean is not None else 'N/A')
+        print(line)
+
+
+def print_stats(reply):
+    if reply['status'] != 'ok':
+        print(reply['status'], reply.get('reason', ''))
+        return
+    q = reply['queues']
+    print('Active workers: ', reply['n_workers'])
+    print('Queued requests: {} ({} clients, max {} per client)'.format(q['queued'], q['clients'], q['max']))
+    print('Requests coalesced: {}, expired: {}, dropped: {}'.format(q['coalesced'], q['expired'], q['dropped']))
+    if not reply['enabled']:
+        print('Instrumentation disabled on the server')
+        return
+    server = reply['server']
+    if server['loop_utilization'] is not None:
+        print('Server loop utilization: {:.1%}'.format(server['loop_utilization']))
+    if 'shards' in reply:
+        print('Shard loop utilization: {}'.format(', '.join(
+            '{:.1%}'.format(s['loop_utilization']) if s['loop_utilization'] is not None else '-'
+            for s in reply['shards'])))
+    print('Server timings since {}:'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(server['since']))))
+    print('  {:<32s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+        'name', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, h in sorted(server['histograms'].items()):
+        if h['count']:
+            print('  {:<32s} {:>10d} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, h['count'], h['mean_ms'], h['p50_ms'], h['p99_ms'], h['max_ms']))
+    if reply['clients']:
+        print('Client timings (distribution of the per-client means):')
+        print('  {:<32s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('name', 'clients', 'p50 ms', 'p90 ms', 'max ms'))
+        for name, c in sorted(reply['clients'].items()):
+            print('  {:<32s} {:>10d} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, c['clients'], c['mean_ms_p50'], c['mean_ms_p90'], c['max_ms']))
+            print('    slowest: {}'.format(', '.join(c['slowest'])))
+
+
+def run_profile(s, poller, args, timeout):
+    import uuid
+    job = uuid.uuid4().hex[:12]
+    s.send_json({'type': 'command', 'cmd': 'profile', 'target': args.target, 'job': job,
+                  'seconds': args.seconds, 'rate': args.rate})
+    reply = wait_for_response(poller, s, timeout)
+    if reply['status'] != 'ok':
+        print(reply['status'], reply.get('reason', ''))
+        return
+    print('Profiling {} engine(s) for {}s, job {}'.format(len(reply['uids']), args.seconds, job))
+
+    # requests and results travel with the heartbeats
+    deadline = time.time() + args.seconds + args.wait
+    while True:
+        time.sleep(2)
+        s.send_json({'type': 'command', 'cmd': 'profile_status', 'job': job})
+        status = wait_for_response(poller, s, timeout)
+        if status['status'] != 'ok':
+            print(status['status'], status.get('reason', ''))
+            return
+        pending = [u for u, t in status['targets'].items() if t['status'] == 'running']
+        if not pending or time.time() > deadline:
+            break
+
+    os.makedirs(args.output, exist_ok=True)
+    merged = []
+    for uid, t in sorted(status['targets'].items()):
+        if t['status'] == 'done':
+            fname = os.path.join(args.output, 'profile-{}-{}.folded'.format(job, uid))
+            with open(fname, 'w') as f:
+                f.write(t['folded'])
+            # one root frame per engine in the merged profile
+            root = '{} {}'.format(t['host'], uid[:8])
+            merged += [root + ';' + l for l in t['folded'].splitlines() if l]
+            print('   {}: {} ({})'.format(uid, fname, t['sampler']))
+        else:
+            print('   {}: {} {}'.format(uid, t['status'] if t['status'] != 'running' else 'timed out',
+                                        t.get('error', '')))
+    if merged and len(status['targets']) > 1:
+        fname = os.path.join(args.output, 'profile-{}.folded'.format(job))
+        with open(fname, 'w') as f:
+            f.write('\n'.join(merged) + '\n')
+        print('Merged profile: {}'.format(fname))
+
+
+def watch_events(ctx, addr, fmt='text'):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.LINGER, 0)
+    sub.setsockopt_string(zmq.SUBSCRIBE, '')
+    sub.connect(addr)
+    try:
+        while True:
+            topic = sub.recv_string()
+            event = sub.recv_json()
+            if fmt == 'text':
+                print(time.strftime('%Y-%m-%d %H:%M:%S'), topic, event)
+            else:
+                print(json.dumps({'time': time.time(), 'topic': topic, 'event': event}), flush=True)
+    except KeyboardInterrupt:
+        pass
+    sub.close()
+
+
+def print_reply(reply):
+    if 'n_selected' in reply:
+        print(reply['status'], '({} selected)'.format(reply['n_selected']))
+    else:
+        print(reply['status'], reply.get('reason', ''))
 
 
 def wait_for_response(poller, socket, timeout=5):
@@ -22,56 +243,201 @@ def wait_for_response(poller, socket, timeout=5):
     return msg
 
 
-if __name__ == "__main__":
+def connect(ctx, target):
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.LINGER, 0)
+    s.connect(target)
+    return s
+
+
+def query(ctx, targets, request, timeout):
+    '''
+    Sends the request to all the targets at once and returns their replies,
+    in the order of the targets. Every target has `timeout` seconds from
+    the send: a cluster that does not answer delays the others by at most
+    that, whatever the number of targets.
+    '''
+    poller = zmq.Poller()
+    sockets = {}
+    for target in targets:
+        s = connect(ctx, target)
+        s.send_json(request)
+        poller.register(s, zmq.POLLIN)
+        sockets[s] = target
+    replies = {}
+    deadline = time.time() + timeout
+    while len(replies) < len(targets):
+        left = deadline - time.time()
+        if left <= 0:
+            break
+        for s, _ in poller.poll(left * 1000):
+            replies[sockets[s]] = s.recv_json()
+            poller.unregister(s)
+    for s, target in sockets.items():
+        if target not in replies:
+            replies[target] = {'status': 'fail', 'reason': 'timeout'}
+            sys.stderr.write("Timeout processing request: {}\n".format(target))
+        # a REQ socket without its reply cannot be reused
+        s.close()
+    return [replies[target] for target in targets]
+
+
+def write_replies(targets, replies, printer, fmt):
+    '''
+    text: the printer output of each target, under a header if there are
+    several. json: one document, target -> reply. ndjson: one line per
+    target.
+    '''
+    if fmt == 'json':
+        print(json.dumps(dict(zip(targets, replies)), indent=2))
+    elif fmt == 'ndjson':
+        for target, reply in zip(targets, replies):
+            print(json.dumps({'target': target, 'reply': reply}))
+        sys.stdout.flush()
+    else:
+        for target, reply in zip(targets, replies):
+            if len(targets) > 1:
+                print('==> {} <=='.format(target))
+            printer(reply)
+
+
+def command_request(args):
+    '''
+    Request of the commands answered by one reply, with its printer.
+    '''
+    if args.cmd in ('restart', 'reset', 'drain', 'undrain', 'limit'):
+        req = {'type': 'command', 'cmd': args.cmd, 'select': args.target}
+    elif args.cmd == 'shutdown':
+        req = {'type': 'command', 'cmd': 'exit', 'select': args.target}
+    elif args.cmd in ('info', 'monitor'):
+        return {'type': 'command', 'cmd': 'info', 'select': args.target}, print_info
+    elif args.cmd == 'history':
+        return history_request(args), print_history
+    elif args.cmd == 'stats':
+        return {'type': 'command', 'cmd': 'stats'}, print_stats
+    else:
+        return None, None
+    if args.cmd == 'drain':
+        req.update(action=args.action, deadline=parse_duration(args.deadline), parallel=args.parallel)
+    if args.cmd == 'limit':
+        req.update(memory_max=args.memory_max, cpu_max=args.cpu_max)
+    return req, print_reply
 
-    timeout = 2
+
+if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Control a Monitored Ipyparallel Cluster')
-    parser.add_argument('cmd', help='Command (restart|shutdown|reset|info|monitor).')
-    parser.add_argument('-a', '--address', type=str, default='localhost:5559',
-                        help='address of the cluster (default: localhost:5559)')
-    parser.add_argument('-s', '--socket', type=str,
-                        help='Use a UNIX socket file descriptor instead of TCP')
+    parser.add_argument('cmd', help='Command (restart|shutdown|reset|info|monitor|history|watch|stats|profile|drain|undrain|limit).')
+    parser.add_argument('target', nargs='?',
+                        help='selector of the engines for restart, shutdown, reset, info, profile, '
+                             'drain, undrain and limit: '
+                             'uid, host glob, type=..., metric predicates like rss>8GB, '
+                             'comma separated (default: all)')
+    parser.add_argument('-a', '--address', type=str, action='append',
+                        help='address of the cluster, repeatable to query several clusters at once '
+                             '(default: localhost:5559)')
+    parser.add_argument('-s', '--socket', type=str, action='append',
+                        help='Use a UNIX socket file descriptor instead of TCP (repeatable)')
+    parser.add_argument('-e', '--events', type=str, default='localhost:5560',
+                        help='address of the server event stream, for watch (default: localhost:5560)')
+    parser.add_argument('-t', '--timeout', type=float,
+                        help='seconds to wait for the reply of each cluster, the clusters are queried '
+                             'at the same time (default: 2, 30 for history)')
+    parser.add_argument('-f', '--format', choices=['text', 'json', 'ndjson'], default='text',
+                        help='output: text, one JSON document (cluster -> reply), or one JSON line '
+                             'per cluster (default: text)')
+
+    history = parser.add_argument_group('history options')
+    history.add_argument('--start', type=str, default='-1h',
+                         help='start of the range: epoch, ISO date or relative like -6h, -2d (default: -1h)')
+    history.add_argument('--end', type=str, help='end of the range (default: now)')
+    history.add_argument('--bucket', type=str, help='aggregate in time buckets, e.g. 5m, 1h, 1d')
+    history.add_argument('--by', choices=['time', 'engine'], default='time',
+                         help='group samples by time bucket or by engine (default: time)')
+    history.add_argument('--metric', action='append', help='metric to query (repeatable, default: all)')
+    history.add_argument('--uid', action='append', help='restrict to an engine uid (repeatable)')
+    history.add_argument('--host', action='append', help='restrict to a host (repeatable)')
+    history.add_argument('--archive', type=str,
+                         help='read the archive directory directly instead of asking the server')
+
+    draining = parser.add_argument_group('drain options (wait for running tasks before stopping engines)')
+    draining.add_argument('--action', choices=['restart', 'exit'], default='restart',
+                          help='what to do with drained engines (default: restart)')
+    draining.add_argument('--deadline', type=str, default='1h',
+                          help='stop engines still busy after this time, e.g. 30m (default: 1h)')
+    draining.add_argument('--parallel', type=int,
+                          help='engines drained at the same time, for rolling restarts (default: all)')
+
+    limits = parser.add_argument_group('limit options (engines started with MIPC_CGROUP=1)')
+    limits.add_argument('--memory-max', type=str, help='memory.max of the engines, e.g. 8GB, or max to remove it')
+    limits.add_argument('--cpu-max', type=str, help='cpu.max of the engines in cores, e.g. 1.5, or max to remove it')
+
+    profiling = parser.add_argument_group('profile options (folded stacks, for flamegraph.pl or inferno)')
+    profiling.add_argument('--seconds', type=float, default=10, help='sampling duration (default: 10)')
+    profiling.add_argument('--rate', type=int, default=100, help='samples per second (default: 100)')
+    profiling.add_argument('--output', type=str, default='.', help='directory of the profiles (default: .)')
+    profiling.add_argument('--wait', type=float, default=60,
+                           help='seconds to wait for results after sampling (default: 60)')
 
     args = parser.parse_args()
 
-    addr = 'tcp://' + args.address
-    if args.socket is not None:
-        addr = 'ipc://' + args.socket
+    # range queries over days of data take longer than a status request
+    timeout = args.timeout or (30 if args.cmd == 'history' else 2)
 
-    ctx = zmq.Context()
-    s = ctx.socket(zmq.REQ)
-    s.setsockopt(zmq.LINGER, 0)
-    s.connect(addr)
-    poller = zmq.Poller()
-    poller.register(s, zmq.POLLIN)
+    if args.cmd == 'history' and args.archive is not None:
+        from monitored_ipcluster.archive import query as query_archive, METRICS
+        req = history_request(args)
+        reply = query_archive(args.archive, req['start'], req['end'], metrics=req['metrics'] or METRICS,
+                              bucket=req['bucket'], by=req['by'], uids=req['uids'], hosts=req['hosts'])
+        reply['status'] = 'ok'
+        write_replies([args.archive], [reply], print_history, args.format)
+        sys.exit(0)
 
-    if args.cmd == 'restart':
-        s.send_json({'type': 'command', 'cmd': 'restart'})
-        reply = wait_for_response(poller, s, timeout)
-        print(reply['status'])
+    targets = ['tcp://' + a for a in args.address or []] + ['ipc://' + s for s in args.socket or []]
+    targets = list(dict.fromkeys(targets)) or ['tcp://localhost:5559']
 
-    if args.cmd == 'shutdown':
-        s.send_json({'type': 'command', 'cmd': 'exit'})
-        reply = wait_for_response(poller, s, timeout)
-        print(reply['status'])
+    request, printer = command_request(args)
+    if args.cmd == 'limit' and args.memory_max is None and args.cpu_max is None:
+        parser.error('limit needs --memory-max or --cpu-max')
+    if args.cmd == 'profile':
+        if args.target is None:
+            parser.error('profile needs an engine uid or a host')
+        if len(targets) > 1:
+            parser.error('profile runs against a single cluster')
+    if args.cmd == 'monitor' and args.format == 'json':
+        parser.error('monitor streams its output, use --format ndjson')
+    if request is None and args.cmd not in ('profile', 'watch'):
+        parser.error('unknown command: {}'.format(args.cmd))
 
-    if args.cmd == 'reset':
-        s.send_json({'type': 'command', 'cmd': 'reset'})
-        reply = wait_for_response(poller, s, timeout)
-        print(reply['status'])
+    import zmq
+    ctx = zmq.Context()
+    failed = False
 
-    if args.cmd == 'info':
-        get_info(s, poller, timeout)
+    if args.cmd == 'profile':
+        s = connect(ctx, targets[0])
+        poller = zmq.Poller()
+        poller.register(s, zmq.POLLIN)
+        run_profile(s, poller, args, timeout)
+        s.close()
 
-    if args.cmd == 'monitor':
+    elif args.cmd == 'watch':
+        watch_events(ctx, 'tcp://' + args.events, args.format)
+
+    elif args.cmd == 'monitor':
         try:
             while True:
-                get_info(s, poller, timeout)
-                print('-----------------------------------')
+                write_replies(targets, query(ctx, targets, request, timeout), printer, args.format)
+                if args.format == 'text':
+                    print('-----------------------------------')
                 time.sleep(1)
         except KeyboardInterrupt:
             pass
 
-    s.close()
-    ctx.term()
\ No newline at end of file
+    else:
+        replies = query(ctx, targets, request, timeout)
+        write_replies(targets, replies, printer, args.format)
+        # for health checks: non zero if a cluster did not answer, or refused
+        failed = any(r.get('status') != 'ok' for r in replies)
+
+    ctx.term()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,189 @@
+import time
+from statistics import median
+
+METRICS = ('pcpu', 'rss', 'net', 'disk_io')
+
+DEFAULTS = {
+    'ewma_alpha': 0.3,         # weight of the last sample in the per-engine averages
+    'median_rate': 0.05,       # step of the streaming median, relative to the MAD
+    'warmup': 32,              # samples used to seed median and MAD
+    'outlier_z': 5.0,          # robust z-score above which an engine is an outlier
+    'cpu_idle': 5.0,           # % cpu under which a busy engine is considered stalled
+    'cpu_stall_beats': 6,      # consecutive heartbeats before flagging a stall
+    'rss_growth_beats': 24,    # consecutive rss increases before flagging a leak
+    'rss_growth_min': 0.1,     # ...if rss also grew at least by this fraction
+    'disk_io_min': 50e6,       # B/s, disk outliers below this are not flagged
+    # deviations smaller than these are never considered significant
+    'min_scale': {'pcpu': 5.0, 'rss': 64e6, 'net': 1e6, 'disk_io': 1e6},
+}
+
+
+class StreamingMedian:
+    '''
+    O(1) estimate of the median and median absolute deviation of a stream.
+
+    Seeded with the exact values of the first `warmup` samples, then moved
+    by a step proportional to the current MAD towards each new sample
+    (stochastic approximation of the quantile).
+    '''
+
+    __slots__ = ('rate', 'warmup', 'min_scale', 'median', 'mad', '_seed')
+
+    def __init__(self, rate=0.05, warmup=32, min_scale=0.):
+        self.rate = rate
+        self.warmup = warmup
+        self.min_scale = min_scale
+        self.median = None
+        self.mad = None
+        self._seed = []
+
+    def update(self, x):
+        if self.median is None:
+            self._seed.append(x)
+            if len(self._seed) >= self.warmup:
+                self.median = median(self._seed)
+                self.mad = median([abs(v - self.median) for v in self._seed])
+                self._seed = None
+            return
+        tiny = 1e-6 * abs(self.median) + 1e-9
+        step = self.rate * max(self.mad, tiny)
+        if x > self.median:
+            self.median += step
+        elif x < self.median:
+            self.median -= step
+        dev = abs(x - self.median)
+        if dev > self.mad:
+            self.mad += step
+        elif dev < self.mad:
+            self.mad = max(self.mad - step, 0.)
+
+    def zscore(self, x):
+        if self.median is None:
+            return 0.
+        scale = max(1.4826 * self.mad, self.min_scale) + 1e-9
+        return (x - self.median) / scale
+
+
+class EngineState:
+    __slots__ = ('ewma', 'last_rss', 'rss_rising', 'rss_base', 'cpu_stalled')
+
+    def __init__(self):
+        self.ewma = {}
+        self.last_rss = None
+        self.rss_rising = 0
+        self.rss_base = None
+        self.cpu_stalled = 0
+
+
+class Analyzer:
+    '''
+    Flags engines that behave differently from their peers.
+
+    Keeps a streaming median/MAD per metric across all the engines and an
+    EWMA per metric per engine, both updated with every heartbeat, so the
+    cost of a heartbeat does not depend on the number of engines.
+
+    Flags:
+        cpu_stalled     cpu stuck near 0 while the engine has tasks
+        rss_growing     rss grew at every heartbeat for a long time
+        disk_io_high    disk throughput much higher than the peers
+        <metric>_high   ewma of the metric is an outlier (z > outlier_z)
+        pcpu_low        cpu much lower than the peers
+        misplaced       cpu affinity differs from the assigned placement
+    '''
+
+    def __init__(self, **options):
+        self.options = dict(DEFAULTS, **options)
+        self.stats = {
+            m: StreamingMedian(self.options['median_rate'], self.options['warmup'],
+                               self.options['min_scale'].get(m, 0.)) for m in METRICS
+        }
+        self.engines = {}
+        self.flags = {}
+
+    def update(self, uid, data, queue=None):
+        '''
+        Updates the statistics with an heartbeat. `queue` is the number of
+        tasks assigned to the engine by the scheduler, if known.
+
+        Returns (raised, cleared) lists of flags.
+        '''
+        if data.get('status') != 'running':
+            return [], []
+        opt = self.options
+        state = self.engines.get(uid)
+        if state is None:
+            state = self.engines[uid] = EngineState()
+
+        alpha = opt['ewma_alpha']
+        for m in METRICS:
+            x = data.get(m)
+            if x is None:
+                continue
+            self.stats[m].update(x)
+            prev = state.ewma.get(m)
+            state.ewma[m] = x if prev is None else prev + alpha * (x - prev)
+
+        current = set()
+        ewma = state.ewma
+
+        # cpu stuck at 0 with work to do
+        if queue and ewma.get('pcpu', 100.) < opt['cpu_idle']:
+            state.cpu_stalled += 1
+        else:
+            state.cpu_stalled = 0
+        if state.cpu_stalled >= opt['cpu_stall_beats']:
+            current.add('cpu_stalled')
+
+        # monotonic memory growth
+        rss = data.get('rss')
+        if rss is not None:
+            if state.last_rss is not None and rss > state.last_rss:
+                state.rss_rising += 1
+            else:
+                state.rss_rising = 0
+                state.rss_base = rss
+            state.last_rss = rss
+            if (state.rss_rising >= opt['rss_growth_beats'] and state.rss_base and
+                    rss > state.rss_base * (1 + opt['rss_growth_min'])):
+                current.add('rss_growing')
+
+        # engine pinned to cores or NUMA node other than the assigned ones
+        if 'placement' in data and 'affinity' in data:
+            node = data.get('placement_node')
+            if (data['affinity'] != data['placement'] or
+                    (node is not None and data.get('numa_nodes') != [node])):
+                current.add('misplaced')
+
+        # outliers with respect to the peers
+        z = opt['outlier_z']
+        for m, x in ewma.items():
+            score = self.stats[m].zscore(x)
+            if score > z:
+                if m == 'disk_io' and x < opt['disk_io_min']:
+                    continue
+                current.add(m + '_high')
+            elif m == 'pcpu' and score < -z:
+                current.add('pcpu_low')
+
+        previous = self.flags.get(uid, {})
+        raised = [f for f in current if f not in previous]
+        cleared = [f for f in previous if f not in current]
+        if current:
+            now = time.time()
+            self.flags[uid] = {f: previous.get(f, now) for f in current}
+        elif uid in self.flags:
+            del self.flags[uid]
+        return raised, cleared
+
+    def forget(self, uid):
+        self.engines.pop(uid, None)
+        self.flags.pop(uid, None)
+
+    def summary(self):
+        return {
+            'stats': {
+                m: {'median': s.median, 'mad': s.mad} for m, s in self.stats.items()
+            },
+            'flags': {uid: sorted(f) for uid, f in self.flags.items()},
+        }
@@ -0,0 +1,199 @@
+'''
+Application metrics shared by an engine with its supervising client.
+
+The client creates a small memory mapped file (in /dev/shm when
+available) before starting the engine and passes its path in the
+MIPC_METRICS_PATH environment variable. Engine code records metrics with
+plain memory writes, and the client reads them on every heartbeat:
+
+    from monitored_ipcluster import appmetrics
+
+    tasks = appmetrics.metric('tasks_done')
+    result_bytes = appmetrics.metric('result_bytes')
+    serialize = appmetrics.metric('serialize_s')
+
+    tasks.add()
+    result_bytes.add(len(buf))
+    with serialize.time():
+        buf = pickle.dumps(result)
+
+Values are doubles, used as counters (add), gauges (set) or accumulated
+seconds (time). There is a single writer, the engine process: metrics
+created by its children are not supported. Outside of a supervised
+engine, metrics are kept in process memory and never reported. A warm
+standby engine gets a file of its own, which becomes the file of the
+engine when the standby is swapped in.
+
+Layout: a 16 bytes header (magic, version, number of slots) followed by
+N_SLOTS slots of a 32 bytes utf-8 name and an 8 bytes aligned double.
+'''
+import os
+import mmap
+import time
+import struct
+import tempfile
+
+ENV_VAR = 'MIPC_METRICS_PATH'
+MAGIC = b'MIPC'
+VERSION = 1
+N_SLOTS = 64
+NAME_SIZE = 32
+SLOT_SIZE = NAME_SIZE + 8
+HEADER = struct.Struct('<4sII4x')
+FILE_SIZE = HEADER.size + N_SLOTS * SLOT_SIZE
+
+
+def metrics_path(uid):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'mipc-{}.metrics'.format(uid))
+
+
+def create(path):
+    '''
+    Creates the file, or zeroes it in place for a new engine. The size
+    never changes, as a shrinking file would fault concurrent readers.
+    '''
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size != FILE_SIZE:
+            os.ftruncate(fd, FILE_SIZE)
+        os.pwrite(fd, bytes(FILE_SIZE - HEADER.size), HEADER.size)
+        os.pwrite(fd, HEADER.pack(MAGIC, VERSION, N_SLOTS), 0)
+    finally:
+        os.close(fd)
+
+
+def _map(path):
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), FILE_SIZE)
+
+
+def _slot_names(buf):
+    return [bytes(buf[HEADER.size + i * SLOT_SIZE:HEADER.size + i * SLOT_SIZE + NAME_SIZE])
+            for i in range(N_SLOTS)]
+
+
+def _values(buf):
+    # one double per slot, after the name: strided view, no copy
+    return memoryview(buf).cast('B')[HEADER.size:].cast('d')[NAME_SIZE // 8::SLOT_SIZE // 8]
+
+
+class Metric:
+
+    __slots__ = ('_values', '_i')
+
+    def __init__(self, values, i):
+        self._values = values
+        self._i = i
+
+    @property
+    def value(self):
+        return self._values[self._i]
+
+    def add(self, x=1):
+        self._values[self._i] += x
+
+    def set(self, x):
+        self._values[self._i] = x
+
+    def time(self):
+        '''
+        Context manager adding the elapsed seconds to the metric.
+        '''
+        return _Timer(self)
+
+
+class _Timer:
+
+    __slots__ = ('metric', 't0')
+
+    def __init__(self, metric):
+        self.metric = metric
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.add(time.perf_counter() - self.t0)
+
+
+class MetricsWriter:
+    '''
+    Engine side of the channel.
+    '''
+
+    def __init__(self, path=None):
+        if path is not None:
+            self._buf = _map(path)
+        else:
+            self._buf = bytearray(FILE_SIZE)
+        self._values = _values(self._buf)
+        self._metrics = {}
+
+    def metric(self, name):
+        m = self._metrics.get(name)
+        if m is not None:
+            return m
+        raw = name.encode()[:NAME_SIZE]
+        names = _slot_names(self._buf)
+        try:
+            i = names.index(raw.ljust(NAME_SIZE, b'\0'))
+        except ValueError:
+            try:
+                i = names.index(bytes(NAME_SIZE))
+            except ValueError:
+                raise RuntimeError('Too many application metrics (max {})'.format(N_SLOTS)) from None
+            self._values[i] = 0.
+            # the name last: the reader skips unnamed slots
+            off = HEADER.size + i * SLOT_SIZE
+            self._buf[off:off + NAME_SIZE] = raw.ljust(NAME_SIZE, b'\0')
+        m = self._metrics[name] = Metric(self._values, i)
+        return m
+
+
+class MetricsReader:
+    '''
+    Client side of the channel.
+    '''
+
+    def __init__(self, path):
+        self._buf = _map(path)
+        self._values = _values(self._buf)
+        self._names = {}  # raw name -> decoded
+
+    def read(self):
+        out = {}
+        buf = self._buf
+        for i in range(N_SLOTS):
+            off = HEADER.size + i * SLOT_SIZE
+            if buf[off] == 0:
+                continue
+            raw = buf[off:off + NAME_SIZE]
+            name = self._names.get(raw)
+            if name is None:
+                name = self._names[raw] = raw.rstrip(b'\0').decode(errors='replace')
+            out[name] = self._values[i]
+        return out
+
+    def close(self):
+        self._values.release()
+        self._buf.close()
+
+
+_writer = None
+
+
+def metric(name):
+    '''
+    Returns the metric `name` of this engine, creating it if needed.
+    '''
+    global _writer
+    if _writer is None:
+        path = os.environ.get(ENV_VAR)
+        try:
+            _writer = MetricsWriter(path)
+        except (OSError, ValueError):
+            # not supervised, or the file is gone
+            _writer = MetricsWriter()
+    return _writer.metric(name)
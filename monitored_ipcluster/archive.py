@@ -0,0 +1,264 @@
+import os
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger('ARCHIVE')
+logger.setLevel(logging.INFO)
+
+METRICS = ('net', 'pcpu', 'rss', 'disk_io')
+DAY = 86400
+ENGINES_FILE = 'engines.txt'
+
+# one raw file per column per day
+COLUMNS = [('time', np.float64), ('engine', np.int32)] + [(m, np.float32) for m in METRICS]
+
+
+def day_name(day):
+    return time.strftime('%Y%m%d', time.gmtime(day * DAY))
+
+
+class MetricsArchive:
+    '''
+    Append-only columnar archive of heartbeat metrics.
+
+    Rows are buffered in memory and flushed every `flush_interval` seconds
+    by appending raw arrays to one file per column per (UTC) day:
+
+        <path>/<YYYYMMDD>/{time,engine,net,pcpu,rss,disk_io}.bin
+
+    Engines are stored as small integers, the uid/host/type of each index
+    is kept in <path>/engines.txt. Rows are appended in arrival order, so
+    the time column of each day is sorted and doubles as the time index:
+    a query memory-maps only the days overlapping its range and bisects
+    them.
+    '''
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.time()
+        self.engines = {}
+        self.engine_info = []
+        os.makedirs(path, exist_ok=True)
+        self._load_engines()
+
+    def _load_engines(self):
+        fname = os.path.join(self.path, ENGINES_FILE)
+        if not os.path.exists(fname):
+            return
+        with open(fname) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                self.engines[fields[0]] = len(self.engine_info)
+                self.engine_info.append(tuple(fields))
+
+    def engine_id(self, uid, host='-', ptype='-'):
+        idx = self.engines.get(uid)
+        if idx is None:
+            idx = len(self.engine_info)
+            self.engines[uid] = idx
+            self.engine_info.append((uid, host, ptype))
+            with open(os.path.join(self.path, ENGINES_FILE), 'a') as f:
+                f.write('{} {} {}\n'.format(uid, host, ptype))
+        return idx
+
+    def append(self, data, now=None):
+        '''
+        Buffers the metrics of a single heartbeat.
+        '''
+        if now is None:
+            now = time.time()
+        self._buffer.append((now, data['uid'], data.get('host', '-'), data.get('type', '-')) +
+                            tuple(data.get(m, np.nan) for m in METRICS))
+
+    def maybe_flush(self):
+        if self._buffer and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        t = np.array([r[0] for r in rows], dtype=np.float64)
+        engine = np.array([self.engine_id(*r[1:4]) for r in rows], dtype=np.int32)
+        values = np.array([r[4:] for r in rows], dtype=np.float32).reshape(len(rows), len(METRICS))
+        self.extend(t, engine, *values.T)
+
+    def extend(self, t, engine, *values):
+        '''
+        Appends already columnar rows. `t` must be sorted.
+        '''
+        days = (t // DAY).astype(np.int64)
+        cuts = np.flatnonzero(np.diff(days)) + 1
+        starts = np.concatenate([[0], cuts])
+        ends = np.concatenate([cuts, [len(t)]])
+        columns = (t, engine) + values
+        for i0, i1 in zip(starts, ends):
+            ddir = os.path.join(self.path, day_name(days[i0]))
+            os.makedirs(ddir, exist_ok=True)
+            for (name, dtype), col in zip(COLUMNS, columns):
+                with open(os.path.join(ddir, name + '.bin'), 'ab') as f:
+                    f.write(np.ascontiguousarray(col[i0:i1], dtype=dtype).tobytes())
+
+    def close(self):
+        self.flush()
+
+
+def _open_day(ddir):
+    cols = {}
+    for name, dtype in COLUMNS:
+        fname = os.path.join(ddir, name + '.bin')
+        if not os.path.exists(fname) or os.path.getsize(fname) == 0:
+            return None
+        cols[name] = np.memmap(fname, dtype=dtype, mode='r')
+    # a crash may leave columns of different lengths
+    n = min(len(c) for c in cols.values())
+    return {k: v[:n] for k, v in cols.items()}
+
+
+def query(path, start, end, metrics=METRICS, bucket=None, by='time', uids=None, hosts=None):
+    '''
+    Aggregates archived metrics in the [start, end) range.
+
+    With by='time' the samples of all the selected engines are reduced in
+    time buckets of `bucket` seconds (a single bucket if None). With
+    by='engine' they are reduced per engine over the whole range.
+
+    Returns count, sum, min and max for each metric and group, so that
+    results of different archives can be merged; mean is added for
+    convenience.
+    '''
+    engine_info = []
+    fname = os.path.join(path, ENGINES_FILE)
+    if os.path.exists(fname):
+        with open(fname) as f:
+            engine_info = [tuple(line.split()) for line in f if len(line.split()) == 3]
+
+    selected = None
+    if uids or hosts:
+        selected = np.array([
+            i for i, (u, h, _) in enumerate(engine_info)
+            if (uids and u in uids) or (hosts and h in hosts)
+        ], dtype=np.int32)
+
+    if bucket is None or by == 'engine':
+        bucket = end - start
+    n_groups = len(engine_info) if by == 'engine' else int(np.ceil((end - start) / bucket))
+    n_groups = max(n_groups, 1)
+
+    acc = {
+        m: {
+            'count': np.zeros(n_groups, dtype=np.int64),
+            'sum': np.zeros(n_groups, dtype=np.float64),
+            'min': np.full(n_groups, np.inf),
+            'max': np.full(n_groups, -np.inf),
+        } for m in metrics
+    }
+
+    n_rows = 0
+    for day in range(int(start // DAY), int((end - 1e-9) // DAY) + 1):
+        ddir = os.path.join(path, day_name(day))
+        cols = _open_day(ddir) if os.path.isdir(ddir) else None
+        if cols is None:
+            continue
+        t = cols['time']
+        i0, i1 = np.searchsorted(t, [start, end])
+        if i1 <= i0:
+            continue
+        t = np.asarray(t[i0:i1])
+        mask = None
+        if selected is not None or by == 'engine':
+            engine = np.asarray(cols['engine'][i0:i1])
+            if selected is not None:
+                mask = np.isin(engine, selected)
+                t, engine = t[mask], engine[mask]
+        if by == 'time':
+            # rows are time sorted: buckets are contiguous runs, found by bisection
+            edges = start + bucket * np.arange(int((t[0] - start) // bucket), int((t[-1] - start) // bucket) + 2)
+            bounds = np.searchsorted(t, edges)
+            nonempty = bounds[1:] > bounds[:-1]
+            seg = bounds[:-1][nonempty]
+            gid = int((t[0] - start) // bucket) + np.flatnonzero(nonempty)
+            order = None
+        else:
+            # group the samples of each engine together
+            order = np.argsort(engine, kind='stable')
+            engine = engine[order]
+            seg = np.flatnonzero(np.diff(engine, prepend=-1))
+            gid = engine[seg]
+        n_rows += len(t)
+        for m in metrics:
+            v = np.asarray(cols[m][i0:i1])
+            if mask is not None:
+                v = v[mask]
+            if order is not None:
+                v = v[order]
+            a = acc[m]
+            ok = None
+            if not np.isfinite(v.sum(dtype=np.float64)):
+                # missing samples are stored as NaN
+                ok = np.isfinite(v)
+                v = np.where(ok, v, 0)
+            a['sum'][gid] += np.add.reduceat(v, seg, dtype=np.float64)
+            if ok is None:
+                a['count'][gid] += np.diff(np.append(seg, len(v)))
+                a['min'][gid] = np.minimum(a['min'][gid], np.minimum.reduceat(v, seg))
+                a['max'][gid] = np.maximum(a['max'][gid], np.maximum.reduceat(v, seg))
+            else:
+                a['count'][gid] += np.add.reduceat(ok, seg, dtype=np.int64)
+                a['min'][gid] = np.minimum(a['min'][gid], np.minimum.reduceat(np.where(ok, v, np.inf), seg))
+                a['max'][gid] = np.maximum(a['max'][gid], np.maximum.reduceat(np.where(ok, v, -np.inf), seg))
+
+    out = {'start': start, 'end': end, 'by': by, 'bucket': bucket, 'rows': n_rows}
+    if by == 'engine':
+        out['groups'] = [u for u, _, _ in engine_info]
+    else:
+        out['groups'] = [start + i * bucket for i in range(n_groups)]
+    keep = np.zeros(n_groups, dtype=bool)
+    for m in metrics:
+        keep |= acc[m]['count'] > 0
+    out['groups'] = [x for x, k in zip(out['groups'], keep) if k]
+    for m in metrics:
+        a = acc[m]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            a['mean'] = a['sum'] / a['count']
+        out[m] = {k: [None if not np.isfinite(x) else float(x) for x in v[keep]]
+                  for k, v in a.items() if k != 'count'}
+        out[m]['count'] = a['count'][keep].tolist()
+    return out
+
+
+
+def merge(results):
+    '''
+    Merges the query results of several archives over the same range and
+    buckets, e.g. those of the shards of a server.
+    '''
+    out = {k: results[0][k] for k in ('start', 'end', 'by', 'bucket')}
+    out['rows'] = sum(r['rows'] for r in results)
+    metrics = [m for m, v in results[0].items() if isinstance(v, dict)]
+    groups = {}
+    for r in results:
+        for i, g in enumerate(r['groups']):
+            groups.setdefault(g, []).append((r, i))
+    out['groups'] = sorted(groups) if out['by'] == 'time' else list(groups)
+    for m in metrics:
+        acc = {'count': [], 'sum': [], 'min': [], 'max': [], 'mean': []}
+        for g in out['groups']:
+            parts = [(r[m], i) for r, i in groups[g]]
+            count = sum(a['count'][i] for a, i in parts)
+            total = sum(a['sum'][i] or 0. for a, i in parts)
+            mins = [a['min'][i] for a, i in parts if a['min'][i] is not None]
+            maxs = [a['max'][i] for a, i in parts if a['max'][i] is not None]
+            acc['count'].append(count)
+            acc['sum'].append(total)
+            acc['min'].append(min(mins) if mins else None)
+            acc['max'].append(max(maxs) if maxs else None)
+            acc['mean'].append(total / count if count else None)
+        out[m] = acc
+    return out
@@ -0,0 +1,180 @@
+import sys
+import math
+import time
+import logging
+from subprocess import Popen
+
+logger = logging.getLogger('AUTOSCALE')
+logger.setLevel(logging.INFO)
+
+LOCAL_WORKER_CMD = [sys.executable, '-c', 'from monitored_ipcluster.client import main; main()']
+
+DEFAULTS = {
+    'min_engines': 1,
+    'max_engines': 64,
+    'up_ratio': 2.0,           # scale up when waiting tasks per idle engine stay above this
+    'up_window': 30.,          # s the condition has to hold
+    'up_step': 16,             # max engines requested at once
+    'down_idle_fraction': 0.5, # scale down when more than this fraction of engines is idle...
+    'down_window': 300.,       # ...for this many seconds, with no waiting tasks
+    'idle_reserve': 0.1,       # fraction of idle engines kept when scaling down
+    'cooldown': 120.,          # s after any action before the next one
+    'launch_timeout': 600.,    # s to wait for requested engines to register
+}
+
+
+class LocalLauncher:
+    '''
+    Starts supervised engines as local processes. Stand-in for a batch
+    system launcher, useful for testing and for single node clusters.
+    '''
+
+    def __init__(self, cmd=None):
+        self.cmd = cmd or LOCAL_WORKER_CMD
+        self.procs = []
+
+    def launch(self, n):
+        self.procs = [p for p in self.procs if p.poll() is None]
+        for i in range(n):
+            self.procs.append(Popen(self.cmd))
+
+
+class CommandLauncher:
+    '''
+    Requests engines running a shell command, e.g. a batch submission
+    script. `template` is formatted with the number of engines, as in
+    'start_ipcluster {n} 2500MB 100:00:00 py3 4GB'.
+    '''
+
+    def __init__(self, template):
+        self.template = template
+
+    def launch(self, n):
+        Popen(self.template.format(n=n), shell=True)
+
+
+def make_launcher(spec):
+    if spec is None or spec == 'local':
+        return LocalLauncher()
+    if isinstance(spec, str):
+        return CommandLauncher(spec)
+    return spec
+
+
+class Autoscaler:
+    '''
+    Closed-loop controller of the number of engines.
+
+    Engines are requested through `launcher` when the waiting tasks per
+    idle engine stay above `up_ratio` for `up_window` seconds, and idle
+    engines are retired when most of the cluster stays idle with no
+    waiting tasks for `down_window` seconds. Separate thresholds and
+    windows, a cooldown after every action and the accounting of engines
+    requested but not yet registered keep the controller from flapping.
+    '''
+
+    def __init__(self, launcher=None, **options):
+        self.launcher = make_launcher(launcher)
+        self.options = dict(DEFAULTS, **options)
+        self._up_since = None
+        self._down_since = None
+        self._last_action = 0.
+        self._in_flight = []   # (time, n) of launch requests
+        self._last_count = None
+        self._retiring = {}    # uid -> time of the exit request
+        self.history = []
+
+    def in_flight(self, now):
+        timeout = self.options['launch_timeout']
+        self._in_flight = [(t, n) for t, n in self._in_flight if now - t < timeout and n > 0]
+        return sum(n for _, n in self._in_flight)
+
+    def _registered(self, n_engines):
+        # newly registered engines are not in flight anymore
+        if self._last_count is not None and n_engines > self._last_count:
+            new = n_engines - self._last_count
+            for i, (t, n) in enumerate(self._in_flight):
+                k = min(n, new)
+                self._in_flight[i] = (t, n - k)
+                new -= k
+        self._last_count = n_engines
+
+    def tick(self, status, workers, engine_queue, now=None):
+        '''
+        Returns the list of uids of the workers to retire. Launches engines
+        directly when needed. `status` is the ipyparallel status computed
+        by the server.
+        '''
+        if now is None:
+            now = time.time()
+        if status.get('status') != 'connected':
+            self._up_since = self._down_since = None
+            return []
+        opt = self.options
+
+        n_engines = status['n_workers']
+        self._registered(n_engines)
+        in_flight = self.in_flight(now)
+        n_busy = status['n_working']
+        n_idle = max(n_engines - n_busy, 0)
+        waiting = max(status['n_pending'] - n_busy, 0)
+
+        pressure = waiting / max(n_idle + in_flight, 1)
+        want_up = pressure > opt['up_ratio'] and n_engines + in_flight < opt['max_engines']
+        want_down = (waiting == 0 and n_engines > opt['min_engines'] and
+                     n_idle > opt['down_idle_fraction'] * n_engines)
+
+        if not want_up:
+            self._up_since = None
+        elif self._up_since is None:
+            self._up_since = now
+        if not want_down:
+            self._down_since = None
+        elif self._down_since is None:
+            self._down_since = now
+
+        if now - self._last_action < opt['cooldown']:
+            return []
+
+        if want_up and now - self._up_since >= opt['up_window']:
+            needed = math.ceil(waiting / opt['up_ratio']) - n_idle - in_flight
+            n = min(max(needed, 1), opt['up_step'], opt['max_engines'] - n_engines - in_flight)
+            if n > 0:
+                logger.info('Scaling up: requesting {} engines ({} waiting tasks, {} idle engines)'.format(
+                    n, waiting, n_idle))
+                self.launcher.launch(n)
+                self._in_flight.append((now, n))
+                self._action(now, 'up', n)
+            return []
+
+        if want_down and now - self._down_since >= opt['down_window']:
+            n = min(n_idle - math.ceil(opt['idle_reserve'] * n_engines), n_engines - opt['min_engines'])
+            # only retire engines known to be idle
+            self._retiring = {u: t for u, t in self._retiring.items()
+                              if u in workers and now - t < opt['launch_timeout']}
+            idle = [uid for uid in workers
+                    if uid not in self._retiring and engine_queue(uid) == 0][:max(n, 0)]
+            for uid in idle:
+                self._retiring[uid] = now
+            if idle:
+                logger.info('Scaling down: retiring {} idle engines'.format(len(idle)))
+                self._action(now, 'down', len(idle))
+            return idle
+
+        return []
+
+    def _action(self, now, direction, n):
+        self._last_action = now
+        self._up_since = self._down_since = None
+        self.history.append({'time': now, 'action': direction, 'n': n})
+        self.history = self.history[-100:]
+
+    def summary(self, now=None):
+        if now is None:
+            now = time.time()
+        return {
+            'in_flight': self.in_flight(now),
+            'min_engines': self.options['min_engines'],
+            'max_engines': self.options['max_engines'],
+            'recent': self.history[-10:],
+        }
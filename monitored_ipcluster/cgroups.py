@@ -0,0 +1,246 @@
+'''
+cgroup v2 accounting and limits of a supervised engine.
+
+The client moves itself to <own cgroup>/mipc-<uid>/supervisor and starts
+the engine in <own cgroup>/mipc-<uid>/engine, with the cpu, memory and io
+controllers enabled. The engine usage is then read from a few files,
+whatever the size of its process tree, including short lived children.
+
+The own cgroup of the client must be delegated to its user and have the
+controllers available, e.g. by starting the client with
+
+    systemd-run --user --scope -p Delegate=yes python run-worker.py
+
+Otherwise setup_cgroup returns None and the client walks the process
+tree as usual.
+'''
+import os
+import glob
+import logging
+
+logger = logging.getLogger('CGROUP')
+logger.setLevel(logging.INFO)
+
+CONTROLLERS = ('cpu', 'memory', 'io')
+
+_mount = False
+
+
+def cgroup2_mount():
+    '''
+    Mount point of the cgroup v2 hierarchy (/sys/fs/cgroup, or
+    /sys/fs/cgroup/unified on hybrid systems), None if not mounted.
+    '''
+    global _mount
+    if _mount is False:
+        _mount = None
+        try:
+            with open('/proc/self/mountinfo') as f:
+                for line in f:
+                    fields = line.split()
+                    # optional fields end with '-', then the fs type
+                    sep = fields.index('-')
+                    if fields[sep + 1] == 'cgroup2':
+                        _mount = fields[4]
+                        break
+        except (IOError, ValueError):
+            pass
+    return _mount
+
+
+def current_cgroup(pid='self'):
+    with open('/proc/{}/cgroup'.format(pid)) as f:
+        for line in f:
+            if line.startswith('0::'):
+                return line[3:].strip()
+    return None
+
+
+def _read(path, name):
+    with open(os.path.join(path, name)) as f:
+        return f.read()
+
+
+def _write(path, name, value):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(value)
+
+
+def _controllers(path):
+    return set(_read(path, 'cgroup.controllers').split())
+
+
+def setup_cgroup(uid, controllers=CONTROLLERS):
+    '''
+    Creates the cgroups of a client and moves the calling process in its
+    supervisor cgroup. Returns the engine cgroup directory, or None if
+    cgroup v2 with the memory controller is not available.
+    '''
+    mount = cgroup2_mount()
+    if mount is None:
+        logger.info('cgroup v2 not mounted, using process tree accounting')
+        return None
+    try:
+        own = os.path.join(mount, current_cgroup().lstrip('/'))
+        available = _controllers(own)
+        if 'memory' not in available:
+            logger.info('Memory controller not available in {}, using process tree accounting'.format(own))
+            return None
+
+        sweep(own)
+        group = os.path.join(own, 'mipc-{}'.format(uid))
+        supervisor = os.path.join(group, 'supervisor')
+        engine = os.path.join(group, 'engine')
+        os.makedirs(supervisor, exist_ok=True)
+        # no internal processes: the client leaves the cgroups with controllers
+        _write(supervisor, 'cgroup.procs', '0')
+
+        wanted = [c for c in controllers if c in available]
+        enabled = set(_read(own, 'cgroup.subtree_control').split())
+        missing = [c for c in wanted if c not in enabled]
+        if missing:
+            _write(own, 'cgroup.subtree_control', ' '.join('+' + c for c in missing))
+        _write(group, 'cgroup.subtree_control', ' '.join('+' + c for c in wanted))
+        os.makedirs(engine, exist_ok=True)
+        logger.info('Engine cgroup: {} ({})'.format(engine, ', '.join(wanted)))
+        return engine
+    except (IOError, OSError) as e:
+        # typically not delegated, or other processes in the own cgroup
+        logger.warning('Cannot set up cgroups ({}), using process tree accounting'.format(e))
+        return None
+
+
+def attach(path, pid=0):
+    '''
+    Moves a process into the cgroup, by default the calling one (as
+    preexec_fn).
+    '''
+    _write(path, 'cgroup.procs', str(pid))
+
+
+def _remove_tree(path):
+    # cgroup directories only hold the interface files: rmdir bottom up
+    for d, _, _ in os.walk(path, topdown=False):
+        os.rmdir(d)
+
+
+def _release_controllers(path):
+    enabled = _read(path, 'cgroup.subtree_control').split()
+    if enabled:
+        _write(path, 'cgroup.subtree_control', ' '.join('-' + c for c in enabled))
+
+
+def sweep(own):
+    '''
+    Removes the cgroups left by clients that could not remove them (see
+    remove), once all their processes are gone.
+    '''
+    for group in glob.glob(os.path.join(own, 'mipc-*')):
+        try:
+            if 'populated 0' in _read(group, 'cgroup.events'):
+                _remove_tree(group)
+        except (IOError, OSError):
+            pass
+
+
+def remove(engine):
+    '''
+    Removes the cgroups created by setup_cgroup, at the exit of the client.
+
+    The client lives in the supervisor cgroup. As the controllers are
+    released bottom up, it moves to the parent cgroup, which can hold
+    processes again, and removes the cgroup it left. If the own cgroup
+    has other children (other clients) or is the root, the mipc-<uid>
+    directory stays, and is removed by the next client (see sweep).
+    '''
+    group = os.path.dirname(engine)
+    own = os.path.dirname(group)
+    try:
+        if os.path.isdir(engine):
+            os.rmdir(engine)
+        _release_controllers(group)
+        attach(group)
+        _remove_tree(os.path.join(group, 'supervisor'))
+        others = [d for d in os.listdir(own)
+                  if d != os.path.basename(group) and os.path.isdir(os.path.join(own, d))]
+        if others or os.path.samefile(own, cgroup2_mount()):
+            return
+        _release_controllers(own)
+        attach(own)
+        _remove_tree(group)
+    except (IOError, OSError) as e:
+        logger.info('Cannot remove all the cgroups of the client: {}'.format(e))
+
+
+def _flat_keyed(text):
+    out = {}
+    for line in text.splitlines():
+        k, v = line.split()
+        out[k] = int(v)
+    return out
+
+
+def read_usage(path):
+    '''
+    Cumulative usage of the cgroup: cpu seconds, memory (current, peak and
+    anonymous, the equivalent of the rss) and bytes read and written.
+    '''
+    usage = {
+        'cpu': _flat_keyed(_read(path, 'cpu.stat'))['usage_usec'] / 1e6,
+        'mem_current': int(_read(path, 'memory.current')),
+        'anon': _flat_keyed(_read(path, 'memory.stat')).get('anon', 0),
+        'io': 0,
+    }
+    try:
+        usage['mem_peak'] = int(_read(path, 'memory.peak'))
+    except (IOError, OSError):
+        # kernels before 5.19
+        pass
+    try:
+        for line in _read(path, 'io.stat').splitlines():
+            for kv in line.split()[1:]:
+                k, v = kv.split('=')
+                if k in ('rbytes', 'wbytes'):
+                    usage['io'] += int(v)
+    except (IOError, OSError):
+        pass
+    return usage
+
+
+def get_cgroup_data(path, prev, now):
+    '''
+    Engine figures in the format of process.get_pstree_data. Rates are
+    computed since the previous call, `prev` is a dict kept by the caller.
+    '''
+    usage = read_usage(path)
+    last = prev.get('usage')
+    dt = now - prev.get('time', now)
+    data = {
+        'pcpu': 0.,
+        'disk_io': 0,
+        'rss': usage['anon'],
+        'mem_current': usage['mem_current'],
+    }
+    if 'mem_peak' in usage:
+        data['mem_peak'] = usage['mem_peak']
+    limit = _read(path, 'memory.max').strip()
+    if limit != 'max':
+        data['mem_max'] = int(limit)
+    if last is not None and dt > 0:
+        data['pcpu'] = max(0., usage['cpu'] - last['cpu']) / dt * 100
+        data['disk_io'] = int(max(0, usage['io'] - last['io']) / dt)
+    prev['usage'] = usage
+    prev['time'] = now
+    return data
+
+
+def set_limits(path, memory_max=None, cpu_max=None):
+    '''
+    memory.max in bytes and cpu.max in cores, 'max' removes a limit.
+    '''
+    if memory_max is not None:
+        _write(path, 'memory.max', str(int(memory_max)) if memory_max != 'max' else 'max')
+    if cpu_max is not None:
+        period = 100000
+        quota = 'max' if cpu_max == 'max' else str(int(float(cpu_max) * period))
+        _write(path, 'cpu.max', '{} {}'.format(quota, period))
@@ -1,3 +1,4 @@
+import os
 import zmq
 import traceback
 import signal
@@ -5,37 +6,108 @@ import uuid
 import time
 from queue import Empty
 from multiprocessing import Process, Value, Queue
-from subprocess import Popen, TimeoutExpired
+from subprocess import Popen, PIPE, TimeoutExpired
 from functools import partial
 import socket
+import json
+import threading
 from .messages import *
-from .process import get_pstree_data
+from .instrument import stats
+from .process import get_pstree_data, get_pstree_pids, get_host_memory, get_net_usage
+from .placement import setup_placement, wrap_command, pin_current_process, get_affinity, format_cpulist, acquire_slot
+from .profiling import profile, chunks
+from . import appmetrics
+from . import cgroups
 import logging
 
 logging.basicConfig()
 
+# the control loop has its own, see control_loop
+logger = logging.getLogger('CLIENT')
+logger.setLevel(logging.INFO)
+
 WORKER_CMD = 'ipengine > /dev/null 2> /dev/null'
 UPDATE_CYCLE = 5.0 # repeat every 5 seconds
+STANDBY_RETRY = 10.0 # s between attempts to start a standby engine
 
 
 def get_process_details(ctx):
     data = {
         'uid' : ctx['uid'],
         'type': ctx['type'],
-        'host': socket.getfqdn()
+        'host': socket.getfqdn(),
+        'n_crashes': ctx['crashes'].value,
+        'n_preempted': ctx['preempted'].value,
+        'n_warm_starts': ctx['warm_starts'].value,
+        # last request processed
+        'ack': ctx['acked'].value,
     }
+    data.update(get_host_memory())
     if ctx['pid'].value > 0:
         data['pid'] = ctx['pid'].value
         data['status'] = 'running'
-        stats = get_pstree_data(ctx['pid'].value)
+        stats = None
+        if ctx['cgroup']:
+            try:
+                stats = get_engine_cgroup_data(ctx)
+            except (IOError, OSError) as e:
+                # e.g. cgroup removed behind our back: still send the heartbeat
+                logger.warning('Cannot read the engine cgroup ({}), walking the process tree'.format(e))
+        if stats is None:
+            stats = get_pstree_data(ctx['pid'].value)
         if stats:
             data.update(stats)
+        affinity = get_affinity(ctx['pid'].value)
+        if affinity:
+            data.update(affinity)
+        if ctx['placement']:
+            data['placement'] = format_cpulist(ctx['placement']['cpus'])
+            data['placement_node'] = ctx['placement']['node']
+        app = read_app_metrics(ctx)
+        if app:
+            data['app'] = app
     else:
         data['returncode'] = ctx['retcode'].value
         data['status'] = 'dead'
+    if ctx['standby_pid'].value > 0:
+        data['standby_pid'] = ctx['standby_pid'].value
+    return data
+
+
+def get_engine_cgroup_data(ctx):
+    # the usage of the whole engine tree, in O(1)
+    data = cgroups.get_cgroup_data(ctx['cgroup'], ctx.setdefault('cgroup_prev', {}), time.time())
+    try:
+        data['net'] = get_net_usage(ctx['pid'].value)
+    except Exception:
+        data['net'] = 0
     return data
 
 
+def engine_metrics_path(ctx):
+    return ctx['metrics_paths'][ctx['metrics_current'].value]
+
+
+def standby_metrics_path(ctx):
+    return ctx['metrics_paths'][1 - ctx['metrics_current'].value]
+
+
+def read_app_metrics(ctx):
+    # metrics written by the engine in shared memory, see appmetrics. The
+    # engine and the standby have a file each, swapped on promotion.
+    current = ctx['metrics_current'].value
+    if ctx.get('app_reader') is not None and ctx['app_reader_file'] != current:
+        ctx['app_reader'].close()
+        ctx['app_reader'] = None
+    if ctx.get('app_reader') is None:
+        try:
+            ctx['app_reader'] = appmetrics.MetricsReader(ctx['metrics_paths'][current])
+        except (OSError, ValueError):
+            return None
+        ctx['app_reader_file'] = current
+    return ctx['app_reader'].read()
+
+
 def graceful_exit(ctx):
     subproc = ctx['subproc']
     logger = ctx['logger']
@@ -57,17 +129,129 @@ def graceful_exit(ctx):
                 traceback.print_exc()
 
 
+def prepare_engine(placement, cgroup):
+    # runs in the engine process before exec
+    if cgroup:
+        cgroups.attach(cgroup)
+    if placement:
+        pin_current_process(placement)
+
+
+def start_standby(ctx):
+    # keeps a warm engine ready, if there is a free standby slot on the host
+    logger = ctx['logger']
+    standby = ctx['standby']
+    if standby is not None:
+        if standby['proc'].poll() is None:
+            return
+        logger.warning('Standby engine exited [retcode: {}]'.format(standby['proc'].returncode))
+        drop_standby(ctx)
+    if time.time() < ctx['standby_retry']:
+        return
+    ctx['standby_retry'] = time.time() + STANDBY_RETRY
+    slot, fd = acquire_slot('standby', ctx['standby_max'])
+    if slot is None:
+        return
+    placement = ctx['placement']
+    # its own file: preloaded modules may create their metrics already
+    appmetrics.create(standby_metrics_path(ctx))
+    proc = Popen(
+        wrap_command(ctx['standby_cmd'], placement),
+        shell=True,
+        stdin=PIPE,
+        preexec_fn=partial(prepare_engine, placement, None),
+        env=dict(os.environ, **{appmetrics.ENV_VAR: standby_metrics_path(ctx)})
+    )
+    ctx['standby'] = {'proc': proc, 'fd': fd}
+    ctx['standby_pid'].value = proc.pid
+    logger.debug('Started standby engine in slot {}. PID: {}'.format(slot, proc.pid))
+
+
+def drop_standby(ctx):
+    standby = ctx['standby']
+    if standby is None:
+        return
+    proc = standby['proc']
+    try:
+        # end of file: the standby exits
+        proc.stdin.close()
+        proc.wait(3)
+    except TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    except OSError:
+        pass
+    os.close(standby['fd'])
+    ctx['standby'] = None
+    ctx['standby_pid'].value = -1
+
+
+def promote_standby(ctx):
+    # swaps in the warm engine, returns False if there is none
+    logger = ctx['logger']
+    standby = ctx['standby']
+    if standby is None or standby['proc'].poll() is not None:
+        return False
+    proc = standby['proc']
+    if ctx['cgroup']:
+        try:
+            for pid in get_pstree_pids(proc.pid):
+                cgroups.attach(ctx['cgroup'], pid)
+        except (IOError, OSError):
+            logger.exception('Cannot move the standby engine to the engine cgroup')
+    try:
+        proc.stdin.write(b'start\n')
+        proc.stdin.close()
+    except (IOError, OSError):
+        logger.exception('Cannot start the standby engine')
+        drop_standby(ctx)
+        return False
+    # the slot is free for a new standby
+    os.close(standby['fd'])
+    ctx['standby'] = None
+    ctx['standby_pid'].value = -1
+    ctx['subproc'] = proc
+    # the file of the standby is the one of the engine now, the next
+    # standby takes the file of the old engine
+    ctx['metrics_current'].value = 1 - ctx['metrics_current'].value
+    ctx['warm_starts'].value += 1
+    ctx['standby_retry'] = 0
+    logger.info('Swapped in the standby engine. PID: {}'.format(proc.pid))
+    return True
+
+
 def do_start(ctx):
     logger = ctx['logger']
     if ctx['subproc'] and ctx['subproc'].poll() is None:
         # already running
         return
-    else:
-        ctx['subproc'] = Popen(ctx['cmd'], shell=True)
+    elif not promote_standby(ctx):
+        placement = ctx['placement']
+        # fresh application metrics for the new engine
+        appmetrics.create(engine_metrics_path(ctx))
+        ctx['subproc'] = Popen(
+            wrap_command(ctx['cmd'], placement),
+            shell=True,
+            preexec_fn=partial(prepare_engine, placement, ctx['cgroup']),
+            env=dict(os.environ, **{appmetrics.ENV_VAR: engine_metrics_path(ctx)})
+        )
         logger.debug('Started Engine subprocess. PID: {}'.format(ctx['subproc'].pid))
     return False
 
 
+def do_limit(ctx, memory_max=None, cpu_max=None):
+    logger = ctx['logger']
+    if not ctx['cgroup']:
+        logger.warning('Resource limits need the engine cgroup, ignored')
+        return False
+    logger.info('Setting engine limits: memory.max {}, cpu.max {}'.format(memory_max, cpu_max))
+    try:
+        cgroups.set_limits(ctx['cgroup'], memory_max, cpu_max)
+    except (IOError, OSError):
+        logger.exception('Cannot set the engine limits')
+    return False
+
+
 def do_continue(ctx):
     return False
 
@@ -80,6 +264,38 @@ def do_restart(ctx):
     return False
 
 
+def do_preempt(ctx):
+    logger = ctx['logger']
+    logger.info('Preemptive restart requested to release memory')
+    ctx['preempted'].value += 1
+    graceful_exit(ctx)
+    do_start(ctx)
+    return False
+
+
+def run_profile(ctx, job, pid, seconds, rate):
+    logger = ctx['logger']
+    try:
+        sampler, folded = profile(pid, seconds, rate)
+        ctx['profiles'].put({'job': job, 'sampler': sampler, 'folded': folded})
+        logger.info('Profile {} complete ({})'.format(job, sampler))
+    except Exception as e:
+        ctx['profiles'].put({'job': job, 'error': repr(e)})
+        logger.exception('Profile {} failed'.format(job))
+
+
+def do_profile(ctx, job, seconds=10, rate=100):
+    logger = ctx['logger']
+    if ctx['pid'].value <= 0:
+        ctx['profiles'].put({'job': job, 'error': 'engine not running'})
+        return False
+    logger.info('Profiling engine for {}s (job {})'.format(seconds, job))
+    # sample in the background, the engine is still supervised meanwhile
+    th = threading.Thread(target=run_profile, args=(ctx, job, ctx['pid'].value, seconds, rate), daemon=True)
+    th.start()
+    return False
+
+
 def clear_queue(q):
     while True:
         try:
@@ -96,6 +312,7 @@ def do_exit(ctx):
     clear_queue(requests)
     requests.put(None)
     graceful_exit(ctx)
+    drop_standby(ctx)
     logger.info('Clean up complete')
     return True
 
@@ -108,21 +325,34 @@ def control_loop(ctx):
 
     ctx['logger'] = logger
     ctx['subproc'] = None
+    ctx['standby'] = None
+    ctx['standby_retry'] = 0
 
     handles = {
         REQ_CONTINUE: do_continue,
         REQ_EXIT: do_exit,
         REQ_RESTART: do_restart,
-        REQ_START: do_start
+        REQ_PREEMPT: do_preempt,
+        REQ_START: do_start,
+        REQ_PROFILE: do_profile,
+        REQ_LIMIT: do_limit,
     }
 
     while True:
         try:
             try:
-                req = ctx['requests'].get(timeout=1.0)
-                if req is None:
+                item = ctx['requests'].get(timeout=1.0)
+                if item is None:
                     break
-                if handles[req](ctx): # a tru-ish value means break
+                seq, req = item
+                if isinstance(req, dict):
+                    # request with arguments
+                    args = dict(req)
+                    done = handles[args.pop('req')](ctx, **args)
+                else:
+                    done = handles[req](ctx)
+                ctx['acked'].value = seq
+                if done: # a tru-ish value means break
                     break
             except Empty:
                 pass
@@ -130,9 +360,16 @@ def control_loop(ctx):
             # autorestart
             if ctx['auto_restart'].value and (ctx['subproc'] is None or ctx['subproc'].poll() is not None):
                 _rc = ctx['retcode'].value if ctx['retcode'].value != -10000 else 'None'
+                if ctx['subproc'] is not None:
+                    # the engine died on its own
+                    ctx['crashes'].value += 1
                 logger.debug('Engine is not running [retcode: {}]. Starting...'.format(_rc))
                 do_start(ctx)
 
+            # refill the standby in the background
+            if ctx['standby_cmd'] and ctx['running'].value:
+                start_standby(ctx)
+
             # update pid and return code
             _pid = None
             _rc = None
@@ -163,30 +400,78 @@ def socket_open(context):
     return socket, pollin, pollout
 
 
+def send_profiles(ctx, socket, pollin, pollout):
+    '''
+    Sends the completed profiles to the server, in chunks. Returns False
+    if the server did not answer.
+    '''
+    while True:
+        try:
+            res = ctx['profiles'].get_nowait()
+        except Empty:
+            return True
+        msg = {'uid': ctx['uid'], 'type': 'profile', 'job': res['job']}
+        if 'error' in res:
+            parts = [dict(msg, error=res['error'])]
+        else:
+            folded = chunks(res['folded'])
+            parts = [dict(msg, sampler=res['sampler'], seq=i, n_chunks=len(folded), data=x)
+                     for i, x in enumerate(folded)]
+        for part in parts:
+            if not pollout.poll(1000):
+                return False
+            socket.send_json(part)
+            if not pollin.poll(3000):
+                return False
+            socket.recv_json()
+
+
 def communication_loop(ctx):
 
     print('Entering Communications Loop')
     context = zmq.Context()
     print("Connecting to the server…")
     socket, pollin, pollout = socket_open(context)
+    # the server resends requests until they are acknowledged
+    last_seq = 0
 
     while ctx['running'].value:
         try:
+            if not send_profiles(ctx, socket, pollin, pollout):
+                print('ERROR: connection to server timed out')
+                socket.close()
+                socket, pollin, pollout = socket_open(context)
+            if stats.enabled:
+                t0 = time.perf_counter()
             data = get_process_details(ctx)
+            if stats.enabled:
+                stats.observe('client.sample', time.perf_counter() - t0)
+                # figures since the last report, the server aggregates them
+                data['_stats'] = {k: h.summary() for k, h in stats.histograms.items()}
+                stats.reset()
+                t0 = time.perf_counter()
+            msg = json.dumps(data)
+            if stats.enabled:
+                stats.observe('client.serialize', time.perf_counter() - t0)
             if pollout.poll(1000):
-                socket.send_json(data)
+                t_sent = time.perf_counter()
+                socket.send_string(msg)
                 ok = False
                 req_queue = []
                 for trial in range(3):
                     if pollin.poll(1000):
                         req_queue = socket.recv_json()
                         ok = True
+                        if stats.enabled:
+                            stats.observe('client.rtt', time.perf_counter() - t_sent)
                 if not ok:
                     print('ERROR: connection to server timed out')
                     socket.close()
                     socket, pollin, pollout = socket_open(context)
                 for x in req_queue:
-                    ctx['requests'].put(x)
+                    if x['seq'] > last_seq:
+                        ctx['requests'].put((x['seq'], x['req']))
+                        last_seq = x['seq']
             time.sleep(UPDATE_CYCLE)
         except KeyboardInterrupt:
             ctx['requests'].put(None)
@@ -199,19 +484,46 @@ def communication_loop(ctx):
     print('Exiting Communications Loop')
 
 
-def main(cmd=WORKER_CMD, ptype='worker'):
+def main(cmd=WORKER_CMD, ptype='worker', placement=None, cores_per_engine=1, cgroup=False,
+         standby=0, standby_cmd=None):
+    '''
+    `standby` is the number of warm engines kept on this host, each client
+    keeps at most one, started with `standby_cmd` (see standby.py).
+    '''
 
+    uid = str(uuid.uuid4())
     ctx = {
-        'uid': str(uuid.uuid4()),
+        'uid': uid,
         'cmd': cmd,
         'type': ptype,
         'running': Value('b', True),
         'auto_restart': Value('b', True),
         'requests': Queue(),
         'pid': Value('i', -1),
-        'retcode': Value('i', -10000)
+        'retcode': Value('i', -10000),
+        'crashes': Value('i', 0),
+        'preempted': Value('i', 0),
+        'warm_starts': Value('i', 0),
+        'standby_pid': Value('i', -1),
+        'standby_cmd': standby_cmd if standby > 0 else None,
+        'standby_max': standby,
+        'acked': Value('q', 0),
+        'placement': None,
+        'profiles': Queue(),
+        # engine and standby files, see read_app_metrics
+        'metrics_paths': (appmetrics.metrics_path(uid), appmetrics.metrics_path(uid + '-standby')),
+        'metrics_current': Value('b', 0),
+        'cgroup': None,
     }
 
+    if placement:
+        # pin the engine to a set of cores and its NUMA node
+        ctx['placement'] = setup_placement(placement, cores_per_engine)
+
+    if cgroup:
+        # account and limit the engine tree through its own cgroup
+        ctx['cgroup'] = cgroups.setup_cgroup(uid)
+
     req_loop = Process(target=control_loop, args=(ctx, ))
     comm_loop = Process(target=communication_loop, args=(ctx, ))
     try:
@@ -225,4 +537,11 @@ def main(cmd=WORKER_CMD, ptype='worker'):
         #clear_queue(requests)
         req_loop.join()
         comm_loop.join()
-        clear_queue(ctx['requests'])
\ No newline at end of file
+        clear_queue(ctx['requests'])
+        for path in ctx['metrics_paths']:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if ctx['cgroup']:
+            cgroups.remove(ctx['cgroup'])
\ No newline at end of file
@@ -0,0 +1,153 @@
+import time
+import logging
+
+from .messages import *
+
+logger = logging.getLogger('CMDQUEUE')
+logger.setLevel(logging.INFO)
+
+# requests that (re)start the engine: one pending is enough
+RESTARTS = (REQ_RESTART, REQ_PREEMPT, REQ_START)
+
+
+def request_code(req):
+    # requests with arguments are dicts like {'req': REQ_PROFILE, ...}
+    return req['req'] if isinstance(req, dict) else req
+
+
+class CommandQueue:
+    '''
+    Per client queues of pending requests.
+
+    Every request gets a sequence number and is sent with each heartbeat
+    reply until the client acknowledges it, reporting the sequence number
+    of the last request it processed. Clients skip requests they have
+    already seen, so redelivery is harmless.
+
+    Pushing coalesces with the pending requests: an exit supersedes
+    everything else, one restart is enough (a restart or preemption
+    replaces a pending start), and a request identical to a pending one is
+    dropped. Requests expire after `ttl` seconds, and a queue holds at most
+    `max_len` requests, the oldest being dropped first.
+
+    Sequence numbers start from the current time in milliseconds, so that
+    they keep increasing across server restarts without persistence.
+
+    `log(op, uid, arg)`, if set, is called on every change, for the
+    write-ahead log: ('push', entry), ('drop', seq), ('ack', seq) and
+    ('clear', None).
+    '''
+
+    def __init__(self, max_len=32, ttl=600., log=None):
+        self.max_len = max_len
+        self.ttl = ttl
+        self.log = log
+        self.queues = {}
+        self._seq = int(time.time() * 1000)
+        self.n_coalesced = 0
+        self.n_expired = 0
+        self.n_dropped = 0
+
+    def _log(self, op, uid, arg=None):
+        if self.log is not None:
+            self.log(op, uid, arg)
+
+    def _remove(self, uid, q, entries):
+        for e in entries:
+            q.remove(e)
+            self._log('drop', uid, e['seq'])
+
+    def _live(self, uid, now):
+        q = self.queues.get(uid)
+        if not q:
+            return []
+        expired = [e for e in q if now - e['time'] > self.ttl]
+        if expired:
+            self.n_expired += len(expired)
+            self._remove(uid, q, expired)
+            if not q:
+                del self.queues[uid]
+        return q
+
+    def push(self, uid, req, now=None):
+        '''
+        Queues a request, returns its entry or None if it was coalesced
+        with the pending ones.
+        '''
+        now = time.time() if now is None else now
+        q = self._live(uid, now)
+        code = request_code(req)
+        codes = [request_code(e['req']) for e in q]
+
+        if REQ_EXIT in codes or any(e['req'] == req for e in q) or \
+                (code in RESTARTS and (REQ_RESTART in codes or REQ_PREEMPT in codes)):
+            self.n_coalesced += 1
+            return None
+
+        if code == REQ_EXIT:
+            superseded = list(q)
+        elif code in (REQ_RESTART, REQ_PREEMPT):
+            superseded = [e for e in q if request_code(e['req']) == REQ_START]
+        else:
+            superseded = []
+        self.n_coalesced += len(superseded)
+
+        if len(q) - len(superseded) >= self.max_len:
+            logger.warning('Queue of {} full, dropping the oldest request'.format(uid))
+            superseded.append(next(e for e in q if e not in superseded))
+            self.n_dropped += 1
+        self._remove(uid, q, superseded)
+
+        self._seq += 1
+        entry = {'seq': self._seq, 'req': req, 'time': now}
+        self.queues.setdefault(uid, []).append(entry)
+        self._log('push', uid, entry)
+        return entry
+
+    def pending(self, uid, now=None):
+        '''
+        Requests not yet acknowledged by the client, as sent with the
+        heartbeat replies.
+        '''
+        q = self._live(uid, time.time() if now is None else now)
+        return [{'seq': e['seq'], 'req': e['req']} for e in q]
+
+    def ack(self, uid, seq):
+        q = self.queues.get(uid)
+        if q and q[0]['seq'] <= seq:
+            rest = [e for e in q if e['seq'] > seq]
+            if rest:
+                self.queues[uid] = rest
+            else:
+                del self.queues[uid]
+            self._log('ack', uid, seq)
+
+    def clear(self, uid):
+        q = self.queues.pop(uid, None)
+        if q:
+            self._log('clear', uid)
+
+    def restore(self, requests):
+        '''
+        Loads queues saved by the state store.
+        '''
+        now = time.time()
+        for uid, q in requests.items():
+            for e in q:
+                if not isinstance(e, dict) or 'seq' not in e:
+                    # request saved before acknowledgements
+                    self._seq += 1
+                    e = {'seq': self._seq, 'req': e, 'time': now}
+                self.queues.setdefault(uid, []).append(e)
+                self._seq = max(self._seq, e['seq'])
+
+    def summary(self):
+        sizes = [len(q) for q in self.queues.values()]
+        return {
+            'clients': sum(1 for n in sizes if n),
+            'queued': sum(sizes),
+            'max': max(sizes, default=0),
+            'coalesced': self.n_coalesced,
+            'expired': self.n_expired,
+            'dropped': self.n_dropped,
+        }
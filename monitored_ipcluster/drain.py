@@ -0,0 +1,136 @@
+import time
+from collections import deque, OrderedDict
+
+# s, stop the engine anyway after this time
+DEADLINE = 3600.
+
+
+class DrainRegistry:
+    '''
+    Engines waiting for their in-flight tasks to complete before being
+    restarted or stopped.
+
+    An engine is stopped as soon as the ipyparallel status shows no task
+    assigned to it, or when its deadline expires. Engines the status does
+    not know about yet are waited for as well: their identification only
+    completes once their running tasks are done.
+
+    With `parallel` set, at most that many engines of a drain are drained
+    at once, the others wait their turn: a slot is released when the
+    client acknowledges the restart (rolling restart).
+
+    ipyparallel has no way of excluding an engine from load balancing, so
+    an engine is caught idle between tasks: with the default high water
+    mark of the scheduler (one task per engine) this happens after each
+    task. Engines receiving tasks continuously from direct views are
+    stopped at their deadline.
+    '''
+
+    def __init__(self):
+        self.active = OrderedDict()   # uid -> {'action', 'since', 'deadline', 'drain'}
+        self.stopping = {}            # uid -> drain id, waiting for the client ack
+        self.waiting = {}             # drain id -> deque of (uid, action, deadline)
+        self.parallel = {}            # drain id -> max engines drained at once
+        self.history = deque(maxlen=100)
+        self._next_id = 0
+
+    def start(self, uids, action='restart', deadline=None, parallel=None, now=None):
+        '''
+        Drains the engines `uids`, then `action` ('restart' or 'exit')
+        them. Returns the drain id.
+        '''
+        now = time.time() if now is None else now
+        deadline = DEADLINE if deadline is None else deadline
+        self._next_id += 1
+        drain = self._next_id
+        uids = [u for u in uids if u not in self.active and u not in self.stopping]
+        self.waiting[drain] = deque((u, action, deadline) for u in uids)
+        self.parallel[drain] = parallel
+        self._fill(drain, now)
+        return drain
+
+    def _fill(self, drain, now):
+        q = self.waiting.get(drain)
+        if q is None:
+            return
+        limit = self.parallel[drain]
+        running = sum(1 for d in self.active.values() if d['drain'] == drain) + \
+            sum(1 for d in self.stopping.values() if d == drain)
+        while q and (limit is None or running < limit):
+            uid, action, deadline = q.popleft()
+            self.active[uid] = {'action': action, 'since': now, 'deadline': now + deadline, 'drain': drain}
+            running += 1
+        if not q and not running:
+            del self.waiting[drain]
+            del self.parallel[drain]
+
+    def cancel(self, uids):
+        n = 0
+        for uid in uids:
+            if self.active.pop(uid, None) is not None:
+                n += 1
+        for drain, q in list(self.waiting.items()):
+            kept = deque(x for x in q if x[0] not in uids)
+            n += len(q) - len(kept)
+            self.waiting[drain] = kept
+            self._fill(drain, time.time())
+        return n
+
+    def forget(self, uid):
+        # the client is gone
+        d = self.active.pop(uid, None)
+        drain = self.stopping.pop(uid, None)
+        drain = d['drain'] if d is not None else drain
+        if drain is not None:
+            self._fill(drain, time.time())
+
+    def is_draining(self, uid):
+        return uid in self.active
+
+    def check(self, engine_queue, tracked=True, pending=None, now=None):
+        '''
+        Returns the (uid, action, reason) of the engines to stop now.
+        `engine_queue(uid)` gives the tasks assigned to the engine of a
+        client, None while unknown. `tracked` is False when ipyparallel is
+        not monitored at all: the engines are stopped right away, as
+        waiting would only delay them until the deadline. While the status
+        is temporarily unavailable the engines wait, up to their deadline.
+        `pending(uid)` tells if a client has requests not yet
+        acknowledged.
+        '''
+        now = time.time() if now is None else now
+        out = []
+        for uid, d in list(self.active.items()):
+            queue = engine_queue(uid)
+            if not tracked:
+                reason = 'untracked'
+            elif queue == 0:
+                reason = 'idle'
+            elif now > d['deadline']:
+                reason = 'deadline'
+            else:
+                continue
+            del self.active[uid]
+            self.stopping[uid] = d['drain']
+            self.history.append((now, uid, d['action'], reason, now - d['since']))
+            out.append((uid, d['action'], reason))
+
+        # restarts acknowledged by the clients free rolling slots
+        stopped = {x[0] for x in out}
+        for uid, drain in list(self.stopping.items()):
+            if uid not in stopped and (pending is None or not pending(uid)):
+                del self.stopping[uid]
+                self._fill(drain, now)
+        return out
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        return {
+            'draining': {
+                uid: {'action': d['action'], 'for': now - d['since'], 'left': d['deadline'] - now}
+                for uid, d in self.active.items()
+            },
+            'waiting': sum(len(q) for q in self.waiting.values()),
+            'stopping': len(self.stopping),
+            'recent': list(self.history)[-10:],
+        }
@@ -0,0 +1,117 @@
+import os
+import math
+import time
+
+# 1us .. ~1 hour in powers of 2
+N_BUCKETS = 32
+
+
+class Histogram:
+    '''
+    Latency histogram with power of 2 buckets (in microseconds). Recording
+    is O(1) and percentiles are approximated by the bucket upper bounds.
+    '''
+
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        us = seconds * 1e6
+        idx = math.frexp(us)[1] if us >= 1 else 0
+        self.buckets[min(idx, N_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        target = p / 100. * self.count
+        acc = 0
+        for i, n in enumerate(self.buckets):
+            acc += n
+            if acc >= target:
+                return min(2. ** i * 1e-6, self.max)
+        return self.max
+
+    def summary(self):
+        '''
+        Figures in milliseconds.
+        '''
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1e3,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+            'max_ms': self.max * 1e3,
+        }
+
+
+class Stats:
+    '''
+    Registry of named latency histograms. When disabled, callers are
+    expected to skip the measurement altogether:
+
+        if stats.enabled:
+            t0 = time.perf_counter()
+        ...
+        if stats.enabled:
+            stats.observe('name', time.perf_counter() - t0)
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.since = time.time()
+
+    def observe(self, name, seconds):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.record(seconds)
+
+    def summary(self):
+        return {
+            'since': self.since,
+            'histograms': {k: h.summary() for k, h in self.histograms.items()},
+        }
+
+    def reset(self):
+        self.histograms = {}
+        self.since = time.time()
+
+
+class LoopMeter:
+    '''
+    Fraction of time a poll loop spends handling messages, over windows of
+    `window` seconds.
+    '''
+
+    def __init__(self, window=10.):
+        self.window = window
+        self.busy = 0.
+        self.start = time.perf_counter()
+        self.utilization = None
+
+    def add_busy(self, seconds):
+        self.busy += seconds
+        now = time.perf_counter()
+        if now - self.start >= self.window:
+            self.utilization = self.busy / (now - self.start)
+            self.busy = 0.
+            self.start = now
+
+
+stats = Stats(enabled=os.environ.get('MIPC_STATS', '1') != '0')
+
+
+def enable(flag=True):
+    stats.enabled = flag
@@ -0,0 +1,194 @@
+import time
+from collections import defaultdict, deque
+
+from .units import parse_size
+
+DEFAULTS = {
+    'engine_rss_max': None,       # bytes, restart engines using more than this
+    'engine_growth_max': None,    # B/s, restart engines growing faster than this
+    'horizon': 300.,              # s, also restart if engine_rss_max would be hit within this time
+    'host_rss_max': None,         # bytes, limit on the sum of the engines rss on a host
+    'host_available_min': None,   # bytes (fraction of the total if < 1) of memory to keep available
+    'host_swap_max': None,        # bytes of swap in use on a host
+    'idle_wait': 60.,             # s, how long to wait for a busy engine to become idle
+    'critical_factor': 1.2,       # beyond limit * factor, restart without waiting
+    'cooldown': 120.,             # s, minimum time between restarts of the same engine
+    'settle': 30.,                # s, time for a restart to show up in the host memory figures
+    'growth_alpha': 0.2,          # ewma weight of the last rss growth sample
+}
+
+SIZE_OPTIONS = ('engine_rss_max', 'engine_growth_max', 'host_rss_max', 'host_available_min',
+                'host_swap_max')
+
+
+class MemoryGuard:
+    '''
+    Restarts engines before the kernel OOM killer does.
+
+    Engines are restarted when their rss, or the rss they are projected to
+    reach within `horizon` seconds, exceeds the per-engine limit, or when
+    their host runs low on memory (sum of rss, available memory, swap in
+    use). On a host under pressure idle engines are picked first, then the
+    largest ones.
+
+    Busy engines are given up to `idle_wait` seconds to finish their tasks,
+    unless the limit is exceeded by more than `critical_factor`.
+    '''
+
+    def __init__(self, **options):
+        opt = dict(DEFAULTS, **options)
+        for k in SIZE_OPTIONS:
+            if opt[k] is not None:
+                opt[k] = parse_size(opt[k])
+        self.options = opt
+        self.growth = {}          # uid -> (time, rss, ewma rate, pid)
+        self.pending = {}         # uid -> (since, reason)
+        self.last_restart = {}    # uid -> time
+        self.totals = defaultdict(int)
+        self.history = deque(maxlen=100)
+
+    def update(self, uid, data, now=None):
+        rss = data.get('rss')
+        if rss is None:
+            # no engine running: its figures are gone with it
+            self.growth.pop(uid, None)
+            return
+        if now is None:
+            now = time.time()
+        pid = data.get('pid')
+        prev = self.growth.get(uid)
+        rate = 0.
+        # a restarted engine starts a new growth estimate
+        if prev is not None and now > prev[0] and prev[3] == pid:
+            sample = (rss - prev[1]) / (now - prev[0])
+            rate = prev[2] + self.options['growth_alpha'] * (sample - prev[2])
+        self.growth[uid] = (now, rss, rate, pid)
+
+    def forget(self, uid):
+        self.growth.pop(uid, None)
+        self.pending.pop(uid, None)
+        self.last_restart.pop(uid, None)
+
+    def _cooling_down(self, uid, now):
+        last = self.last_restart.get(uid)
+        return last is not None and now - last < self.options['cooldown']
+
+    def _engine_candidates(self, workers):
+        opt = self.options
+        rss_max = opt['engine_rss_max']
+        growth_max = opt['engine_growth_max']
+        out = {}
+        # clients culled or gone
+        for uid in [uid for uid in self.growth if uid not in workers]:
+            self.forget(uid)
+        for uid, (_, rss, rate, _) in self.growth.items():
+            if rss_max is not None:
+                if rss > rss_max:
+                    out[uid] = ('engine_rss', rss > rss_max * opt['critical_factor'])
+                    continue
+                if rate > 0 and rss + rate * opt['horizon'] > rss_max:
+                    out[uid] = ('engine_projected', False)
+                    continue
+            if growth_max is not None and rate > growth_max:
+                out[uid] = ('engine_growth', rate > growth_max * opt['critical_factor'])
+        return out
+
+    def _host_excess(self, running):
+        '''
+        Bytes to free on a host, and whether the pressure is critical.
+        '''
+        opt = self.options
+        cf = opt['critical_factor']
+        last = max(running, key=lambda w: w.get('_lastreq', 0))
+        excess, critical = 0., False
+        if opt['host_rss_max'] is not None:
+            x = sum(w.get('rss', 0) for w in running) - opt['host_rss_max']
+            excess = max(excess, x)
+            critical |= x > opt['host_rss_max'] * (cf - 1)
+        if opt['host_available_min'] is not None and 'host_mem_available' in last:
+            target = opt['host_available_min']
+            if target < 1:
+                target *= last['host_mem_total']
+            x = target - last['host_mem_available']
+            excess = max(excess, x)
+            critical |= last['host_mem_available'] < target / cf
+        if opt['host_swap_max'] is not None and 'host_swap_used' in last:
+            x = last['host_swap_used'] - opt['host_swap_max']
+            excess = max(excess, x)
+            critical |= x > opt['host_swap_max'] * (cf - 1)
+        return excess, critical
+
+    def check(self, workers, engine_queue, now=None):
+        '''
+        Returns the list of (uid, reason) of the engines to restart now.
+        `engine_queue(uid)` returns the number of tasks assigned to an
+        engine, or None if unknown.
+        '''
+        if now is None:
+            now = time.time()
+        opt = self.options
+        candidates = self._engine_candidates(workers)
+
+        # memory released by recent restarts may not be reported yet
+        freed = defaultdict(float)
+        for h in self.history:
+            if now - h['time'] < opt['settle']:
+                freed[h['host']] += h['rss'] or 0
+
+        hosts = defaultdict(list)
+        for uid, w in workers.items():
+            if w.get('status') == 'running':
+                hosts[w.get('host')].append((uid, w))
+        for host, entries in hosts.items():
+            excess, critical = self._host_excess([w for _, w in entries])
+            excess -= freed[host]
+            if excess <= 0:
+                continue
+            # engines already being restarted count towards the excess
+            for uid, w in entries:
+                if uid in candidates:
+                    excess -= w.get('rss', 0)
+            # idle engines first, then the largest ones
+            order = sorted(
+                (e for e in entries if e[0] not in candidates),
+                key=lambda e: (engine_queue(e[0]) != 0, -e[1].get('rss', 0))
+            )
+            for uid, w in order:
+                if excess <= 0:
+                    break
+                if self._cooling_down(uid, now):
+                    continue
+                candidates[uid] = ('host_memory', critical)
+                excess -= w.get('rss', 0)
+
+        actions = []
+        for uid, (reason, critical) in candidates.items():
+            if self._cooling_down(uid, now):
+                continue
+            since, _ = self.pending.setdefault(uid, (now, reason))
+            if critical or engine_queue(uid) == 0 or now - since >= opt['idle_wait']:
+                actions.append((uid, reason))
+        for uid in list(self.pending):
+            if uid not in candidates:
+                del self.pending[uid]
+
+        for uid, reason in actions:
+            self.pending.pop(uid, None)
+            self.last_restart[uid] = now
+            self.totals[reason] += 1
+            w = workers[uid]
+            self.history.append({
+                'time': now,
+                'uid': uid,
+                'host': w.get('host'),
+                'rss': w.get('rss'),
+                'reason': reason,
+            })
+        return actions
+
+    def summary(self):
+        return {
+            'restarts': dict(self.totals),
+            'pending': {uid: reason for uid, (_, reason) in self.pending.items()},
+            'recent': list(self.history)[-10:],
+        }
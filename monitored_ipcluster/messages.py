@@ -1,5 +1,8 @@
 
+REQ_LIMIT = 4
+REQ_PROFILE = 3
 REQ_START = 2
 REQ_CONTINUE = 1
 REQ_EXIT = -1
 REQ_RESTART = -2
+REQ_PREEMPT = -3
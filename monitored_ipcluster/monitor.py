@@ -2,9 +2,7 @@ from io import StringIO
 import os, os.path, sys
 import glob
 import time
-import numpy as np
-from ipyparallel import Client
-import ipyparallel
+from math import nan, isfinite
 import subprocess
 from stat import *
 import curses
@@ -20,7 +18,7 @@ status = ''
 
 
 def human_mem(m):
-    if not np.isfinite(m):
+    if not isfinite(m):
         hmem = 'N/A'
     elif m > 1e12:
         hmem = '%4.2f TB' % (float(m)/1024/1024/1024/1024)
@@ -39,7 +37,7 @@ def levelbar(x, tot, blen=20):
     try:
         x = float(x)
         tot = float(tot)
-        if not np.isfinite(x) or not np.isfinite(tot) or tot == 0:
+        if not isfinite(x) or not isfinite(tot) or tot == 0:
             raise ValueError()
     except ValueError:
         x = 0
@@ -52,7 +50,7 @@ def barcolor(x, tot, vals, colors):
     try:
         x = float(x)
         tot = float(tot)
-        if not np.isfinite(x) or not np.isfinite(tot) or tot == 0:
+        if not isfinite(x) or not isfinite(tot) or tot == 0:
             raise ValueError()
     except ValueError:
         x = 0.0
@@ -64,6 +62,11 @@ def barcolor(x, tot, vals, colors):
     return colors[-1]
 
 
+def average(values):
+    # nan for no values, like numpy
+    return sum(values) / len(values) if values else nan
+
+
 class Hist:
     def __init__(self, nmax, *keys):
         self._nmax = nmax
@@ -209,13 +212,13 @@ def app(stdscr):
         bars_values = [0.49, 0.79, 1.0]
         bars_colors = [GREEN, YELLOW, RED]
 
-        n_workers, n_pending, n_working = np.nan, np.nan, np.nan
+        n_workers, n_pending, n_working = nan, nan, nan
         info = {
             'workers': {
-                'avecpu' : np.nan,
-                'avemem' : np.nan,
-                'avenet' : np.nan,
-                'avedisk_io' : np.nan
+                'avecpu' : nan,
+                'avemem' : nan,
+                'avenet' : nan,
+                'avedisk_io' : nan
             }
         }
 
@@ -224,7 +227,7 @@ def app(stdscr):
             while not q0.empty():
                 n_workers, n_pending, n_working = q0.get_nowait()
 
-            if np.isfinite(n_workers):
+            if isfinite(n_workers):
                 responding = True
             else:
                 responding = False
@@ -242,16 +245,16 @@ def app(stdscr):
             else:
                 stdscr.addstr(0, col1 + label_offs, 'OFFLINE', RED )
 
-            sinfo = info.get('scheduler', {'cpu': np.nan, 'mem': np.nan, 'net': np.nan})
+            sinfo = info.get('scheduler', {'cpu': nan, 'mem': nan, 'net': nan})
             cpu, mem, net = sinfo['cpu'], sinfo['mem'], sinfo['net']
 
-            if np.isfinite(mem):
+            if isfinite(mem):
                 shist.append('mem', mem)
-            if np.isfinite(net):
+            if isfinite(net):
                 shist.append('net', net)
 
-            maxsmem = 2*np.average(shist.mem)
-            maxsnet = 2*np.average(shist.net)
+            maxsmem = 2*average(shist.mem)
+            maxsnet = 2*average(shist.net)
 
             # with open('debug.txt', 'a') as f:
             #     f.write('%f %f | '% ( mem, maxsmem ))
@@ -293,16 +296,16 @@ def app(stdscr):
             winfo = info['workers']
             cpu, mem, net, disk_io = winfo['avecpu'], winfo['avemem'], winfo['avenet'], winfo['avedisk_io']
 
-            if np.isfinite(mem):
+            if isfinite(mem):
                 whist.append('mem', mem)
-            if np.isfinite(net):
+            if isfinite(net):
                 whist.append('net', net)
-            if np.isfinite(disk_io):
+            if isfinite(disk_io):
                 whist.append('disk_io', disk_io)
 
-            maxwmem = 2*np.average(whist.mem)
-            maxwnet = 2*np.average(whist.net)
-            maxwdisk_io = 2*np.average(whist.disk_io)
+            maxwmem = 2*average(whist.mem)
+            maxwnet = 2*average(whist.net)
+            maxwdisk_io = 2*average(whist.disk_io)
 
             stdscr.addstr(0, col2, 'Workers: ')
 
@@ -0,0 +1,223 @@
+import os
+import glob
+import json
+import time
+import threading
+import traceback
+import logging
+
+logger = logging.getLogger('PERSIST')
+logger.setLevel(logging.INFO)
+
+SNAPSHOT_FILE = 'snapshot.json'
+WAL_PREFIX = 'wal.'
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _entry_seq(entry):
+    # queued requests saved before acknowledgements have no sequence number
+    return entry['seq'] if isinstance(entry, dict) and 'seq' in entry else 0
+
+
+def _segment_start(path):
+    return int(path.rsplit('.', 1)[1])
+
+
+class StateStore:
+    '''
+    Durable state for the control server.
+
+    Registry state (workers, scheduler, pending requests) is written as a
+    compact snapshot every `interval` seconds, while every change to the
+    request queues (push, drop, ack, clear) is appended to a write-ahead
+    log. On startup the last
+    snapshot is loaded and the log entries written after it are replayed.
+
+    Snapshots are serialized in a forked child (copy-on-write), so the
+    server loop only pays for the fork. Where fork is not available a
+    background thread is used instead.
+
+    The log is split in segments named wal.<seq>, each one holding the
+    entries with sequence number > seq. A new segment is opened every time
+    a snapshot is started, and older segments are removed once the
+    snapshot is safely on disk.
+    '''
+
+    def __init__(self, path, interval=30.0):
+        self.path = path
+        self.interval = interval
+        self._seq = 0
+        self._wal = None
+        self._last_snapshot = time.time()
+        self._pending = None  # (pid or thread, seq) of the running snapshot
+        os.makedirs(path, exist_ok=True)
+
+    def _snapshot_path(self):
+        return os.path.join(self.path, SNAPSHOT_FILE)
+
+    def _segments(self):
+        files = glob.glob(os.path.join(self.path, WAL_PREFIX + '*'))
+        return sorted(files, key=_segment_start)
+
+    def _open_segment(self):
+        if self._wal is not None:
+            self._wal.close()
+        fname = os.path.join(self.path, '{}{:012d}'.format(WAL_PREFIX, self._seq))
+        self._wal = open(fname, 'a')
+
+    def load(self):
+        '''
+        Returns the (workers, scheduler, requests) saved state. The
+        heartbeat time of every restored client is set to now, so that
+        clients are culled only if they do not show up within the usual
+        timeout.
+        '''
+        workers, scheduler, requests = {}, {}, {}
+        snap_seq = 0
+        try:
+            with open(self._snapshot_path()) as f:
+                state = json.load(f)
+            snap_seq = state['seq']
+            workers = state['workers']
+            scheduler = state['scheduler']
+            requests = state['requests']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError):
+            logger.warning('Corrupted snapshot, ignoring it')
+
+        seq = snap_seq
+        n_replayed = 0
+        for fname in self._segments():
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        eseq, op, uid, req = json.loads(line)
+                    except ValueError:
+                        # truncated write from a crash
+                        continue
+                    if eseq <= snap_seq:
+                        continue
+                    if op == 'push':
+                        requests.setdefault(uid, []).append(req)
+                    elif op == 'clear':
+                        requests.pop(uid, None)
+                    elif op == 'ack':
+                        requests[uid] = [e for e in requests.get(uid, []) if _entry_seq(e) > req]
+                    elif op == 'drop':
+                        requests[uid] = [e for e in requests.get(uid, []) if _entry_seq(e) != req]
+                    seq = max(seq, eseq)
+                    n_replayed += 1
+
+        now = time.time()
+        for registry in (workers, scheduler):
+            for data in registry.values():
+                data['_lastreq'] = now
+
+        self._seq = seq
+        self._open_segment()
+        logger.info('Restored {} workers, {} queued requests ({} log entries replayed)'.format(
+            len(workers), sum(len(q) for q in requests.values()), n_replayed))
+        return workers, scheduler, requests
+
+    def log(self, op, uid, req=None):
+        self._seq += 1
+        self._wal.write(_dumps([self._seq, op, uid, req]) + '\n')
+        self._wal.flush()
+
+    def maybe_snapshot(self, workers, scheduler, requests):
+        self._reap()
+        now = time.time()
+        if self._pending is not None or now - self._last_snapshot < self.interval:
+            return
+        self._last_snapshot = now
+        seq = self._seq
+        self._open_segment()
+
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                # child: never return into the server loop
+                code = 1
+                try:
+                    self._write_snapshot(seq, workers, scheduler, requests)
+                    code = 0
+                except:
+                    traceback.print_exc()
+                finally:
+                    os._exit(code)
+            self._pending = (pid, seq)
+        else:
+            state = (
+                seq,
+                {uid: dict(w) for uid, w in workers.items()},
+                {uid: dict(s) for uid, s in scheduler.items()},
+                {uid: list(q) for uid, q in requests.items()},
+            )
+            th = threading.Thread(target=self._thread_snapshot, args=state, daemon=True)
+            th.ok = False
+            th.start()
+            self._pending = (th, seq)
+
+    def _thread_snapshot(self, *state):
+        try:
+            self._write_snapshot(*state)
+            threading.current_thread().ok = True
+        except:
+            traceback.print_exc()
+
+    def _write_snapshot(self, seq, workers, scheduler, requests):
+        state = {
+            'seq': seq,
+            'time': time.time(),
+            'workers': {uid: dict(w) for uid, w in workers.items()},
+            'scheduler': scheduler,
+            'requests': {uid: q for uid, q in requests.items() if q},
+        }
+        fname = self._snapshot_path()
+        with open(fname + '.tmp', 'w') as f:
+            f.write(_dumps(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + '.tmp', fname)
+
+    def _reap(self, block=False):
+        if self._pending is None:
+            return
+        proc, seq = self._pending
+        if isinstance(proc, threading.Thread):
+            if block:
+                proc.join()
+            if proc.is_alive():
+                return
+            ok = proc.ok
+        else:
+            pid, status = os.waitpid(proc, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return
+            ok = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        self._pending = None
+        if not ok:
+            logger.warning('Snapshot failed, keeping the log')
+            return
+        # segments older than the snapshot are not needed anymore
+        for fname in self._segments():
+            if _segment_start(fname) < seq:
+                os.remove(fname)
+
+    def close(self, workers, scheduler, requests):
+        '''
+        Write a final snapshot synchronously.
+        '''
+        self._reap(block=True)
+        self._write_snapshot(self._seq, workers, scheduler, requests)
+        seq = self._seq
+        self._open_segment()
+        for fname in self._segments():
+            if _segment_start(fname) < seq:
+                os.remove(fname)
+        self._wal.close()
+        self._wal = None
@@ -0,0 +1,213 @@
+import os
+import glob
+import fcntl
+import itertools
+import shutil
+import tempfile
+import logging
+
+logger = logging.getLogger('PLACEMENT')
+logger.setLevel(logging.INFO)
+
+SYS_CPU = '/sys/devices/system/cpu'
+SYS_NODE = '/sys/devices/system/node'
+
+POLICIES = ('compact', 'spread', 'per-socket')
+
+
+def parse_cpulist(s):
+    '''
+    '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    '''
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            a, b = part.split('-')
+            cpus.extend(range(int(a), int(b) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    cpus = sorted(cpus)
+    parts = []
+    i = 0
+    while i < len(cpus):
+        j = i
+        while j + 1 < len(cpus) and cpus[j + 1] == cpus[j] + 1:
+            j += 1
+        parts.append(str(cpus[i]) if i == j else '{}-{}'.format(cpus[i], cpus[j]))
+        i = j + 1
+    return ','.join(parts)
+
+
+def _read(fname, default=None):
+    try:
+        with open(fname) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return default
+
+
+_cpu_nodes = None
+
+
+def cpu_nodes():
+    '''
+    {cpu: NUMA node}, read once.
+    '''
+    global _cpu_nodes
+    if _cpu_nodes is None:
+        _cpu_nodes = {}
+        for ndir in glob.glob(os.path.join(SYS_NODE, 'node[0-9]*')):
+            node = int(os.path.basename(ndir)[4:])
+            for cpu in parse_cpulist(_read(os.path.join(ndir, 'cpulist'), '')):
+                _cpu_nodes[cpu] = node
+    return _cpu_nodes
+
+
+def read_topology():
+    '''
+    Returns {node: [cpus]}, with the cpus of each NUMA node ordered so that
+    physical cores come before their hyperthread siblings.
+    '''
+    online = parse_cpulist(_read(os.path.join(SYS_CPU, 'online'), '') or '')
+    if not online:
+        online = sorted(os.sched_getaffinity(0))
+
+    node_of = cpu_nodes()
+
+    rank = {}
+    seen = {}
+    for cpu in online:
+        topo = os.path.join(SYS_CPU, 'cpu{}'.format(cpu), 'topology')
+        core = (_read(os.path.join(topo, 'physical_package_id'), '0'),
+                _read(os.path.join(topo, 'core_id'), str(cpu)))
+        rank[cpu] = seen.get(core, 0)
+        seen[core] = rank[cpu] + 1
+
+    nodes = {}
+    for cpu in online:
+        nodes.setdefault(node_of.get(cpu, 0), []).append(cpu)
+    for node in nodes:
+        nodes[node].sort(key=lambda c: (rank[c], c))
+    return nodes
+
+
+def compute_placement(nodes, slot, policy='compact', cores=1):
+    '''
+    Cpus and NUMA node (None if spanning several) for the engine in `slot`,
+    (None, None) if the slot does not fit on the host.
+
+        compact     fill one node after the other
+        spread      round robin over the nodes with cores left
+        per-socket  bind to all the cpus of a node, round robin
+    '''
+    node_ids = sorted(nodes)
+    if policy == 'per-socket':
+        node = node_ids[slot % len(node_ids)]
+        return sorted(nodes[node]), node
+
+    if policy == 'spread':
+        # (node, chunk) in round robin order, skipping the full nodes
+        depth = max(len(c) for c in nodes.values()) // cores
+        order = [(n, k) for k in range(depth) for n in node_ids if (k + 1) * cores <= len(nodes[n])]
+        if slot >= len(order):
+            return None, None
+        node, k = order[slot]
+        return sorted(nodes[node][k * cores:(k + 1) * cores]), node
+
+    if policy == 'compact':
+        ordered = [(n, c) for n in node_ids for c in nodes[n]]
+        chunk = ordered[slot * cores:(slot + 1) * cores]
+        if len(chunk) < cores:
+            return None, None
+        used = {n for n, _ in chunk}
+        return sorted(c for _, c in chunk), used.pop() if len(used) == 1 else None
+
+    raise ValueError('Unknown placement policy: {}'.format(policy))
+
+
+def n_slots(nodes, policy='compact', cores=1):
+    '''
+    Number of engines the host can hold, None for no limit.
+    '''
+    if policy == 'per-socket':
+        # engines share the cpus of their node
+        return None
+    if policy == 'spread':
+        return sum(len(c) // cores for c in nodes.values())
+    return sum(len(c) for c in nodes.values()) // cores
+
+
+def acquire_slot(name, max_slots, directory=None):
+    '''
+    Locks the first free slot among `max_slots` (None for no limit) for the
+    lifetime of this process (and its children), so that clients on the
+    same host get distinct slots. Returns (slot, fd), or (None, None) if
+    all are taken.
+    '''
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'mipc-{}'.format(os.getuid()))
+    os.makedirs(directory, exist_ok=True)
+    for slot in (range(max_slots) if max_slots is not None else itertools.count()):
+        fd = os.open(os.path.join(directory, '{}-{}.lock'.format(name, slot)), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, fd
+        except BlockingIOError:
+            os.close(fd)
+    return None, None
+
+
+def setup_placement(policy='compact', cores=1):
+    '''
+    Picks a slot on this host and returns the placement as a dict with
+    `cpus`, `node`, `slot` and the slot lock `fd`, or None.
+    '''
+    if policy not in POLICIES:
+        raise ValueError('Unknown placement policy: {}'.format(policy))
+    nodes = read_topology()
+    slot, fd = acquire_slot('engine', n_slots(nodes, policy, cores))
+    if slot is None:
+        logger.warning('No free placement slot on this host, the engine will not be pinned')
+        return None
+    cpus, node = compute_placement(nodes, slot, policy, cores)
+    if cpus is None:
+        logger.warning('Slot {} does not fit the cpus of this host, the engine will not be pinned'.format(slot))
+        os.close(fd)
+        return None
+    logger.info('Engine slot {}: cpus {}, NUMA node {}'.format(slot, format_cpulist(cpus), node))
+    return {'cpus': cpus, 'node': node, 'slot': slot, 'fd': fd}
+
+
+def wrap_command(cmd, placement):
+    '''
+    Binds the memory of the engine to its NUMA node, if numactl is
+    available. Without it, memory is still allocated locally by the
+    kernel first-touch policy, since the cpus are pinned.
+    '''
+    if placement is None or placement['node'] is None or shutil.which('numactl') is None:
+        return cmd
+    return 'numactl --preferred={} {}'.format(placement['node'], cmd)
+
+
+def pin_current_process(placement):
+    # used as preexec_fn: the affinity is inherited by the engine and its children
+    if placement is not None:
+        os.sched_setaffinity(0, placement['cpus'])
+
+
+def get_affinity(pid):
+    try:
+        cpus = os.sched_getaffinity(pid)
+    except (OSError, ProcessLookupError):
+        return None
+    node_of = cpu_nodes()
+    return {
+        'affinity': format_cpulist(cpus),
+        'numa_nodes': sorted({node_of.get(c, 0) for c in cpus}),
+    }
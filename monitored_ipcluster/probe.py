@@ -0,0 +1,201 @@
+import time
+import traceback
+from collections import deque
+
+import zmq
+
+DEFAULTS = {
+    'interval': 1.,        # s between probes
+    'timeout': 5.,         # s, a probe not answered by then counts as this long
+    'window': 60.,         # s of probes the percentiles are computed on
+    'slo_ms': None,        # restart the scheduler when the percentile exceeds this
+    'percentile': 90,
+    'sustain': 30.,        # s the SLO must be breached before restarting
+    'cooldown': 300.,      # s after a restart before checking again
+    'reconnect_after': 5,  # consecutive timeouts before reconnecting to the controller
+}
+
+
+def percentile_key(p):
+    return 'p{}'.format(p)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+
+class HubProbe:
+    '''
+    Measures the round trip time of the controller with a queue status
+    request on the hub query (registration) endpoint.
+
+    The probe has its own DEALER socket and session: the query socket of
+    the Client belongs to its IO thread, which takes the replies. The
+    Client is only used to read the connection file. The request is sent
+    and polled with a timeout by hand, replies arriving after the timeout
+    are recognized by their parent msg_id and discarded.
+    '''
+
+    def __init__(self, rcl):
+        self.rcl = rcl
+        cfg = rcl._config
+        self.session = type(rcl.session)(
+            key=cfg['key'].encode('utf8'), signature_scheme=cfg['signature_scheme'],
+            packer=cfg['pack'], unpacker=cfg['unpack'])
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(cfg['registration'])
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
+        self.rcl.close()
+
+    def ping(self, timeout):
+        '''
+        Returns the round trip time in seconds, None on timeout.
+        '''
+        t0 = time.perf_counter()
+        msg = self.session.send(self.socket, 'queue_request', content={'targets': None, 'verbose': False})
+        deadline = t0 + timeout
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0 or not self.socket.poll(left * 1000):
+                return None
+            _, reply = self.session.recv(self.socket, mode=zmq.NOBLOCK)
+            if reply is not None and reply['parent_header'].get('msg_id') == msg['header']['msg_id']:
+                return time.perf_counter() - t0
+
+
+def probe_loop(out, client_args=None, **options):
+    '''
+    Probes the controller every `interval` seconds, and keeps the figures
+    of the last `window` seconds in out['probe'].
+    '''
+    from ipyparallel import Client
+    opt = dict(DEFAULTS, **options)
+    client_args = dict(client_args or {})
+    client_args.setdefault('timeout', 10)
+
+    probe = None
+    samples = deque()  # (time, rtt or None)
+    last_ok = None
+    n_timeouts = 0
+    while True:
+        start = time.time()
+        try:
+            if probe is None:
+                probe = HubProbe(Client(**client_args))
+            rtt = probe.ping(opt['timeout'])
+            error = None
+        except KeyboardInterrupt:
+            return
+        except:
+            rtt = None
+            error = traceback.format_exc(limit=1)
+            if probe is not None:
+                probe.close()
+            probe = None
+
+        # the controller may be back on other ports: read the connection file again
+        n_timeouts = n_timeouts + 1 if rtt is None and error is None else 0
+        if n_timeouts >= opt['reconnect_after'] and probe is not None:
+            probe.close()
+            probe = None
+            n_timeouts = 0
+
+        now = time.time()
+        samples.append((now, rtt))
+        while now - samples[0][0] > opt['window']:
+            samples.popleft()
+        if rtt is not None:
+            last_ok = now
+        # unanswered probes count as the timeout
+        rtts = [(x if x is not None else opt['timeout']) * 1e3 for _, x in samples]
+        out['probe'] = {
+            'status': 'ok' if rtt is not None else ('error' if error else 'timeout'),
+            'reason': error,
+            'last_ms': rtt * 1e3 if rtt is not None else None,
+            'last_ok': last_ok,
+            'time': now,
+            'samples': len(rtts),
+            'timeouts': sum(1 for _, x in samples if x is None),
+            'rtt_ms': {
+                'p50': _percentile(rtts, 50),
+                'p90': _percentile(rtts, 90),
+                'p99': _percentile(rtts, 99),
+                'max': max(rtts),
+            },
+        }
+        # the percentile of the SLO
+        out['probe']['rtt_ms'][percentile_key(opt['percentile'])] = _percentile(rtts, opt['percentile'])
+        time.sleep(max(0., opt['interval'] - (time.time() - start)))
+
+
+class SchedulerSLO:
+    '''
+    Decides when the scheduler must be restarted: the probe latency
+    percentile stays above `slo_ms` (or the probe stops reporting) for
+    `sustain` seconds. After a restart, waits `cooldown` seconds for the
+    controller to come back.
+    '''
+
+    def __init__(self, **options):
+        self.options = dict(DEFAULTS, **options)
+        if not 0 < self.options['percentile'] <= 100:
+            raise ValueError('SLO percentile must be in (0, 100]: {}'.format(self.options['percentile']))
+        self.breach_since = None
+        self.last_restart = None
+        self.n_restarts = 0
+
+    def breached(self, probe, now):
+        opt = self.options
+        if probe is None:
+            return False
+        if now - probe['time'] > opt['sustain']:
+            # the probe itself is stuck
+            return True
+        return self.latency(probe) > opt['slo_ms']
+
+    def latency(self, probe):
+        '''
+        The SLO percentile of the probe round trip times, in ms.
+        '''
+        rtt = probe['rtt_ms']
+        key = percentile_key(self.options['percentile'])
+        # reported by the probe with the same options, p99 at worst
+        return rtt.get(key, rtt['p99'])
+
+    def check(self, probe, now=None):
+        '''
+        Returns True if the scheduler must be restarted now.
+        '''
+        opt = self.options
+        now = time.time() if now is None else now
+        if opt['slo_ms'] is None:
+            return False
+        if self.last_restart is not None and now - self.last_restart < opt['cooldown']:
+            return False
+        if not self.breached(probe, now):
+            self.breach_since = None
+            return False
+        if self.breach_since is None:
+            self.breach_since = now
+        if now - self.breach_since < opt['sustain']:
+            return False
+        self.breach_since = None
+        self.last_restart = now
+        self.n_restarts += 1
+        return True
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        return {
+            'slo_ms': self.options['slo_ms'],
+            'percentile': self.options['percentile'],
+            'breached_for': now - self.breach_since if self.breach_since is not None else None,
+            'n_restarts': self.n_restarts,
+            'last_restart': self.last_restart,
+        }
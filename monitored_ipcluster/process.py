@@ -90,10 +90,28 @@ def get_disk_io_usage(p):
     return int(rs + ws)
 
 
+def get_host_memory():
+    vm = psutil.virtual_memory()
+    sw = psutil.swap_memory()
+    return {
+        'host_mem_total': vm.total,
+        'host_mem_available': vm.available,
+        'host_swap_used': sw.used,
+    }
+
+
 def init_worker():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
+def get_pstree_pids(pid):
+    try:
+        p = psutil.Process(pid)
+        return [pid] + [sp.pid for sp in p.children(True)]
+    except psutil.NoSuchProcess:
+        return []
+
+
 def get_pstree_data(pid):
     try:
         p = psutil.Process(pid)
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from subprocess import run, TimeoutExpired, DEVNULL, PIPE
+
+import psutil
+
+# bytes of folded stacks per message sent to the server
+CHUNK_SIZE = 256 * 1024
+
+STATES = {
+    'R': 'running',
+    'S': 'sleeping',
+    'D': 'disk-wait',
+    'T': 'stopped',
+    't': 'traced',
+    'Z': 'zombie',
+}
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _thread_frames(pid, tid):
+    '''
+    Frames of a thread from /proc, outermost first: the thread name, its
+    scheduler state and, for waiting threads, the kernel stack when
+    readable (root only) or else the kernel function they wait in.
+    '''
+    stat = _read('/proc/{}/task/{}/stat'.format(pid, tid))
+    if stat is None:
+        return None
+    lp, rp = stat.index('('), stat.rindex(')')
+    comm = stat[lp + 1:rp]
+    state = STATES.get(stat[rp + 2], stat[rp + 2])
+    frames = ['thread {} ({})'.format(comm, tid), state]
+    if state == 'running':
+        # in user space, the kernel stack is only the sampling interrupt
+        return frames
+    stack = _read('/proc/{}/task/{}/stack'.format(pid, tid))
+    if stack:
+        # lines like "[<0>] do_select+0x5e8/0x7d0", innermost first
+        kframes = [l.split()[-1].split('+')[0] for l in stack.splitlines() if l.strip()]
+        frames += ['[k] ' + f for f in reversed(kframes)]
+    else:
+        wchan = _read('/proc/{}/task/{}/wchan'.format(pid, tid))
+        if wchan and wchan != '0':
+            frames.append('[k] ' + wchan)
+    return frames
+
+
+def sample_proc(pid, seconds, rate=100):
+    '''
+    Samples the threads of a process tree from /proc. Resolves where
+    threads are blocked (i/o, locks, network) rather than the Python
+    stacks, but needs no privilege nor external tool.
+    '''
+    counts = Counter()
+    period = 1. / rate
+    end = time.time() + seconds
+    root = psutil.Process(pid)
+    while time.time() < end:
+        t0 = time.time()
+        try:
+            procs = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            break
+        for p in procs:
+            try:
+                pframe = 'process {} ({})'.format(p.name(), p.pid)
+                tids = os.listdir('/proc/{}/task'.format(p.pid))
+            except (psutil.NoSuchProcess, psutil.AccessDenied, OSError):
+                continue
+            for tid in tids:
+                frames = _thread_frames(p.pid, tid)
+                if frames:
+                    counts[';'.join([pframe] + frames)] += 1
+        time.sleep(max(0, period - (time.time() - t0)))
+    return ''.join('{} {}\n'.format(k, v) for k, v in counts.most_common())
+
+
+def sample_pyspy(pid, seconds, rate=100):
+    '''
+    Python stacks of the process tree, from py-spy. The engine is not
+    stopped while sampling.
+    '''
+    fd, output = tempfile.mkstemp(prefix='mipc-profile-', suffix='.folded')
+    os.close(fd)
+    try:
+        cmd = ['py-spy', 'record', '--pid', str(pid), '--duration', str(int(max(1, seconds))),
+               '--rate', str(rate), '--format', 'raw', '--output', output,
+               '--subprocesses', '--nonblocking']
+        p = run(cmd, stdout=DEVNULL, stderr=PIPE, timeout=seconds + 30)
+        if p.returncode != 0:
+            raise RuntimeError(p.stderr.decode(errors='replace').strip())
+        with open(output) as f:
+            return f.read()
+    finally:
+        os.remove(output)
+
+
+def profile(pid, seconds, rate=100):
+    '''
+    Returns the sampler used and the folded stacks ("frame;frame;... count"
+    lines, the input of flamegraph.pl or inferno) of the process tree
+    rooted at `pid`. Uses py-spy when available and permitted, /proc
+    sampling otherwise.
+    '''
+    if shutil.which('py-spy'):
+        try:
+            return 'py-spy', sample_pyspy(pid, seconds, rate)
+        except (RuntimeError, TimeoutExpired, OSError):
+            # usually ptrace not permitted, fall back
+            pass
+    return 'proc', sample_proc(pid, seconds, rate)
+
+
+def chunks(text, size=CHUNK_SIZE):
+    '''
+    Splits folded stacks in chunks of about `size` characters, at line
+    boundaries.
+    '''
+    out = []
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start + size)
+        end = len(text) if end < 0 else end + 1
+        out.append(text[start:end])
+        start = end
+    return out or ['']
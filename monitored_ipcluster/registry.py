@@ -0,0 +1,204 @@
+'''
+Registry of the clients known to the server, with a compact record per
+client.
+
+A heartbeat is decoded as a fresh dict, with its own copies of the key
+strings, the uid, the host and the type. Storing it as is costs a few KB
+per engine, and replacing it on every heartbeat churns the allocator. A
+record keeps the usual heartbeat fields in slots, updated in place, the
+host and type strings shared with the other records of the same host and
+type, and the uid string of the first heartbeat. Fields that are not
+slotted (app metrics, placement, timings, ...) go to a small dict.
+
+Records and the registry are mappings, so that the code reading
+heartbeats (w.get('rss'), uid in workers, dict(w), ...) works unchanged.
+'''
+from operator import attrgetter, itemgetter
+from collections.abc import Mapping
+
+# fields of every heartbeat of a running engine, the others are kept in
+# WorkerRecord.extra
+FIELDS = (
+    'pid', 'status', 'pcpu', 'rss', 'net', 'disk_io',
+    'n_crashes', 'n_preempted', 'n_warm_starts', 'ack',
+    'host_mem_total', 'host_mem_available', 'host_swap_used', '_lastreq',
+)
+_get_fields = itemgetter(*FIELDS)
+_KEYS = frozenset(('uid', 'host', 'type') + FIELDS)
+
+
+class _Missing:
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+
+
+class WorkerRecord(Mapping):
+
+    __slots__ = ('uid', 'host', 'type', 'extra') + FIELDS
+
+    def __init__(self, uid, host, ptype):
+        self.uid = uid
+        self.host = host
+        self.type = ptype
+        self.extra = None
+        for k in FIELDS:
+            setattr(self, k, _MISSING)
+
+    def update(self, data):
+        '''
+        Replaces the fields with those of a heartbeat, except uid, host and
+        type that are set by the registry. The slots are written in one
+        go when the heartbeat has all of them, the usual case, and the
+        extra dict is updated in place.
+        '''
+        try:
+            values = _get_fields(data)
+            n_fields = len(FIELDS)
+        except KeyError:
+            values = [data.get(k, _MISSING) for k in FIELDS]
+            n_fields = len(FIELDS) - values.count(_MISSING)
+        # in the order of FIELDS
+        (self.pid, self.status, self.pcpu, self.rss, self.net, self.disk_io,
+         self.n_crashes, self.n_preempted, self.n_warm_starts, self.ack,
+         self.host_mem_total, self.host_mem_available, self.host_swap_used, self._lastreq) = values
+
+        n_extra = len(data) - n_fields - ('uid' in data) - ('host' in data) - ('type' in data)
+        extra = self.extra
+        if not n_extra:
+            self.extra = None
+            return
+        if extra is None:
+            extra = self.extra = {}
+        for k, v in data.items():
+            if k not in _KEYS:
+                extra[k] = v
+        # fields of the previous heartbeat missing from this one
+        if len(extra) != n_extra:
+            for k in [k for k in extra if k not in data]:
+                del extra[k]
+
+    def get(self, key, default=None):
+        if key in _KEYS:
+            v = getattr(self, key)
+            return default if v is _MISSING else v
+        if self.extra is not None:
+            return self.extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        v = self.get(key, _MISSING)
+        if v is _MISSING:
+            raise KeyError(key)
+        return v
+
+    def __setitem__(self, key, value):
+        if key in _KEYS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        for k in ('uid', 'host', 'type') + FIELDS:
+            if getattr(self, k) is not _MISSING:
+                yield k
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        n = sum(1 for k in FIELDS if getattr(self, k) is not _MISSING) + 3
+        return n + (len(self.extra) if self.extra is not None else 0)
+
+    def __repr__(self):
+        return 'WorkerRecord({!r})'.format(dict(self))
+
+
+class WorkerRegistry(Mapping):
+    '''
+    uid -> WorkerRecord, with the host and type strings interned.
+    '''
+
+    def __init__(self):
+        self._records = {}
+        self._strings = {}
+
+    def _intern(self, s):
+        return self._strings.setdefault(s, s)
+
+    def heartbeat(self, uid, data):
+        '''
+        Records a heartbeat, returns True for a new client.
+        '''
+        rec = self._records.get(uid)
+        host = data.get('host', '')
+        ptype = data.get('type', '')
+        new = rec is None
+        if new:
+            rec = self._records[uid] = WorkerRecord(uid, self._intern(host), self._intern(ptype))
+        else:
+            if host != rec.host:
+                rec.host = self._intern(host)
+            if ptype != rec.type:
+                rec.type = self._intern(ptype)
+        rec.update(data)
+        return new
+
+    def column(self, field):
+        '''
+        Values of a field over the records having it.
+        '''
+        if field in _KEYS:
+            return [v for v in map(attrgetter(field), self._records.values()) if v is not _MISSING]
+        return [rec.extra[field] for rec in self._records.values()
+                if rec.extra is not None and field in rec.extra]
+
+    def total(self, field):
+        return sum(self.column(field))
+
+    def stale(self, before):
+        '''
+        Uids of the clients not heard of since `before`.
+        '''
+        # a record without a heartbeat time is stale
+        return [uid for uid, rec in self._records.items()
+                if rec._lastreq is _MISSING or rec._lastreq < before]
+
+    def pop(self, uid, default=None):
+        return self._records.pop(uid, default)
+
+    def clear(self):
+        self._records.clear()
+        self._strings.clear()
+
+    def get(self, uid, default=None):
+        return self._records.get(uid, default)
+
+    def __getitem__(self, uid):
+        return self._records[uid]
+
+    def __contains__(self, uid):
+        return uid in self._records
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def keys(self):
+        return self._records.keys()
+
+    def values(self):
+        return self._records.values()
+
+    def items(self):
+        return self._records.items()
@@ -0,0 +1,167 @@
+import re
+import operator
+from fnmatch import fnmatchcase
+from collections import defaultdict
+
+from .units import parse_size
+
+OPERATORS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+}
+
+# fields resolved through the indexes rather than the heartbeat data
+INDEXED = ('uid', 'host', 'type')
+
+_term_re = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_.]*)\s*(>=|<=|!=|>|<|=)\s*(.+?)\s*$')
+
+
+def parse_selector(text):
+    '''
+    Parses a selector into a list of (field, op, value) terms, all of
+    which must hold. Terms are separated by commas:
+
+        3f2c9e4a-...            an engine uid
+        node01*                 a host name or glob (also the short name)
+        host=node0[1-4]*        same, explicit
+        type=worker             client type
+        rss>8GB,pcpu<5          predicates on the last heartbeat, with
+                                sizes like 512MB
+        app.tasks_done<10       application metrics of the engine
+    '''
+    terms = []
+    for tok in text.split(','):
+        if not tok.strip():
+            continue
+        m = _term_re.match(tok)
+        if m is None:
+            # bare token: a uid or a host glob
+            terms.append(('target', '=', tok.strip()))
+            continue
+        field, op, value = m.groups()
+        if field in INDEXED:
+            if op not in ('=', '!='):
+                raise ValueError('Invalid operator for {}: {}'.format(field, op))
+        else:
+            try:
+                value = parse_size(value)
+            except ValueError:
+                if op not in ('=', '!='):
+                    raise
+        terms.append((field, op, value))
+    if not terms:
+        raise ValueError('Empty selector')
+    return terms
+
+
+def _field(data, field):
+    for key in field.split('.'):
+        # heartbeat dicts, registry records
+        get = getattr(data, 'get', None)
+        if get is None:
+            return None
+        data = get(key)
+    return data
+
+
+def _host_match(host, pattern):
+    return fnmatchcase(host, pattern) or fnmatchcase(host.split('.')[0], pattern)
+
+
+class WorkerIndex:
+    '''
+    Host and type indexes of the registered clients, kept up to date by
+    the server on registration and culling.
+    '''
+
+    def __init__(self):
+        self.by_host = defaultdict(set)
+        self.by_type = defaultdict(set)
+        self.keys = {}  # uid -> (host, type)
+
+    def add(self, uid, data):
+        key = (data.get('host', ''), data.get('type', ''))
+        old = self.keys.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            self.remove(uid)
+        self.keys[uid] = key
+        self.by_host[key[0]].add(uid)
+        self.by_type[key[1]].add(uid)
+
+    def remove(self, uid):
+        key = self.keys.pop(uid, None)
+        if key is None:
+            return
+        for idx, k in zip((self.by_host, self.by_type), key):
+            idx[k].discard(uid)
+            if not idx[k]:
+                del idx[k]
+
+    def clear(self):
+        self.by_host.clear()
+        self.by_type.clear()
+        self.keys.clear()
+
+    def hosts(self, pattern):
+        if not any(c in pattern for c in '*?['):
+            # exact or short name
+            uids = set(self.by_host.get(pattern, ()))
+            for host, u in self.by_host.items():
+                if host.split('.')[0] == pattern:
+                    uids |= u
+            return uids
+        uids = set()
+        for host, u in self.by_host.items():
+            if _host_match(host, pattern):
+                uids |= u
+        return uids
+
+    def _candidates(self, field, value):
+        if field == 'uid':
+            return {value} if value in self.keys else set()
+        if field == 'host':
+            return self.hosts(value)
+        if field == 'type':
+            return self.by_type.get(value, set())
+        # bare token
+        if value in self.keys:
+            return {value}
+        return self.hosts(value)
+
+    def select(self, terms, lookup):
+        '''
+        Uids matching all the terms. `lookup(uid)` returns the last
+        heartbeat of a client, for the metric predicates.
+        '''
+        positive = [t for t in terms if t[0] in INDEXED + ('target',) and t[1] == '=']
+        others = [t for t in terms if t not in positive]
+        if positive:
+            # start from the smallest index lookup
+            sets = sorted((self._candidates(f, v) for f, _, v in positive), key=len)
+            uids = sets[0].intersection(*sets[1:])
+        else:
+            uids = set(self.keys)
+        for field, op, value in others:
+            if field in INDEXED:
+                excluded = self._candidates(field, value)
+                uids = {u for u in uids if u not in excluded}
+                continue
+            f = OPERATORS[op]
+            keep = set()
+            for u in uids:
+                x = _field(lookup(u), field)
+                if x is None:
+                    continue
+                try:
+                    if f(x, value):
+                        keep.add(u)
+                except TypeError:
+                    pass
+            uids = keep
+        return sorted(uids)
@@ -4,12 +4,14 @@
 #   Expects b"Hello" from client, replies with b"World"
 #
 
+import os
 import time
+import uuid
+import json
 import zmq
 from multiprocessing import Process, Manager
 import traceback
 from collections import defaultdict
-from functools import partial
 import logging
 logging.basicConfig()
 
@@ -17,31 +19,119 @@ logger = logging.getLogger('SERVER')
 logger.setLevel(logging.INFO)
 
 from .messages import *
-
-workers = {}
+from .persistence import StateStore
+from .analysis import Analyzer
+from .memguard import MemoryGuard
+from .autoscale import Autoscaler
+from .instrument import stats, enable as enable_stats, LoopMeter
+from .selection import parse_selector, WorkerIndex
+from .cmdqueue import CommandQueue
+from .registry import WorkerRegistry
+from .taskstats import HistoryCursor, TaskStats
+from .drain import DrainRegistry
+from .probe import probe_loop, SchedulerSLO
+from .units import parse_size
+
+workers = WorkerRegistry()
 scheduler = {}
-request_queue = defaultdict(list)
+request_queue = CommandQueue()
+worker_index = WorkerIndex()
+drains = DrainRegistry()
+state_store = None
+metrics_archive = None
+# archive queries run off the server loop, see req_history
+history_executor = None
+deferred = []  # (future, socket, route) of the replies not sent yet
+analyzer = None
+memguard = None
+autoscaler = None
+scheduler_slo = None
+loop_meter = LoopMeter()
+pub_socket = None
+
+ADDRESSES = {
+    'clients': 'tcp://*:5558',
+    'control': 'tcp://*:5559',
+    'control_ipc': 'ipc://ipyserver.socket',
+    'events': 'tcp://*:5560',
+}
+
+# local copy of the ipyparallel status, refreshed by the server loop
+ipyparallel_data = {}
+ipp_status = {}
+# False when ipyparallel is not monitored at all, see check_drains
+ipp_monitored = False
+engine_ids = {}  # (host, pid) -> ipyparallel engine id
+
+# remote profiling jobs, by job id
+profiles = {}
+PROFILE_TTL = 3600
+PROFILE_MAX_SECONDS = 600
 
 
 def do_nothing(*args, **kwargs):
     pass
 
 
-def clear_queue(uid):
-    if uid in request_queue:
-        del request_queue[uid]
+def push_request(uid, req):
+    request_queue.push(uid, req)
+
+
+def publish(topic, data):
+    if pub_socket is not None:
+        pub_socket.send_string(topic, zmq.SNDMORE)
+        pub_socket.send_json(data)
+
+
+def refresh_ipyparallel_status():
+    global ipp_status
+    global engine_ids
+    ipp_status = dict(ipyparallel_data)
+    engine_ids = {}
+    for eid, (host, pids) in ipp_status.get('engines', {}).items():
+        for pid in pids:
+            engine_ids[(host, pid)] = eid
+
+
+def engine_queue(uid):
+    '''
+    Number of tasks assigned to the ipyparallel engine supervised by the
+    client `uid`, or None if the engine is unknown.
+    '''
+    w = workers.get(uid)
+    if w is None:
+        return None
+    eid = engine_ids.get((w.get('host'), w.get('pid')))
+    if eid is None:
+        return None
+    return ipp_status.get('queue', {}).get(eid)
 
 
 def handle_worker(data):
     uid = data['uid']
-    if uid not in workers:
+    data['_lastreq'] = time.time()
+    if workers.heartbeat(uid, data):
         logger.info('New client connection: {}'.format(uid))
-        request_queue[uid] = []
-    workers[uid] = data
-    workers[uid]['_lastreq'] = time.time()
+    # the interned host and type
+    worker_index.add(uid, workers[uid])
+    if metrics_archive is not None:
+        metrics_archive.append(data, data['_lastreq'])
+    if analyzer is not None:
+        raised, cleared = analyzer.update(uid, data, engine_queue(uid))
+        if raised or cleared:
+            publish('flags', {
+                'uid': uid,
+                'host': data.get('host'),
+                'raised': raised,
+                'cleared': cleared,
+            })
+    if memguard is not None:
+        memguard.update(uid, data, data['_lastreq'])
+    if 'ack' in data:
+        request_queue.ack(uid, data['ack'])
     return {
-        'data': request_queue[uid],
-        'on_success': partial(clear_queue, uid)
+        'data': request_queue.pending(uid),
+        'on_success': do_nothing
     }
 
 
@@ -49,13 +139,47 @@ def handle_scheduler(data):
     global scheduler
     uid = data['uid']
     # replace the scheduler
+    for old in scheduler:
+        if old != uid:
+            worker_index.remove(old)
+    worker_index.add(uid, data)
     scheduler = {
         uid: data
     }
     scheduler[uid]['_lastreq'] = time.time()
+    if 'ack' in data:
+        request_queue.ack(uid, data['ack'])
     return {
-        'data': request_queue[uid],
-        'on_success': partial(clear_queue, uid)
+        'data': request_queue.pending(uid),
+        'on_success': do_nothing
+    }
+
+
+def handle_profile(data):
+    # a chunk of the folded stacks of a profiling job, or its failure
+    job = profiles.get(data['job'])
+    if job is None:
+        return {
+            'data': {'status': 'failed', 'reason': 'Unknown job'},
+            'on_success': do_nothing
+        }
+    uid = data['uid']
+    target = job['targets'].setdefault(uid, {'status': 'running', 'chunks': {}})
+    if 'error' in data:
+        target['status'] = 'failed'
+        target['error'] = data['error']
+    else:
+        target['chunks'][data['seq']] = data['data']
+        target['n_chunks'] = data['n_chunks']
+        target['sampler'] = data['sampler']
+        if len(target['chunks']) == target['n_chunks']:
+            target['status'] = 'done'
+    if target['status'] != 'running':
+        logger.info('Profile {} of {}: {}'.format(data['job'], uid, target['status']))
+        publish('profile', {'job': data['job'], 'uid': uid, 'status': target['status']})
+    return {
+        'data': {'status': 'ok'},
+        'on_success': do_nothing
     }
 
 
@@ -73,12 +197,36 @@ def handle_command(data):
     logger.info('Command received: {}'.format(data['cmd']))
 
     cmd = data.get('cmd', '')
+    try:
+        selected = select(data['select']) if data.get('select') else None
+    except ValueError as e:
+        return {
+            'data': {'status': 'failed', 'reason': str(e)},
+            'on_success': do_nothing
+        }
+
     if cmd == 'restart':
-        return req_restart()
+        return req_restart(selected)
     elif cmd == 'exit':
-        return req_exit()
+        return req_exit(selected)
+    elif cmd == 'reset':
+        return req_reset(selected)
     elif cmd == 'info':
-        return req_info()
+        return req_info(selected)
+    elif cmd == 'drain':
+        return req_drain(data, selected)
+    elif cmd == 'undrain':
+        return req_undrain(selected)
+    elif cmd == 'limit':
+        return req_limit(data, selected)
+    elif cmd == 'history':
+        return req_history(data)
+    elif cmd == 'stats':
+        return req_stats()
+    elif cmd == 'profile':
+        return req_profile(data)
+    elif cmd == 'profile_status':
+        return req_profile_status(data)
     else:
         return handle_other(data)
 
@@ -89,6 +237,7 @@ def handle_message(data):
         'worker': handle_worker,
         'scheduler': handle_scheduler,
         'command': handle_command,
+        'profile': handle_profile,
         'default': handle_other,
     }
 
@@ -97,22 +246,31 @@ def handle_message(data):
     except KeyError:
         f = handles['default']
 
-    return f(data)
+    if not stats.enabled:
+        return f(data)
+
+    t0 = time.perf_counter()
+    response = f(data)
+    key = data.get('type', 'default')
+    if key == 'command':
+        key += '.' + str(data.get('cmd'))
+    stats.observe('handle.' + key, time.perf_counter() - t0)
+    return response
 
 
 def cull_inactive(timeout=20):
-    to_cull = []
-    for uid, data in workers.items():
-        now = time.time()
-        if now - workers[uid]['_lastreq'] > timeout:
-            to_cull.append(uid)
-            logger.info('culling inactive worker: {}'.format(uid))
+    to_cull = workers.stale(time.time() - timeout)
     for uid in to_cull:
-        try:
-            del workers[uid]
-            del request_queue[uid]
-        except KeyError:
-            pass
+        logger.info('culling inactive worker: {}'.format(uid))
+    for uid in to_cull:
+        workers.pop(uid, None)
+        worker_index.remove(uid)
+        request_queue.clear(uid)
+        drains.forget(uid)
+        if analyzer is not None:
+            analyzer.forget(uid)
+        if memguard is not None:
+            memguard.forget(uid)
 
     to_cull = []
     for uid, data in scheduler.items():
@@ -121,53 +279,170 @@ def cull_inactive(timeout=20):
             to_cull.append(uid)
             logger.info('culling scheduler: {}'.format(uid))
     for uid in to_cull:
-        try:
-            del scheduler[uid]
-            del request_queue[uid]
-        except KeyError:
-            pass
+        scheduler.pop(uid, None)
+        worker_index.remove(uid)
+        request_queue.clear(uid)
+
+
+def check_memory():
+    for uid, reason in memguard.check(workers, engine_queue):
+        w = workers[uid]
+        logger.info('Preemptive restart of {} on {} ({}, rss: {:.0f} MB)'.format(
+            uid, w.get('host'), reason, w.get('rss', 0) / 1024**2))
+        push_request(uid, REQ_PREEMPT)
+        publish('preempt', {'uid': uid, 'host': w.get('host'), 'rss': w.get('rss'), 'reason': reason})
+
+
+def check_drains():
+    # while the status is temporarily unknown (startup, controller
+    # timeouts) engine_queue is None and the drains wait for their deadline
+    for uid, action, reason in drains.check(engine_queue, ipp_monitored, request_queue.queues.get):
+        w = workers.get(uid, {})
+        logger.info('Drained {} on {} ({}), {}'.format(uid, w.get('host'), reason, action))
+        push_request(uid, REQ_EXIT if action == 'exit' else REQ_RESTART)
+        publish('drain', {'uid': uid, 'host': w.get('host'), 'action': action, 'reason': reason})
+
+
+def check_scheduler():
+    if not scheduler_slo.check(ipp_status.get('probe')):
+        return
+    probe = ipp_status['probe']
+    logger.warning('Scheduler latency SLO breached (p{} {:.0f} ms, {} timeouts), restarting it'.format(
+        scheduler_slo.options['percentile'],
+        scheduler_slo.latency(probe), probe['timeouts']))
+    if not scheduler:
+        logger.warning('No supervised scheduler to restart')
+    for uid in scheduler:
+        push_request(uid, REQ_RESTART)
+    publish('scheduler', {'action': 'restart', 'rtt_ms': probe['rtt_ms'], 'timeouts': probe['timeouts']})
+
+
+def autoscale():
+    for uid in autoscaler.tick(ipp_status, workers, engine_queue):
+        push_request(uid, REQ_EXIT)
+        publish('autoscale', {'uid': uid, 'host': workers[uid].get('host'), 'action': 'retire'})
+
+
+def restore_state(path, interval=30.0):
+    global state_store
+    global scheduler
+    state_store = StateStore(path, interval)
+    saved_workers, saved_scheduler, saved_requests = state_store.load()
+    for uid, data in saved_workers.items():
+        workers.heartbeat(uid, data)
+    scheduler = saved_scheduler
+    request_queue.restore(saved_requests)
+    request_queue.log = state_store.log
+    for uid, data in list(workers.items()) + list(scheduler.items()):
+        worker_index.add(uid, data)
 
 
 def cleanup():
-    pass
+    if metrics_archive is not None:
+        metrics_archive.close()
+    if state_store is not None:
+        state_store.close(workers, scheduler, request_queue.queues)
 
 
-def req_exit():
+def select(selector):
+    '''
+    Uids of the clients matching a selector (see selection.parse_selector).
+    Only engines are selected, unless the selector has a type term.
+    '''
+    terms = parse_selector(selector)
+    if not any(t[0] == 'type' for t in terms):
+        terms.append(('type', '=', 'worker'))
+    return worker_index.select(terms, lambda uid: workers.get(uid) or scheduler.get(uid, {}))
 
-    for uid in workers:
-        request_queue[uid].append(REQ_EXIT)
-    for uid in scheduler:
-        request_queue[uid].append(REQ_EXIT)
+
+def req_exit(selected=None):
+
+    if selected is None:
+        selected = list(workers) + list(scheduler)
+    for uid in selected:
+        push_request(uid, REQ_EXIT)
 
     return {
-        'data': {'status': 'ok'},
+        'data': {'status': 'ok', 'n_selected': len(selected)},
         'on_success': do_nothing
     }
 
 
-def req_restart():
+def req_restart(selected=None):
     # restart workers
-    for uid in workers:
-        request_queue[uid].append(REQ_RESTART)
+    if selected is None:
+        selected = list(workers)
+    for uid in selected:
+        push_request(uid, REQ_RESTART)
     return {
-        'data': {'status': 'ok'},
+        'data': {'status': 'ok', 'n_selected': len(selected)},
         'on_success': do_nothing
     }
 
 
-def req_reset():
+def req_reset(selected=None):
     # restart both scheduler and workers
+    if selected is not None:
+        return req_restart(selected)
     for uid in scheduler:
-        request_queue[uid].append(REQ_RESTART)
+        push_request(uid, REQ_RESTART)
     return req_restart()
 
 
-def req_info():
+def req_drain(data, selected=None):
+    action = data.get('action', 'restart')
+    if action not in ('restart', 'exit'):
+        return {
+            'data': {'status': 'failed', 'reason': 'Invalid drain action: {}'.format(action)},
+            'on_success': do_nothing
+        }
+    if selected is None:
+        selected = list(workers)
+    drain = drains.start(selected, action, deadline=data.get('deadline'), parallel=data.get('parallel'))
+    logger.info('Draining {} engines before {} (drain {})'.format(len(selected), action, drain))
+    return {
+        'data': {'status': 'ok', 'drain': drain, 'n_selected': len(selected)},
+        'on_success': do_nothing
+    }
+
+
+def req_undrain(selected=None):
+    n = drains.cancel(set(workers if selected is None else selected))
+    return {
+        'data': {'status': 'ok', 'n_selected': n},
+        'on_success': do_nothing
+    }
+
+
+def req_limit(data, selected=None):
+    # cgroup limits of the engines, 'max' removes a limit
+    memory_max, cpu_max = data.get('memory_max'), data.get('cpu_max')
+    try:
+        if memory_max not in (None, 'max'):
+            memory_max = int(parse_size(memory_max))
+        if cpu_max not in (None, 'max'):
+            cpu_max = float(cpu_max)
+    except ValueError as e:
+        return {
+            'data': {'status': 'failed', 'reason': str(e)},
+            'on_success': do_nothing
+        }
+    if selected is None:
+        selected = list(workers)
+    for uid in selected:
+        push_request(uid, {'req': REQ_LIMIT, 'memory_max': memory_max, 'cpu_max': cpu_max})
+    return {
+        'data': {'status': 'ok', 'n_selected': len(selected)},
+        'on_success': do_nothing
+    }
+
+
+def req_info(selected=None):
     import socket as sk
     host = sk.getfqdn()
     n_workers = len(workers)
     if n_workers > 0:
-        ave_cpu = sum([w.get('pcpu', 0) for w in workers.values()]) / n_workers
+        ave_cpu = workers.total('pcpu') / n_workers
     else:
         ave_cpu = 0
 
@@ -175,108 +450,501 @@ def req_info():
     for uid in scheduler:
         if 'host' in scheduler[uid]:
             scheduler_host = scheduler[uid]['host']
-            
+
+    data = {
+        'status': 'ok',
+        'n_workers': n_workers,
+        'ave_cpu': ave_cpu,
+        'host': host,
+        'shost': scheduler_host,
+        'scheduler': scheduler,
+    }
+    if analyzer is not None:
+        summary = analyzer.summary()
+        data['n_flagged'] = len(summary['flags'])
+        data['flags'] = summary['flags']
+        data['peer_stats'] = summary['stats']
+    # engines that died on their own vs. restarted by the memory guard
+    data['n_crashes'] = workers.total('n_crashes')
+    data['n_preempted'] = workers.total('n_preempted')
+    # application metrics reported by the engines, summed over the cluster
+    app = defaultdict(float)
+    for values in workers.column('app'):
+        for name, value in values.items():
+            app[name] += value
+    if app:
+        data['app'] = dict(app)
+    if memguard is not None:
+        data['memguard'] = memguard.summary()
+    if autoscaler is not None:
+        data['autoscale'] = autoscaler.summary()
+    if 'tasks' in ipp_status:
+        data['tasks'] = task_summary()
+    if 'probe' in ipp_status:
+        data['probe'] = dict(ipp_status['probe'])
+        if scheduler_slo is not None:
+            data['probe']['slo'] = scheduler_slo.summary()
+    if drains.active or drains.waiting or drains.stopping:
+        data['drain'] = drains.summary()
+    if selected is not None:
+        data['selected'] = {uid: workers.get(uid, scheduler.get(uid, {})).get('host') for uid in selected}
+
+    return {
+        'data': data,
+        'on_success': do_nothing
+    }
+
+
+def task_summary():
+    '''
+    Task accounting from the ipyparallel status, with the engine ranking
+    annotated with the uids of the supervising clients.
+    '''
+    tasks = dict(ipp_status['tasks'])
+    if 'engines' in tasks:
+        uids = {}
+        for uid, w in workers.items():
+            eid = engine_ids.get((w.get('host'), w.get('pid')))
+            if eid is not None:
+                uids[eid] = uid
+        tasks['engines'] = [dict(e, uid=uids.get(e['engine'])) for e in tasks['engines']]
+    return tasks
+
+
+def req_history(data):
+    if metrics_archive is None:
+        return {
+            'data': {
+                'status': 'failed',
+                'reason': 'Metrics archive not enabled'
+            },
+            'on_success': do_nothing
+        }
+    # a long range scans seconds of data: the reply is sent when the
+    # query completes, heartbeats are handled meanwhile
+    metrics_archive.flush()
+    return {
+        'deferred': history_executor.submit(query_history, metrics_archive.path, data, time.time()),
+        'on_success': do_nothing
+    }
+
+
+def query_history(path, data, now):
+    from .archive import query, METRICS
+    result = query(
+        path,
+        start=data.get('start', now - 3600),
+        end=data.get('end', now),
+        metrics=data.get('metrics') or METRICS,
+        bucket=data.get('bucket'),
+        by=data.get('by', 'time'),
+        uids=data.get('uids'),
+        hosts=data.get('hosts'),
+    )
+    result['status'] = 'ok'
+    return result
+
+
+def defer_reply(future, sock, route, poller):
+    '''
+    Replies to a message when `future` is done, see send_deferred. A REP
+    socket answers its requests in order, it is not polled meanwhile.
+    '''
+    if route is None:
+        poller.unregister(sock)
+    deferred.append((future, sock, route))
+
+
+def send_deferred(poller):
+    for item in [x for x in deferred if x[0].done()]:
+        future, sock, route = item
+        deferred.remove(item)
+        try:
+            reply = future.result()
+        except Exception as e:
+            traceback.print_exc()
+            reply = {'status': 'failed', 'reason': repr(e)}
+        if route is None:
+            sock.send_json(reply)
+            poller.register(sock, zmq.POLLIN)
+        else:
+            sock.send_multipart(route + [json.dumps(reply).encode()])
+
+
+def req_profile(data):
+    now = time.time()
+    for job in [j for j, p in profiles.items() if now - p['created'] > PROFILE_TTL]:
+        del profiles[job]
+
+    try:
+        uids = select(data.get('target', ''))
+    except ValueError as e:
+        uids, reason = [], str(e)
+    else:
+        reason = 'No engine matching {}'.format(data.get('target'))
+    if not uids:
+        return {
+            'data': {'status': 'failed', 'reason': reason},
+            'on_success': do_nothing
+        }
+    job = data.get('job') or uuid.uuid4().hex
+    seconds = min(float(data.get('seconds', 10)), PROFILE_MAX_SECONDS)
+    rate = int(data.get('rate', 100))
+    profiles[job] = {
+        'created': now,
+        'seconds': seconds,
+        'targets': {uid: {'status': 'running', 'chunks': {}} for uid in uids},
+    }
+    for uid in uids:
+        push_request(uid, {'req': REQ_PROFILE, 'job': job, 'seconds': seconds, 'rate': rate})
+    return {
+        'data': {'status': 'ok', 'job': job, 'uids': uids},
+        'on_success': do_nothing
+    }
+
+
+def req_profile_status(data):
+    job = profiles.get(data.get('job'))
+    if job is None:
+        return {
+            'data': {'status': 'failed', 'reason': 'Unknown job'},
+            'on_success': do_nothing
+        }
+    targets = {}
+    for uid, t in job['targets'].items():
+        targets[uid] = {
+            'status': t['status'],
+            'host': workers.get(uid, {}).get('host'),
+            'received': len(t['chunks']),
+            'n_chunks': t.get('n_chunks'),
+        }
+        if 'error' in t:
+            targets[uid]['error'] = t['error']
+        if t['status'] == 'done':
+            targets[uid]['sampler'] = t['sampler']
+            targets[uid]['folded'] = ''.join(t['chunks'][i] for i in range(t['n_chunks']))
     return {
         'data': {
             'status': 'ok',
-            'n_workers': n_workers,
-            'ave_cpu': ave_cpu,
-            'host': host,
-            'shost': scheduler_host,
-            'scheduler': scheduler,
+            'job': data['job'],
+            'created': job['created'],
+            'seconds': job['seconds'],
+            'targets': targets,
         },
         'on_success': do_nothing
     }
 
 
-def ipyparallel_status_loop(out, client_args=None, interval=5):
+def _engine_identity():
+    # runs on the engine: host and pids of the engine and its parents, so
+    # that the server can match it with the client supervising it
+    import os
+    import socket
+    pids = [os.getpid()]
+    try:
+        import psutil
+        pids += [p.pid for p in psutil.Process().parents()]
+    except ImportError:
+        pids.append(os.getppid())
+    return socket.getfqdn(), pids
+
+
+def _client_stats():
+    '''
+    Aggregates the figures reported by the clients with their heartbeats.
+    '''
+    per_name = defaultdict(list)
+    for uid, w in workers.items():
+        for name, h in w.get('_stats', {}).items():
+            if h.get('count'):
+                per_name[name].append((h['mean_ms'], h['max_ms'], uid))
+    out = {}
+    for name, values in per_name.items():
+        values.sort()
+        n = len(values)
+        out[name] = {
+            'clients': n,
+            'mean_ms_p50': values[n // 2][0],
+            'mean_ms_p90': values[min(n - 1, int(0.9 * n))][0],
+            'max_ms': max(v[1] for v in values),
+            'slowest': [v[2] for v in values[-5:][::-1]],
+        }
+    return out
+
+
+def req_stats():
+    data = {
+        'status': 'ok',
+        'enabled': stats.enabled,
+        'n_workers': len(workers),
+        'queues': request_queue.summary(),
+    }
+    if stats.enabled:
+        data['server'] = stats.summary()
+        data['server']['loop_utilization'] = loop_meter.utilization
+        data['clients'] = _client_stats()
+    return {
+        'data': data,
+        'on_success': do_nothing
+    }
+
+
+def _poll_ipyparallel(rcl, engines, identities, own_tasks, cursor, task_stats):
+    '''
+    One round of queries to the controller, returns the status to publish.
+    '''
+    status = {}
+    ids = rcl.ids
+    qstat = rcl.queue_status()
+    n_unassigned = qstat['unassigned']
+    iworkers = [k for k in qstat.keys() if k != 'unassigned']
+    n_tasks = sum([qstat[k]['tasks'] for k in iworkers])
+    n_queued = sum([qstat[k]['queue'] for k in iworkers])
+    n_working = sum([ 1 for w in iworkers if qstat[w]['tasks'] + qstat[w]['queue'] > 0 ])
+    n_pending = n_queued + n_tasks + n_unassigned
+    status['n_workers'] = len(ids)
+    status['n_pending'] = n_pending
+    status['n_working'] = n_working
+    status['queue'] = {w: qstat[w]['tasks'] + qstat[w]['queue'] for w in iworkers}
+
+    # ask new engines who they are. The request waits behind the
+    # tasks running on the engine, so results are collected when ready
+    for eid in ids:
+        if eid not in engines and eid not in identities:
+            identities[eid] = ar = rcl[eid].apply_async(_engine_identity)
+            own_tasks.update(ar.msg_ids)
+    for eid, ar in list(identities.items()):
+        if ar.ready():
+            del identities[eid]
+            try:
+                engines[eid] = ar.get()
+            except:
+                pass
+    for eid in [eid for eid in engines if eid not in ids]:
+        del engines[eid]
+    status['engines'] = dict(engines)
+    status['status'] = 'connected'
+
+    # completed tasks since the last poll, from the hub database
+    try:
+        uuids = {u: eid for eid, u in getattr(rcl, '_engines', {}).items()}
+        records = []
+        # the identity requests are not application tasks
+        for r in cursor.fetch(rcl):
+            if r['msg_id'] in own_tasks:
+                own_tasks.discard(r['msg_id'])
+            else:
+                records.append(r)
+        task_stats.add(records, uuids)
+        status['tasks'] = task_stats.summary()
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        # e.g. hub without a task database (NoDB)
+        status['tasks'] = {'status': 'unavailable', 'reason': repr(e)}
+    return status
+
+
+def ipyparallel_status_loop(out, client_args=None, interval=5, task_window=300.):
+    '''
+    Publishes the controller status in `out` every `interval` seconds.
+
+    The Client calls wait for the controller without a timeout: they run
+    in a worker thread and a round not answered in `timeout` seconds marks
+    the controller disconnected. The stuck Client is abandoned to its
+    thread (closed if the call ever returns) and a new one is created.
+    '''
     from ipyparallel import Client
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError
     if client_args is None:
         client_args = {}
     timeout = client_args.pop('timeout', 10)
 
     rcl = None
+    executor = ThreadPoolExecutor(1)
+    identities = {}
+    own_tasks = set()
+    engines = {}
+    cursor = HistoryCursor(backfill=task_window)
+    task_stats = TaskStats(window=task_window)
+
+    def reset(status, reason):
+        nonlocal rcl, executor, identities
+        if rcl is not None:
+            executor.submit(rcl.close)
+        executor.shutdown(wait=False)
+        executor = ThreadPoolExecutor(1)
+        rcl = None
+        identities = {}
+        # stale figures must not be acted upon
+        for key in ('queue', 'engines', 'n_pending', 'n_working'):
+            out.pop(key, None)
+        out['status'] = status
+        out['reason'] = reason
+
     while True:
         start = time.time()
         try:
-            rcl = Client(**client_args, timeout=timeout)
-            n_workers = len(rcl.ids)
-            qstat = rcl.queue_status()
-            rcl.close()
-            n_unassigned = qstat['unassigned']
-            iworkers = [k for k in qstat.keys() if k != 'unassigned']
-            n_tasks = sum([qstat[k]['tasks'] for k in iworkers])
-            n_queued = sum([qstat[k]['queue'] for k in iworkers])
-            n_working = sum([ 1 for w in iworkers if qstat[w]['tasks'] + qstat[w]['queue'] > 0 ])
-            n_pending = n_queued + n_tasks + n_unassigned
-            out['n_workers'] = n_workers
-            out['n_pending'] = n_pending
-            out['n_working'] = n_working
-            out['status'] = 'connected'
+            if rcl is None:
+                rcl = Client(**client_args, timeout=timeout)
+            future = executor.submit(_poll_ipyparallel, rcl, engines, identities, own_tasks,
+                                     cursor, task_stats)
+            out.update(future.result(timeout=timeout))
         except KeyboardInterrupt:
             return
+        except TimeoutError:
+            logger.warning('ipyparallel controller not answering in {}s'.format(timeout))
+            reset('disconnected', 'timeout')
         except:
-            out['status'] = 'error'
-            out['reason'] = traceback.format_exc()
-        finally:
-            if rcl is not None:
-                rcl.close()
+            reset('error', traceback.format_exc())
         elapsed = time.time() - start
         next_iteration_timer = max(0., interval - elapsed)
         time.sleep(next_iteration_timer)
 
 
-def server_loop(ipclient_args=None):
+def server_loop(ipclient_args=None, state_dir=None, snapshot_interval=30.0, archive_dir=None,
+                analysis_options=None, memguard_options=None, autoscale_options=None,
+                addresses=None, monitor_ipyparallel=True, instrument=True, probe_options=None,
+                shard=None):
+    '''
+    Runs the control server. With `shard` (see sharding.py) the server
+    owns a partition of the clients: it does not bind the public
+    endpoints, and receives the client messages and the commands from the
+    sharding front-end.
+    '''
+    global metrics_archive
+    global history_executor
+    global analyzer
+    global memguard
+    global autoscaler
+    global scheduler_slo
+    global pub_socket
+    global ipyparallel_data
+    global ipp_monitored
     logger.info('Starting Server Loop')
 
-    context = zmq.Context()
-    socket = context.socket(zmq.REP)
-    socket.setsockopt(zmq.LINGER, 0)
-    socket.bind("tcp://*:5558")
+    if state_dir is not None:
+        restore_state(state_dir, snapshot_interval)
 
-    ctcpsocket = context.socket(zmq.REP)
-    ctcpsocket.setsockopt(zmq.LINGER, 0)
-    ctcpsocket.bind("tcp://*:5559")
+    if archive_dir is not None:
+        from .archive import MetricsArchive
+        from concurrent.futures import ThreadPoolExecutor
+        metrics_archive = MetricsArchive(archive_dir)
+        history_executor = ThreadPoolExecutor(1)
 
-    cunixsocket = context.socket(zmq.REP)
-    cunixsocket.setsockopt(zmq.LINGER, 0)
-    cunixsocket.bind("ipc://ipyserver.socket")
+    addresses = dict(ADDRESSES, **(addresses or {}))
+    enable_stats(instrument)
 
+    context = zmq.Context()
     poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
-    poller.register(ctcpsocket, zmq.POLLIN)
-    poller.register(cunixsocket, zmq.POLLIN)
-
-    manager = Manager()
-    ipyparallel_data = manager.dict()
-    # start the ipyparallel check loop
-    p = Process(
-        target=ipyparallel_status_loop,
-        kwargs={
-            'out': ipyparallel_data,
-            'client_args': ipclient_args,
-        },
-        daemon=True
-    )
-    p.start()
-
+    backend = None
+    if shard is None:
+        socket = context.socket(zmq.REP)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(addresses['clients'])
+
+        ctcpsocket = context.socket(zmq.REP)
+        ctcpsocket.setsockopt(zmq.LINGER, 0)
+        ctcpsocket.bind(addresses['control'])
+
+        cunixsocket = context.socket(zmq.REP)
+        cunixsocket.setsockopt(zmq.LINGER, 0)
+        cunixsocket.bind(addresses['control_ipc'])
+
+        poller.register(socket, zmq.POLLIN)
+        poller.register(ctcpsocket, zmq.POLLIN)
+        poller.register(cunixsocket, zmq.POLLIN)
+
+        # event stream (flags, ...) for subscribers
+        pub_socket = context.socket(zmq.PUB)
+        pub_socket.setsockopt(zmq.LINGER, 0)
+        pub_socket.bind(addresses['events'])
+    else:
+        # [route..., message] frames, see sharding.ShardRouter
+        backend = context.socket(zmq.PAIR)
+        backend.setsockopt(zmq.LINGER, 0)
+        backend.connect(shard['backend'])
+        poller.register(backend, zmq.POLLIN)
+
+        # events are republished by the front-end
+        pub_socket = context.socket(zmq.PUB)
+        pub_socket.setsockopt(zmq.LINGER, 0)
+        pub_socket.connect(shard['events'])
+
+    if analysis_options is not False:
+        analyzer = Analyzer(**(analysis_options or {}))
+
+    if memguard_options:
+        memguard = MemoryGuard(**memguard_options)
+
+    if autoscale_options:
+        autoscaler = Autoscaler(**autoscale_options)
+
+    if shard is not None and shard.get('ipp') is not None:
+        # status and probe loops run in the front-end
+        ipyparallel_data = shard['ipp']
+        ipp_monitored = True
+        if probe_options is not False:
+            scheduler_slo = SchedulerSLO(**(probe_options or {}))
+    elif monitor_ipyparallel:
+        manager = Manager()
+        ipyparallel_data = manager.dict()
+        ipp_monitored = True
+        # start the ipyparallel check loop
+        p = Process(
+            target=ipyparallel_status_loop,
+            kwargs={
+                'out': ipyparallel_data,
+                'client_args': ipclient_args,
+            },
+            daemon=True
+        )
+        p.start()
+
+        if probe_options is not False:
+            # controller health, on its own connection
+            probe_options = probe_options or {}
+            scheduler_slo = SchedulerSLO(**probe_options)
+            Process(
+                target=probe_loop,
+                args=(ipyparallel_data, ipclient_args),
+                kwargs=probe_options,
+                daemon=True
+            ).start()
+
+    last_refresh = 0
+    last_memcheck = 0
+    last_autoscale = 0
     while True:
         try:
             #  Wait for next request from either client or controller
-            evts = poller.poll(1000)
+            evts = poller.poll(50 if deferred else 1000)
+            if stats.enabled:
+                t_busy = time.perf_counter()
             if evts:
                 sock = evts[0][0]
-                data = sock.recv_json()
+                if sock is backend:
+                    # the route frames go back with the reply
+                    *route, msg = sock.recv_multipart()
+                    data = json.loads(msg)
+                else:
+                    data = sock.recv_json()
                 logger.debug("Received info: \n{}".format(data))
                 try:
                     response = handle_message(data)
-                    ok = False
-                    if sock.poll(timeout=.2, flags=zmq.POLLOUT):
-                        sock.send_json(response['data'])
-                        response['on_success']()
-                        ok = True
-                    if not ok:
-                        raise RuntimeError('Cannot send back the message')
+                    if 'deferred' in response:
+                        defer_reply(response['deferred'], sock, route if sock is backend else None, poller)
+                    else:
+                        ok = False
+                        if sock.poll(timeout=.2, flags=zmq.POLLOUT):
+                            if sock is backend:
+                                sock.send_multipart(route + [json.dumps(response['data']).encode()])
+                            else:
+                                sock.send_json(response['data'])
+                            response['on_success']()
+                            ok = True
+                        if not ok:
+                            raise RuntimeError('Cannot send back the message')
 
                 except zmq.ZMQError:
                     logger.debug('Error receiving or sending back message')
@@ -285,8 +953,45 @@ def server_loop(ipclient_args=None):
                 except:
                     traceback.print_exc()
 
+            if deferred:
+                send_deferred(poller)
+
+            now = time.time()
+            if now - last_refresh >= 1.0:
+                refresh_ipyparallel_status()
+                last_refresh = now
+
             cull_inactive()
 
+            check_drains()
+
+            if scheduler_slo is not None:
+                check_scheduler()
+
+            if memguard is not None and now - last_memcheck >= 5.0:
+                check_memory()
+                last_memcheck = now
+
+            if autoscaler is not None and now - last_autoscale >= 5.0:
+                autoscale()
+                last_autoscale = now
+
+            if state_store is not None:
+                state_store.maybe_snapshot(workers, scheduler, request_queue.queues)
+
+            if stats.enabled:
+                busy = time.perf_counter() - t_busy
+                stats.observe('loop.message' if evts else 'loop.idle', busy)
+                loop_meter.add_busy(busy)
+
+            if metrics_archive is not None:
+                metrics_archive.maybe_flush()
+
+            if shard is not None and os.getppid() != shard['parent']:
+                logger.info('Front-end gone, stopping shard..')
+                cleanup()
+                break
+
         except KeyboardInterrupt:
             logger.info('Interrupt signal received, stopping..')
             cleanup()
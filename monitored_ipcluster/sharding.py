@@ -0,0 +1,441 @@
+'''
+Sharded control server, for clusters of several thousand engines.
+
+A front-end process binds the public endpoints and routes the client
+messages to N shards by a hash of the client uid. Each shard is a server
+loop (server.server_loop) owning its partition of the clients: their
+state, request queues, selectors, analysis and memory guard. Commands are
+sent to every shard and their replies merged. Events of the shards are
+republished on the events endpoint.
+
+The ipyparallel status and probe loops run once, in the front-end, and
+their figures are shared with the shards. The autoscaler needs the whole
+cluster and is not available in this mode. The memory guard host limits
+and the drain parallelism are applied per shard.
+'''
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import shutil
+import logging
+import tempfile
+import itertools
+import traceback
+from collections import defaultdict
+from multiprocessing import Process, Manager
+
+import zmq
+
+from . import server
+from .archive import merge as merge_history
+from .instrument import stats, enable as enable_stats, LoopMeter
+
+logger = logging.getLogger('SHARDS')
+logger.setLevel(logging.INFO)
+
+# the uid is found without decoding the message, it comes first in the
+# messages of the clients
+_uid_re = re.compile(rb'"uid"\s*:\s*"([^"]*)"')
+
+COMMAND_TIMEOUT = 10.0 # s to wait for the replies of the shards
+
+
+def shard_of(msg, n_shards):
+    m = _uid_re.search(msg)
+    if m is not None:
+        uid = m.group(1)
+    else:
+        try:
+            uid = str(json.loads(msg).get('uid', '')).encode()
+        except (ValueError, AttributeError):
+            uid = b''
+    return zlib.crc32(uid) % n_shards
+
+
+def _sum_dicts(dicts):
+    out = {}
+    for d in dicts:
+        for k, v in d.items():
+            out[k] = out.get(k, 0) + v
+    return out
+
+
+def merge_info(replies):
+    n = sum(r['n_workers'] for r in replies)
+    data = {
+        'status': 'ok',
+        'n_workers': n,
+        'ave_cpu': sum(r['ave_cpu'] * r['n_workers'] for r in replies) / n if n else 0,
+        'host': replies[0]['host'],
+        'shost': next((r['shost'] for r in replies if r['shost'] != 'N/A'), 'N/A'),
+        'scheduler': {},
+        'n_shards': len(replies),
+        'n_crashes': sum(r.get('n_crashes', 0) for r in replies),
+        'n_preempted': sum(r.get('n_preempted', 0) for r in replies),
+    }
+    for r in replies:
+        data['scheduler'].update(r['scheduler'])
+
+    if any('flags' in r for r in replies):
+        data['flags'] = {}
+        for r in replies:
+            data['flags'].update(r.get('flags', {}))
+        data['n_flagged'] = len(data['flags'])
+        # medians do not merge, those of the largest shard are close enough
+        data['peer_stats'] = max(replies, key=lambda r: r['n_workers']).get('peer_stats')
+
+    app = _sum_dicts(r['app'] for r in replies if 'app' in r)
+    if app:
+        data['app'] = app
+
+    guards = [r['memguard'] for r in replies if 'memguard' in r]
+    if guards:
+        data['memguard'] = {
+            'restarts': _sum_dicts(g['restarts'] for g in guards),
+            'pending': {uid: reason for g in guards for uid, reason in g['pending'].items()},
+            'recent': sorted((x for g in guards for x in g['recent']), key=lambda x: x['time'])[-10:],
+        }
+
+    drains = [r['drain'] for r in replies if 'drain' in r]
+    if drains:
+        data['drain'] = {
+            'draining': {uid: d for x in drains for uid, d in x['draining'].items()},
+            'waiting': sum(x['waiting'] for x in drains),
+            'stopping': sum(x['stopping'] for x in drains),
+            'recent': sorted((e for x in drains for e in x['recent']), key=lambda e: e[0])[-10:],
+        }
+
+    # same ipyparallel figures in every shard
+    for key in ('tasks', 'probe'):
+        for r in replies:
+            if key in r:
+                data[key] = r[key]
+                break
+
+    if any('selected' in r for r in replies):
+        data['selected'] = {}
+        for r in replies:
+            data['selected'].update(r.get('selected', {}))
+    return data
+
+
+def merge_stats(replies, front=None):
+    data = {
+        'status': 'ok',
+        'enabled': all(r['enabled'] for r in replies),
+        'n_workers': sum(r['n_workers'] for r in replies),
+        'queues': _sum_dicts(r['queues'] for r in replies),
+    }
+    data['queues']['max'] = max(r['queues']['max'] for r in replies)
+    if not data['enabled']:
+        return data
+
+    data['server'] = front
+    data['shards'] = [r['server'] for r in replies]
+    per_name = defaultdict(list)
+    for r in replies:
+        for name, c in r['clients'].items():
+            per_name[name].append(c)
+    data['clients'] = {}
+    for name, cs in per_name.items():
+        slowest = max(cs, key=lambda c: c['max_ms'])
+        data['clients'][name] = {
+            'clients': sum(c['clients'] for c in cs),
+            # percentiles of the shards: median of the medians, worst p90
+            'mean_ms_p50': sorted(c['mean_ms_p50'] for c in cs)[len(cs) // 2],
+            'mean_ms_p90': max(c['mean_ms_p90'] for c in cs),
+            'max_ms': slowest['max_ms'],
+            'slowest': slowest['slowest'],
+        }
+    return data
+
+
+def merge_replies(cmd, replies, front_stats=None):
+    '''
+    Reply of the cluster from the replies of the shards. Shards failing
+    are ignored when others succeed: they may just have no client matching
+    the selector.
+    '''
+    ok = [r for r in replies if r.get('status') == 'ok']
+    if not ok:
+        return replies[0] if replies else {'status': 'failed', 'reason': 'No reply from the shards'}
+    if cmd == 'info':
+        return merge_info(ok)
+    if cmd == 'stats':
+        return merge_stats(ok, front_stats)
+    if cmd == 'history':
+        data = merge_history(ok)
+        data['status'] = 'ok'
+        return data
+    if cmd == 'profile':
+        return {'status': 'ok', 'job': ok[0]['job'], 'uids': [u for r in ok for u in r['uids']]}
+    data = dict(ok[0])
+    if cmd == 'profile_status':
+        data['targets'] = {}
+        for r in ok:
+            data['targets'].update(r['targets'])
+    elif 'n_selected' in data:
+        data['n_selected'] = sum(r.get('n_selected', 0) for r in ok)
+    return data
+
+
+class ShardRouter:
+    '''
+    Front-end sockets: a ROUTER for the clients and a PAIR to each shard,
+    carrying [route..., message] frames, sent back with the reply. The
+    route is the identity of the client, or an empty frame and the id of
+    the command for commands.
+
+    Commands do not block the routing of the client messages: their
+    replies are collected as they come, and late replies to a command
+    already answered are recognized by the id and discarded.
+    '''
+
+    def __init__(self, context, address, backends):
+        self.frontend = context.socket(zmq.ROUTER)
+        self.frontend.setsockopt(zmq.LINGER, 0)
+        self.frontend.bind(address)
+        self.backends = []
+        for addr in backends:
+            sock = context.socket(zmq.PAIR)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.bind(addr)
+            self.backends.append(sock)
+        self.index = {sock: k for k, sock in enumerate(self.backends)}
+        self.ids = itertools.count()
+        self.pending = {}  # command id -> {'cmd', 'replies', 'left', 'deadline', 'done'}
+
+    def route_request(self):
+        # REQ clients: [identity, empty, message]
+        identity, _, msg = self.frontend.recv_multipart()
+        self.backends[shard_of(msg, len(self.backends))].send_multipart([identity, msg])
+
+    def route_reply(self, sock):
+        '''
+        Forwards a client reply, or records the reply of a shard to a
+        command.
+        '''
+        frames = sock.recv_multipart()
+        if frames[0]:
+            route, msg = frames
+            self.frontend.send_multipart([route, b'', msg])
+            return
+        _, cid, msg = frames
+        p = self.pending.get(int(cid))
+        if p is None:
+            logger.warning('Late reply to a command discarded')
+            return
+        k = self.index[sock]
+        if p['replies'][k] is None:
+            p['replies'][k] = json.loads(msg)
+            p['left'] -= 1
+        if not p['left']:
+            self._finish(int(cid))
+
+    def command(self, data, done, timeout=COMMAND_TIMEOUT):
+        '''
+        Sends a command to every shard. done(replies) is called with the
+        replies of the shards once all answered, or with those received at
+        the timeout (see expire).
+        '''
+        cid = next(self.ids)
+        msg = json.dumps(data).encode()
+        for sock in self.backends:
+            sock.send_multipart([b'', str(cid).encode(), msg])
+        self.pending[cid] = {
+            'cmd': data.get('cmd'),
+            'replies': [None] * len(self.backends),
+            'left': len(self.backends),
+            'deadline': time.time() + timeout,
+            'done': done,
+        }
+
+    def next_deadline(self):
+        return min((p['deadline'] for p in self.pending.values()), default=None)
+
+    def expire(self, now):
+        for cid, p in list(self.pending.items()):
+            if now >= p['deadline']:
+                logger.warning('{} shards did not answer {}'.format(p['left'], p['cmd']))
+                self._finish(cid)
+
+    def _finish(self, cid):
+        p = self.pending.pop(cid)
+        p['done']([r for r in p['replies'] if r is not None])
+
+
+def prepare_command(data, n_shards):
+    data = dict(data)
+    if data.get('cmd') == 'profile':
+        # the same job in every shard
+        data['job'] = data.get('job') or uuid.uuid4().hex
+    elif data.get('cmd') == 'drain' and data.get('parallel'):
+        # rolling drains proceed in every shard
+        data['parallel'] = -(-int(data['parallel']) // n_shards)
+    return data
+
+
+def command_reply(data, replies, t0, loop_meter):
+    try:
+        front = None
+        if stats.enabled:
+            stats.observe('command.' + str(data.get('cmd')), time.perf_counter() - t0)
+            front = stats.summary()
+            front['loop_utilization'] = loop_meter.utilization
+        return merge_replies(data.get('cmd'), replies, front)
+    except Exception as e:
+        # the control socket must answer anyway
+        traceback.print_exc()
+        return {'status': 'failed', 'reason': repr(e)}
+
+
+def handle_command(router, sock, poller, loop_meter):
+    '''
+    Sends a command of a control socket to the shards. The socket gets the
+    merged reply when the shards have answered, and is not polled
+    meanwhile: a REP socket answers its requests in order.
+    '''
+    data = sock.recv_json()
+    logger.info('Command received: {}'.format(data.get('cmd')))
+    t0 = time.perf_counter()
+
+    def done(replies):
+        sock.send_json(command_reply(data, replies, t0, loop_meter))
+        poller.register(sock, zmq.POLLIN)
+
+    poller.unregister(sock)
+    try:
+        router.command(prepare_command(data, len(router.backends)), done)
+    except Exception as e:
+        traceback.print_exc()
+        sock.send_json({'status': 'failed', 'reason': repr(e)})
+        poller.register(sock, zmq.POLLIN)
+
+
+def _shard_dir(path, k):
+    return None if path is None else os.path.join(path, 'shard-{}'.format(k))
+
+
+def sharded_server(n_shards, ipclient_args=None, state_dir=None, archive_dir=None,
+                   autoscale_options=None, addresses=None, monitor_ipyparallel=True,
+                   instrument=True, probe_options=None, **options):
+    '''
+    Runs the front-end and `n_shards` server loops. Other options are
+    passed to server.server_loop. The state and the metrics archive of
+    each shard are kept in a shard-<k> subdirectory.
+
+    The partition of the clients depends on the number of shards: keep it
+    when restarting with a state directory.
+    '''
+    addresses = dict(server.ADDRESSES, **(addresses or {}))
+    enable_stats(instrument)
+    loop_meter = LoopMeter()
+    if autoscale_options:
+        logger.warning('The autoscaler is not available with shards, disabled')
+
+    ipp = None
+    if monitor_ipyparallel:
+        manager = Manager()
+        ipp = manager.dict()
+        Process(
+            target=server.ipyparallel_status_loop,
+            kwargs={'out': ipp, 'client_args': ipclient_args},
+            daemon=True
+        ).start()
+        if probe_options is not False:
+            Process(
+                target=server.probe_loop,
+                args=(ipp, ipclient_args),
+                kwargs=probe_options or {},
+                daemon=True
+            ).start()
+
+    tmpdir = tempfile.mkdtemp(prefix='mipc-shards-')
+    backends = ['ipc://{}/shard-{}.socket'.format(tmpdir, k) for k in range(n_shards)]
+    events = 'ipc://{}/events.socket'.format(tmpdir)
+
+    context = zmq.Context()
+    router = ShardRouter(context, addresses['clients'], backends)
+
+    control = []
+    for name in ('control', 'control_ipc'):
+        sock = context.socket(zmq.REP)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind(addresses[name])
+        control.append(sock)
+
+    # events of the shards, republished
+    sub = context.socket(zmq.SUB)
+    sub.setsockopt(zmq.LINGER, 0)
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    sub.bind(events)
+    pub = context.socket(zmq.PUB)
+    pub.setsockopt(zmq.LINGER, 0)
+    pub.bind(addresses['events'])
+
+    shards = []
+    for k in range(n_shards):
+        p = Process(
+            target=server.server_loop,
+            kwargs=dict(
+                options,
+                state_dir=_shard_dir(state_dir, k),
+                archive_dir=_shard_dir(archive_dir, k),
+                instrument=instrument,
+                probe_options=probe_options,
+                # the ipyparallel loops run in the front-end only
+                monitor_ipyparallel=False,
+                shard={'backend': backends[k], 'events': events, 'ipp': ipp, 'parent': os.getpid()},
+            ),
+        )
+        p.start()
+        shards.append(p)
+    logger.info('Started {} shards'.format(n_shards))
+
+    poller = zmq.Poller()
+    poller.register(router.frontend, zmq.POLLIN)
+    for sock in router.backends + control + [sub]:
+        poller.register(sock, zmq.POLLIN)
+
+    try:
+        while True:
+            timeout = 1000
+            deadline = router.next_deadline()
+            if deadline is not None:
+                timeout = min(timeout, max(0., deadline - time.time()) * 1000)
+            evts = poller.poll(timeout)
+            if stats.enabled:
+                t_busy = time.perf_counter()
+            for sock, _ in evts:
+                try:
+                    if sock is router.frontend:
+                        router.route_request()
+                    elif sock is sub:
+                        pub.send_multipart(sub.recv_multipart())
+                    elif sock in router.index:
+                        router.route_reply(sock)
+                    else:
+                        handle_command(router, sock, poller, loop_meter)
+                except zmq.ZMQError:
+                    logger.debug('Error routing a message')
+                    traceback.print_exc()
+                except:
+                    traceback.print_exc()
+            router.expire(time.time())
+            if stats.enabled:
+                busy = time.perf_counter() - t_busy
+                stats.observe('loop.message' if evts else 'loop.idle', busy)
+                loop_meter.add_busy(busy)
+    except KeyboardInterrupt:
+        logger.info('Interrupt signal received, stopping..')
+    finally:
+        # the shards receive the interrupt as well, and save their state
+        for p in shards:
+            p.join(10)
+            if p.is_alive():
+                p.terminate()
+        context.destroy(linger=0)
+        shutil.rmtree(tmpdir, ignore_errors=True)
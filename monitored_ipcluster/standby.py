@@ -0,0 +1,55 @@
+'''
+Warm standby engine, kept by the client to replace its engine at once.
+
+    python standby.py [--preload numpy,scipy] -- ipengine [args]
+
+Pays the interpreter startup and the imports (the console script of the
+engine and the `preload` modules) in advance, then waits for a line on
+stdin: on "start" the engine runs in this process, on end of file (the
+client dropped the standby, or is gone) it exits.
+
+The engine only registers with the controller once started: a registered
+engine receives tasks from the schedulers, it cannot be kept idle.
+'''
+import os
+import sys
+import argparse
+import importlib
+from importlib import metadata
+
+
+def load_console_script(name):
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        found = eps.select(group='console_scripts', name=name)
+    else:
+        # python < 3.10
+        found = [ep for ep in eps.get('console_scripts', []) if ep.name == name]
+    for ep in found:
+        return ep.load()
+    raise ValueError('No console script named {}'.format(name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm standby engine')
+    parser.add_argument('--preload', type=str, default='',
+                        help='comma separated modules to import in advance')
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help='console script of the engine and its arguments')
+    args = parser.parse_args()
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    if not command:
+        parser.error('missing engine command')
+
+    entry = load_console_script(os.path.basename(command[0]))
+    for module in filter(None, args.preload.split(',')):
+        importlib.import_module(module)
+
+    if sys.stdin.readline().strip() != 'start':
+        return 0
+    sys.argv = command
+    return entry()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import time
+from collections import deque, Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+
+# task record fields needed, the rest of the record is never transferred
+KEYS = ['msg_id', 'engine_uuid', 'submitted', 'started', 'completed']
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    n = len(values)
+    return {
+        'p50': values[n // 2],
+        'p90': values[min(n - 1, int(0.9 * n))],
+        'p99': values[min(n - 1, int(0.99 * n))],
+        'max': values[-1],
+    }
+
+
+class HistoryCursor:
+    '''
+    Incremental reader of the task records of an ipyparallel Hub.
+
+    Every fetch asks the Hub database for the tasks completed since the
+    last completion time seen, so each record is transferred once. Records
+    completed exactly at the cursor are asked again and skipped by msg_id.
+    The first fetch only goes back `backfill` seconds.
+    '''
+
+    def __init__(self, backfill=300.):
+        self.backfill = backfill
+        self.cursor = None
+        self._at_cursor = set()
+        self._aware = True
+
+    def _start(self):
+        if self._aware:
+            return datetime.now(timezone.utc) - timedelta(seconds=self.backfill)
+        return datetime.utcnow() - timedelta(seconds=self.backfill)
+
+    def fetch(self, rcl):
+        since = self.cursor if self.cursor is not None else self._start()
+        try:
+            records = rcl.db_query({'completed': {'$gte': since}}, keys=KEYS)
+        except Exception as e:
+            # raised by the hub comparing aware and naive timestamps
+            if self.cursor is not None or not self._aware or \
+                    getattr(e, 'ename', type(e).__name__) != 'TypeError':
+                raise
+            # hub with naive timestamps
+            self._aware = False
+            records = rcl.db_query({'completed': {'$gte': self._start()}}, keys=KEYS)
+
+        new = [r for r in records if r['msg_id'] not in self._at_cursor and r.get('completed') is not None]
+        if new:
+            latest = max(r['completed'] for r in new)
+            if latest != self.cursor:
+                self._at_cursor = set()
+            self.cursor = latest
+            self._at_cursor.update(r['msg_id'] for r in new if r['completed'] == latest)
+        return new
+
+
+class TaskStats:
+    '''
+    Rolling task accounting over the last `window` seconds: throughput,
+    time waited in the queues (submitted to started), run time (started to
+    completed) and throughput per engine.
+
+    Records are placed in the window by the time they are received, the
+    Hub timestamps are only used for durations (their timezone depends on
+    the ipyparallel version).
+    '''
+
+    def __init__(self, window=300.):
+        self.window = window
+        self.tasks = deque()  # (received, engine, wait, runtime)
+        self.n_total = 0
+
+    def add(self, records, engine_ids=None, now=None):
+        now = time.time() if now is None else now
+        engine_ids = engine_ids or {}
+        for r in records:
+            submitted, started, completed = r.get('submitted'), r.get('started'), r.get('completed')
+            wait = (started - submitted).total_seconds() if started and submitted else None
+            runtime = (completed - started).total_seconds() if started and completed else None
+            engine = engine_ids.get(r.get('engine_uuid'), r.get('engine_uuid'))
+            self.tasks.append((now, engine, wait, runtime))
+        self.n_total += len(records)
+        self._expire(now)
+
+    def _expire(self, now):
+        while self.tasks and now - self.tasks[0][0] > self.window:
+            self.tasks.popleft()
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        counts = Counter()
+        runtimes = defaultdict(float)
+        for _, engine, _, runtime in self.tasks:
+            counts[engine] += 1
+            runtimes[engine] += runtime or 0.
+        ranking = [
+            {
+                'engine': engine,
+                'tasks': n,
+                'rate': n / self.window,
+                'runtime_mean': runtimes[engine] / n,
+            }
+            for engine, n in counts.most_common()
+        ]
+        return {
+            'window': self.window,
+            'completed': self.n_total,
+            'rate': len(self.tasks) / self.window,
+            'wait_s': _percentiles([t[2] for t in self.tasks if t[2] is not None]),
+            'runtime_s': _percentiles([t[3] for t in self.tasks if t[3] is not None]),
+            'engines': ranking,
+        }
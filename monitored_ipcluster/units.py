@@ -0,0 +1,23 @@
+import re
+
+SIZE_UNITS = {
+    '': 1, 'b': 1,
+    'k': 1024, 'kb': 1024,
+    'm': 1024 ** 2, 'mb': 1024 ** 2,
+    'g': 1024 ** 3, 'gb': 1024 ** 3,
+    't': 1024 ** 4, 'tb': 1024 ** 4,
+}
+
+_size_re = re.compile(r'^\s*([0-9.eE+-]+)\s*([a-zA-Z]*)\s*$')
+
+
+def parse_size(x):
+    '''
+    Parses sizes like 512, 800MB, 8GB, 1.5t into bytes.
+    '''
+    if isinstance(x, (int, float)):
+        return x
+    m = _size_re.match(x)
+    if m is None or m.group(2).lower() not in SIZE_UNITS:
+        raise ValueError('Invalid size: {}'.format(x))
+    return float(m.group(1)) * SIZE_UNITS[m.group(2).lower()]
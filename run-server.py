@@ -1,4 +1,81 @@
+import argparse
 from monitored_ipcluster.server import server_loop
+from monitored_ipcluster.sharding import sharded_server
 
 if __name__ == '__main__':
-    server_loop()
+    parser = argparse.ArgumentParser(description='Monitored Ipyparallel Cluster control server')
+    parser.add_argument('--state-dir', type=str,
+                        help='directory for state snapshots and the request log (default: no persistence)')
+    parser.add_argument('--snapshot-interval', type=float, default=30.0,
+                        help='seconds between state snapshots (default: 30)')
+    parser.add_argument('--archive-dir', type=str,
+                        help='directory of the on-disk metrics archive (default: no archive)')
+    parser.add_argument('--no-analysis', action='store_true',
+                        help='disable straggler and hot-spot detection')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='disable the timing of the server hot paths (see mipc.py stats)')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='split the clients among this many server processes, for very large '
+                             'clusters; the autoscaler is not available (default: 0, a single process)')
+    memory = parser.add_argument_group('memory guard (disabled unless a limit is set)')
+    memory.add_argument('--engine-rss-max', type=str, help='restart engines above this rss, e.g. 8GB')
+    memory.add_argument('--engine-growth-max', type=str,
+                        help='restart engines growing faster than this per second, e.g. 20MB')
+    memory.add_argument('--host-rss-max', type=str, help='limit on the total engines rss of a host')
+    memory.add_argument('--host-available-min', type=str,
+                        help='memory to keep available on each host, e.g. 4GB or 0.1 (fraction)')
+    memory.add_argument('--host-swap-max', type=str, help='swap usage that triggers restarts')
+    memory.add_argument('--idle-wait', type=float, default=60.,
+                        help='seconds to wait for busy engines to become idle (default: 60)')
+    probe = parser.add_argument_group('scheduler health probe')
+    probe.add_argument('--no-probe', action='store_true', help='disable the controller latency probe')
+    probe.add_argument('--probe-interval', type=float, default=1., help='seconds between probes (default: 1)')
+    probe.add_argument('--scheduler-slo', type=float,
+                       help='restart the scheduler when the percentile of the probe latency exceeds '
+                            'this many ms (default: never)')
+    probe.add_argument('--slo-percentile', type=int, default=90,
+                       help='percentile of the probe latency checked against the SLO (default: 90)')
+    probe.add_argument('--slo-sustain', type=float, default=30.,
+                       help='seconds the SLO must be breached before restarting (default: 30)')
+    scaling = parser.add_argument_group('autoscaling')
+    scaling.add_argument('--autoscale', action='store_true', help='enable the engine autoscaler')
+    scaling.add_argument('--min-engines', type=int, default=1)
+    scaling.add_argument('--max-engines', type=int, default=64)
+    scaling.add_argument('--launcher', type=str, default='local',
+                         help='"local" to start engines on this host, or a shell command '
+                              'formatted with the number of engines {n} (default: local)')
+    args = parser.parse_args()
+
+    memguard_options = {
+        k: getattr(args, k) for k in
+        ('engine_rss_max', 'engine_growth_max', 'host_rss_max', 'host_available_min', 'host_swap_max')
+        if getattr(args, k) is not None
+    }
+    if memguard_options:
+        memguard_options['idle_wait'] = args.idle_wait
+
+    options = dict(
+        state_dir=args.state_dir,
+        snapshot_interval=args.snapshot_interval,
+        archive_dir=args.archive_dir,
+        analysis_options=False if args.no_analysis else None,
+        memguard_options=memguard_options,
+        autoscale_options={
+            'launcher': args.launcher,
+            'min_engines': args.min_engines,
+            'max_engines': args.max_engines,
+        } if args.autoscale else None,
+        instrument=not args.no_stats,
+        probe_options=False if args.no_probe else {
+            'interval': args.probe_interval,
+            'slo_ms': args.scheduler_slo,
+            'sustain': args.slo_sustain,
+            'percentile': args.slo_percentile,
+        },
+    )
+    if not 0 < args.slo_percentile <= 100:
+        parser.error('--slo-percentile must be between 1 and 100')
+    if args.shards > 0:
+        sharded_server(args.shards, **options)
+    else:
+        server_loop(**options)
@@ -1,6 +1,25 @@
+import os
 import sys
 from monitored_ipcluster.client import main
 
 if __name__ == '__main__':
     cmd = 'ipengine "{}" > /dev/null 2> /dev/null'.format('" "'.join(sys.argv[1:]))
-    main(cmd=cmd, ptype='worker')
+    # MIPC_STANDBY: warm engines kept on this host for fast restarts,
+    # importing the MIPC_STANDBY_PRELOAD modules (comma separated) in advance
+    standby_cmd = '"{}" "{}" --preload "{}" -- {}'.format(
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'monitored_ipcluster', 'standby.py'),
+        os.environ.get('MIPC_STANDBY_PRELOAD', ''),
+        cmd,
+    )
+    # MIPC_PLACEMENT: compact, spread or per-socket to pin the engine
+    # MIPC_CGROUP=1: account and limit the engine with cgroup v2
+    main(
+        cmd=cmd,
+        ptype='worker',
+        placement=os.environ.get('MIPC_PLACEMENT'),
+        cores_per_engine=int(os.environ.get('MIPC_CORES_PER_ENGINE', 1)),
+        cgroup=os.environ.get('MIPC_CGROUP', '0') not in ('', '0'),
+        standby=int(os.environ.get('MIPC_STANDBY', 0)),
+        standby_cmd=standby_cmd,
+    )
@@ -0,0 +1,67 @@
+import pytest
+
+from monitored_ipcluster.archive import MetricsArchive, query, DAY
+
+T0 = 20000 * DAY
+
+
+@pytest.fixture
+def archive_path(tmp_path):
+    path = str(tmp_path)
+    archive = MetricsArchive(path)
+    for i in range(6):
+        # two engines, one sample every 5 s, the last two on the next day
+        t = T0 - 15 + 5 * i
+        archive.append({'uid': 'e1', 'host': 'h1', 'type': 'worker', 'pcpu': 10. * i, 'rss': 100.}, now=t)
+        archive.append({'uid': 'e2', 'host': 'h2', 'type': 'worker', 'pcpu': 1., 'net': 5.}, now=t + 1)
+    archive.close()
+    return path
+
+
+def test_single_bucket(archive_path):
+    r = query(archive_path, T0 - 100, T0 + 100)
+    assert r['rows'] == 12
+    assert r['groups'] == [T0 - 100]
+    assert r['pcpu']['count'] == [12]
+    assert r['pcpu']['sum'] == [150. + 6.]
+    assert r['pcpu']['min'] == [0.] and r['pcpu']['max'] == [50.]
+    # missing metrics are not counted
+    assert r['rss']['count'] == [6] and r['rss']['mean'] == [100.]
+    assert r['disk_io']['count'] == [0] and r['disk_io']['mean'] == [None]
+
+
+def test_time_buckets(archive_path):
+    r = query(archive_path, T0 - 20, T0 + 20, metrics=('pcpu',), bucket=10)
+    assert r['groups'] == [T0 - 20, T0 - 10, T0, T0 + 10]
+    assert r['pcpu']['count'] == [2, 4, 4, 2]
+    assert r['pcpu']['max'] == [1., 20., 40., 50.]
+
+
+def test_range(archive_path):
+    r = query(archive_path, T0, T0 + 6, metrics=('pcpu',))
+    assert r['rows'] == 3
+    assert r['pcpu']['sum'] == [30. + 1. + 40.]
+    assert query(archive_path, T0 + 100, T0 + 200)['groups'] == []
+
+
+def test_by_engine(archive_path):
+    r = query(archive_path, T0 - 100, T0 + 100, metrics=('pcpu', 'net'), by='engine')
+    assert r['groups'] == ['e1', 'e2']
+    assert r['pcpu']['mean'] == [25., 1.]
+    assert r['net']['count'] == [0, 6]
+
+
+def test_filters(archive_path):
+    r = query(archive_path, T0 - 100, T0 + 100, metrics=('pcpu',), uids=['e2'])
+    assert r['rows'] == 6 and r['pcpu']['sum'] == [6.]
+    r = query(archive_path, T0 - 100, T0 + 100, metrics=('pcpu',), by='engine', hosts=['h1'])
+    assert r['groups'] == ['e1'] and r['pcpu']['max'] == [50.]
+
+
+def test_reopen(archive_path):
+    archive = MetricsArchive(archive_path)
+    assert archive.engine_id('e2') == 1
+    archive.append({'uid': 'e3', 'pcpu': 7.}, now=T0 + 50)
+    archive.close()
+    r = query(archive_path, T0 - 100, T0 + 100, metrics=('pcpu',), by='engine')
+    assert r['groups'] == ['e1', 'e2', 'e3'] and r['pcpu']['sum'] == [150., 6., 7.]
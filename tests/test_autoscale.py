@@ -0,0 +1,147 @@
+from monitored_ipcluster.autoscale import Autoscaler, CommandLauncher, make_launcher
+
+# the controller starts out of cooldown
+T0 = 1000.
+
+
+class FakeLauncher:
+
+    def __init__(self):
+        self.requests = []
+
+    def launch(self, n):
+        self.requests.append(n)
+
+
+def status(n_workers, n_working=0, n_pending=0, connected=True):
+    return {
+        'status': 'connected' if connected else 'disconnected',
+        'n_workers': n_workers,
+        'n_working': n_working,
+        'n_pending': n_pending,
+    }
+
+
+def autoscaler(**options):
+    opt = dict(up_window=10, down_window=60, cooldown=30, up_step=8, max_engines=20, min_engines=2)
+    opt.update(options)
+    return Autoscaler(FakeLauncher(), **opt)
+
+
+def no_workers(uid):
+    return None
+
+
+def test_scale_up_after_window():
+    a = autoscaler()
+    # 4 busy engines, 20 waiting tasks
+    st = status(4, n_working=4, n_pending=24)
+    assert a.tick(st, {}, no_workers, now=T0 + 0) == []
+    assert a.tick(st, {}, no_workers, now=T0 + 9) == []
+    assert a.launcher.requests == []
+    a.tick(st, {}, no_workers, now=T0 + 10)
+    # ceil(20 / up_ratio) engines, capped by up_step
+    assert a.launcher.requests == [8]
+    assert a.summary(now=T0 + 10)['in_flight'] == 8
+    assert a.history[-1]['action'] == 'up'
+
+
+def test_scale_up_hysteresis():
+    a = autoscaler()
+    a.tick(status(4, 4, 24), {}, no_workers, now=T0 + 0)
+    # pressure gone for a moment: the window starts again
+    a.tick(status(4, 4, 4), {}, no_workers, now=T0 + 5)
+    a.tick(status(4, 4, 24), {}, no_workers, now=T0 + 6)
+    a.tick(status(4, 4, 24), {}, no_workers, now=T0 + 15)
+    assert a.launcher.requests == []
+    a.tick(status(4, 4, 24), {}, no_workers, now=T0 + 16)
+    assert a.launcher.requests == [8]
+
+
+def test_in_flight_launches_count():
+    a = autoscaler(cooldown=0, up_step=100, max_engines=100)
+    st = status(4, n_working=4, n_pending=24)
+    a.tick(st, {}, no_workers, now=T0 + 0)
+    a.tick(st, {}, no_workers, now=T0 + 10)
+    assert a.launcher.requests == [10]
+    # the requested engines have not registered yet: nothing more
+    a.tick(st, {}, no_workers, now=T0 + 20)
+    a.tick(st, {}, no_workers, now=T0 + 30)
+    assert a.launcher.requests == [10]
+    # 6 of them registered, 4 still in flight
+    a.tick(status(10, 4, 24), {}, no_workers, now=T0 + 40)
+    assert a.in_flight(T0 + 40) == 4
+    # in flight requests time out
+    assert a.in_flight(T0 + 10 + 600) == 0
+
+
+def test_max_engines():
+    a = autoscaler(max_engines=6)
+    st = status(4, n_working=4, n_pending=100)
+    a.tick(st, {}, no_workers, now=T0 + 0)
+    a.tick(st, {}, no_workers, now=T0 + 10)
+    assert a.launcher.requests == [2]
+    a.tick(st, {}, no_workers, now=T0 + 100)
+    assert a.launcher.requests == [2]
+
+
+def test_cooldown():
+    a = autoscaler(up_step=2)
+    st = status(4, n_working=4, n_pending=24)
+    a.tick(st, {}, no_workers, now=T0 + 0)
+    a.tick(st, {}, no_workers, now=T0 + 10)
+    a.tick(status(6, 4, 24), {}, no_workers, now=T0 + 20)
+    a.tick(status(6, 4, 24), {}, no_workers, now=T0 + 39)
+    assert a.launcher.requests == [2]
+    a.tick(status(6, 4, 24), {}, no_workers, now=T0 + 40)
+    assert a.launcher.requests == [2, 2]
+
+
+def test_scale_down_idle_engines_only():
+    a = autoscaler(idle_reserve=0.)
+    queues = {'e{}'.format(i): 0 for i in range(8)}
+    queues.update(e0=3, e1=1, e2=None)
+    workers = dict.fromkeys(queues, {})
+    # 2 busy engines out of 8, nothing waiting
+    st = status(8, n_working=2, n_pending=2)
+    assert a.tick(st, workers, queues.get, now=T0 + 0) == []
+    assert a.tick(st, workers, queues.get, now=T0 + 59) == []
+    retired = a.tick(st, workers, queues.get, now=T0 + 60)
+    # engines with tasks or unknown queues are kept
+    assert retired == ['e3', 'e4', 'e5', 'e6', 'e7']
+    assert a.history[-1] == {'time': T0 + 60, 'action': 'down', 'n': 5}
+
+
+def test_scale_down_keeps_min_and_reserve():
+    a = autoscaler(idle_reserve=.25, min_engines=6, cooldown=0)
+    queues = {'e{}'.format(i): 0 for i in range(8)}
+    workers = dict.fromkeys(queues, {})
+    st = status(8)
+    a.tick(st, workers, queues.get, now=T0 + 0)
+    assert a.tick(st, workers, queues.get, now=T0 + 60) == ['e0', 'e1']
+    # the retiring engines are not picked again
+    a.tick(st, workers, queues.get, now=T0 + 61)
+    assert a.tick(st, workers, queues.get, now=T0 + 121) == ['e2', 'e3']
+
+
+def test_waiting_tasks_prevent_scale_down():
+    a = autoscaler()
+    queues = {'e{}'.format(i): 0 for i in range(8)}
+    workers = dict.fromkeys(queues, {})
+    for now in range(0, 200, 10):
+        assert a.tick(status(8, n_working=1, n_pending=2), workers, queues.get, now=T0 + now) == []
+
+
+def test_disconnected():
+    a = autoscaler()
+    st = status(4, n_working=4, n_pending=24)
+    a.tick(st, {}, no_workers, now=T0 + 0)
+    assert a.tick(status(4, connected=False), {}, no_workers, now=T0 + 5) == []
+    a.tick(st, {}, no_workers, now=T0 + 10)
+    assert a.launcher.requests == []
+
+
+def test_make_launcher():
+    assert isinstance(make_launcher('start_ipcluster {n}'), CommandLauncher)
+    fake = FakeLauncher()
+    assert make_launcher(fake) is fake
@@ -0,0 +1,94 @@
+import pytest
+
+from monitored_ipcluster import cgroups
+
+CPU_STAT = '''usage_usec 2500000
+user_usec 2000000
+system_usec 500000
+nr_periods 0
+nr_throttled 0
+throttled_usec 0
+'''
+
+MEMORY_STAT = '''anon 104857600
+file 52428800
+kernel_stack 163840
+shmem 0
+'''
+
+IO_STAT = '''8:0 rbytes=1048576 wbytes=2097152 rios=10 wios=20 dbytes=0 dios=0
+259:0 rbytes=4096 wbytes=0 rios=1 wios=0 dbytes=0 dios=0
+'''
+
+
+def write_files(path, **files):
+    for name, text in files.items():
+        (path / name.replace('_', '.', 1)).write_text(text)
+
+
+@pytest.fixture
+def group(tmp_path):
+    write_files(
+        tmp_path,
+        cpu_stat=CPU_STAT,
+        memory_stat=MEMORY_STAT,
+        memory_current='167772160\n',
+        memory_peak='209715200\n',
+        memory_max='max\n',
+        io_stat=IO_STAT,
+    )
+    return tmp_path
+
+
+def test_read_usage(group):
+    assert cgroups.read_usage(str(group)) == {
+        'cpu': 2.5,
+        'mem_current': 160 * 1024**2,
+        'mem_peak': 200 * 1024**2,
+        'anon': 100 * 1024**2,
+        'io': 1048576 + 2097152 + 4096,
+    }
+
+
+def test_missing_peak_and_io(group):
+    # kernels before 5.19, io controller not enabled
+    (group / 'memory.peak').unlink()
+    (group / 'io.stat').unlink()
+    usage = cgroups.read_usage(str(group))
+    assert 'mem_peak' not in usage and usage['io'] == 0
+    data = cgroups.get_cgroup_data(str(group), {}, 0.)
+    assert 'mem_peak' not in data and data['rss'] == 100 * 1024**2
+
+
+def test_get_cgroup_data_rates(group):
+    prev = {}
+    data = cgroups.get_cgroup_data(str(group), prev, 100.)
+    assert data == {
+        'pcpu': 0.,
+        'disk_io': 0,
+        'rss': 100 * 1024**2,
+        'mem_current': 160 * 1024**2,
+        'mem_peak': 200 * 1024**2,
+    }
+    (group / 'cpu.stat').write_text(CPU_STAT.replace('2500000', '4500000'))
+    (group / 'io.stat').write_text('8:0 rbytes=2048576 wbytes=2097152 rios=10 wios=20\n')
+    (group / 'memory.max').write_text('4294967296\n')
+    data = cgroups.get_cgroup_data(str(group), prev, 104.)
+    # 2 cpu seconds in 4 s; 1e6 more bytes read on 8:0, 259:0 is gone
+    assert data['pcpu'] == pytest.approx(50.)
+    assert data['disk_io'] == (1000000 - 4096) // 4
+    assert data['mem_max'] == 4 * 1024**3
+
+
+def test_missing_cgroup(tmp_path):
+    with pytest.raises(OSError):
+        cgroups.get_cgroup_data(str(tmp_path / 'gone'), {}, 0.)
+
+
+def test_set_limits(group):
+    cgroups.set_limits(str(group), memory_max=2 * 1024**3, cpu_max=1.5)
+    assert (group / 'memory.max').read_text() == str(2 * 1024**3)
+    assert (group / 'cpu.max').read_text() == '150000 100000'
+    cgroups.set_limits(str(group), memory_max='max', cpu_max='max')
+    assert (group / 'memory.max').read_text() == 'max'
+    assert (group / 'cpu.max').read_text() == 'max 100000'
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import logging
+import functools
+from multiprocessing import Value
+
+from monitored_ipcluster import client, appmetrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# preloads its metrics like a MIPC_STANDBY_PRELOAD module would
+STANDBY = '''
+import sys, time
+from monitored_ipcluster import appmetrics
+preloaded = appmetrics.metric('preloaded')
+preloaded.set(1)
+if sys.stdin.readline().strip() != 'start':
+    sys.exit(0)
+preloaded.add(1)
+appmetrics.metric('tasks').add(2)
+time.sleep(60)
+'''
+
+
+def make_ctx(tmp_path, pid):
+    return {
+        'uid': 'u1',
+        'type': 'worker',
+        'crashes': Value('i', 0),
+        'preempted': Value('i', 0),
+        'warm_starts': Value('i', 0),
+        'acked': Value('q', 0),
+        'pid': Value('i', pid),
+        'retcode': Value('i', -10000),
+        'standby_pid': Value('i', -1),
+        'placement': None,
+        'metrics_paths': (str(tmp_path / 'engine.metrics'), str(tmp_path / 'standby.metrics')),
+        'metrics_current': Value('b', 0),
+        'cgroup': str(tmp_path / 'missing'),
+    }
+
+
+def test_unreadable_cgroup_falls_back_to_pstree(tmp_path, monkeypatch):
+    monkeypatch.setattr(client, 'get_pstree_data', lambda pid: {'pcpu': 1., 'rss': 2})
+    # the communication loop has no ctx['logger']
+    data = client.get_process_details(make_ctx(tmp_path, 12345))
+    assert data['status'] == 'running' and data['pid'] == 12345
+    assert data['pcpu'] == 1. and data['rss'] == 2
+
+
+def test_dead_engine(tmp_path):
+    data = client.get_process_details(make_ctx(tmp_path, -1))
+    assert data['status'] == 'dead' and data['returncode'] == -10000
+    assert data['uid'] == 'u1' and 'host_mem_total' in data
+
+
+def wait_for(f, timeout=10.):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        out = f()
+        if out:
+            return out
+        time.sleep(.05)
+    raise AssertionError('timed out')
+
+
+def test_standby_metrics(tmp_path, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', ROOT)
+    monkeypatch.setattr(client, 'acquire_slot', functools.partial(client.acquire_slot, directory=str(tmp_path)))
+    script = tmp_path / 'standby.py'
+    script.write_text(STANDBY)
+    ctx = make_ctx(tmp_path, -1)
+    ctx.update({
+        'logger': logging.getLogger('TEST'),
+        'standby': None,
+        'standby_retry': 0,
+        'standby_max': 1,
+        'standby_cmd': '"{}" "{}"'.format(sys.executable, script),
+        'cgroup': None,
+    })
+    engine_file, standby_file = ctx['metrics_paths']
+    appmetrics.create(engine_file)
+    appmetrics.MetricsWriter(engine_file).metric('old').set(5)
+
+    client.start_standby(ctx)
+    try:
+        wait_for(lambda: appmetrics.MetricsReader(standby_file).read().get('preloaded'))
+        # the live engine file is untouched by the standby
+        assert client.read_app_metrics(ctx) == {'old': 5.}
+
+        assert client.promote_standby(ctx)
+        assert ctx['warm_starts'].value == 1 and ctx['standby'] is None
+        assert client.engine_metrics_path(ctx) == standby_file
+        assert wait_for(lambda: 'tasks' in client.read_app_metrics(ctx) and client.read_app_metrics(ctx)) == \
+            {'preloaded': 2., 'tasks': 2.}
+    finally:
+        proc = ctx['subproc'] if ctx['standby'] is None else ctx['standby']['proc']
+        proc.kill()
+        proc.wait()
+    # the next standby takes the file of the old engine
+    assert client.standby_metrics_path(ctx) == engine_file
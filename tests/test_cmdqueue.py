@@ -0,0 +1,89 @@
+from monitored_ipcluster.cmdqueue import CommandQueue
+from monitored_ipcluster.messages import REQ_EXIT, REQ_RESTART, REQ_PREEMPT, REQ_START, REQ_PROFILE
+
+
+def codes(q, uid):
+    return [e['req'] for e in q.pending(uid, now=0)]
+
+
+def test_exit_supersedes_everything():
+    q = CommandQueue()
+    q.push('a', REQ_START, now=0)
+    q.push('a', {'req': REQ_PROFILE, 'job': 'x'}, now=0)
+    q.push('a', REQ_EXIT, now=0)
+    assert codes(q, 'a') == [REQ_EXIT]
+    # nothing is queued after an exit
+    assert q.push('a', REQ_RESTART, now=0) is None
+    assert codes(q, 'a') == [REQ_EXIT]
+    assert q.n_coalesced == 3
+
+
+def test_one_restart_is_enough():
+    q = CommandQueue()
+    q.push('a', REQ_START, now=0)
+    q.push('a', REQ_RESTART, now=0)
+    assert codes(q, 'a') == [REQ_RESTART]
+    assert q.push('a', REQ_PREEMPT, now=0) is None
+    assert q.push('a', REQ_START, now=0) is None
+    assert codes(q, 'a') == [REQ_RESTART]
+
+
+def test_identical_requests_coalesce():
+    q = CommandQueue()
+    q.push('a', {'req': REQ_PROFILE, 'job': 'x'}, now=0)
+    assert q.push('a', {'req': REQ_PROFILE, 'job': 'x'}, now=0) is None
+    assert q.push('a', {'req': REQ_PROFILE, 'job': 'y'}, now=0) is not None
+    assert len(codes(q, 'a')) == 2
+
+
+def test_ack():
+    q = CommandQueue()
+    e1 = q.push('a', {'req': REQ_PROFILE, 'job': 1}, now=0)
+    e2 = q.push('a', {'req': REQ_PROFILE, 'job': 2}, now=0)
+    assert e2['seq'] > e1['seq']
+    q.ack('a', e1['seq'])
+    assert [e['seq'] for e in q.pending('a', now=0)] == [e2['seq']]
+    # acknowledging an older sequence number again changes nothing
+    q.ack('a', e1['seq'])
+    assert len(q.pending('a', now=0)) == 1
+    q.ack('a', e2['seq'])
+    assert q.pending('a', now=0) == []
+    assert 'a' not in q.queues
+
+
+def test_ttl():
+    q = CommandQueue(ttl=10)
+    q.push('a', REQ_START, now=0)
+    q.push('a', {'req': REQ_PROFILE, 'job': 1}, now=5)
+    assert len(q.pending('a', now=9)) == 2
+    assert len(q.pending('a', now=12)) == 1
+    assert q.pending('a', now=20) == []
+    assert q.n_expired == 2
+
+
+def test_max_len_drops_the_oldest():
+    q = CommandQueue(max_len=3)
+    for job in range(5):
+        q.push('a', {'req': REQ_PROFILE, 'job': job}, now=0)
+    assert [e['req']['job'] for e in q.pending('a', now=0)] == [2, 3, 4]
+    assert q.n_dropped == 2
+
+
+def test_log():
+    ops = []
+    q = CommandQueue(log=lambda op, uid, arg: ops.append((op, uid)))
+    e = q.push('a', REQ_START, now=0)
+    q.push('a', REQ_EXIT, now=0)
+    q.ack('a', e['seq'] + 1)
+    q.push('b', REQ_START, now=0)
+    q.clear('b')
+    assert ops == [('push', 'a'), ('drop', 'a'), ('push', 'a'), ('ack', 'a'), ('push', 'b'), ('clear', 'b')]
+
+
+def test_restore():
+    q = CommandQueue()
+    q.restore({'a': [{'seq': q._seq + 100, 'req': REQ_START, 'time': 0}, REQ_EXIT]})
+    seqs = [e['seq'] for e in q.queues['a']]
+    # requests saved without a sequence number get one after the others
+    assert seqs[1] > seqs[0]
+    assert q.push('b', REQ_START)['seq'] > seqs[1]
@@ -0,0 +1,92 @@
+import pytest
+
+from monitored_ipcluster import server
+from monitored_ipcluster.drain import DrainRegistry
+
+
+def queues(**kw):
+    return kw.get
+
+
+def stopped(out):
+    return [(uid, reason) for uid, _, reason in out]
+
+
+def test_idle_and_deadline():
+    drains = DrainRegistry()
+    drains.start(['a', 'b', 'c'], deadline=10, now=0)
+    out = drains.check(queues(a=0, b=2, c=None), now=5)
+    assert stopped(out) == [('a', 'idle')]
+    assert drains.is_draining('b') and drains.is_draining('c')
+    out = drains.check(queues(b=2, c=None), now=11)
+    assert stopped(out) == [('b', 'deadline'), ('c', 'deadline')]
+    assert not drains.active
+
+
+def test_untracked_and_unknown_status():
+    drains = DrainRegistry()
+    drains.start(['a', 'b'], action='exit', now=0)
+    # status temporarily unknown: wait
+    assert drains.check(queues(), tracked=True, now=1) == []
+    # ipyparallel not monitored: nothing to wait for
+    assert drains.check(queues(), tracked=False, now=2) == [('a', 'exit', 'untracked'), ('b', 'exit', 'untracked')]
+
+
+def test_rolling_slots_released_on_ack():
+    drains = DrainRegistry()
+    pending = {'a': True}
+    drains.start(['a', 'b', 'c'], parallel=1, now=0)
+    assert list(drains.active) == ['a']
+    assert stopped(drains.check(queues(a=0), pending=pending.get, now=1)) == [('a', 'idle')]
+    # restart not acknowledged yet: the slot stays taken
+    assert drains.check(queues(), pending=pending.get, now=2) == []
+    assert list(drains.active) == [] and drains.stopping == {'a': 1}
+    pending['a'] = False
+    assert drains.check(queues(b=1), pending=pending.get, now=3) == []
+    assert list(drains.active) == ['b'] and drains.active['b']['since'] == 3
+    assert stopped(drains.check(queues(b=0), now=4)) == [('b', 'idle')]
+    drains.check(queues(), now=5)
+    assert stopped(drains.check(queues(c=0), now=6)) == [('c', 'idle')]
+    drains.check(queues(), now=7)
+    assert not drains.waiting and not drains.parallel and not drains.stopping
+
+
+def test_cancel_and_forget_refill():
+    drains = DrainRegistry()
+    drains.start(['a', 'b', 'c', 'd'], parallel=1, now=0)
+    assert drains.cancel({'a', 'c'}) == 2
+    assert list(drains.active) == ['b']
+    drains.forget('b')
+    assert list(drains.active) == ['d']
+    drains.forget('d')
+    assert not drains.active and not drains.waiting
+
+
+def test_engines_drained_once():
+    drains = DrainRegistry()
+    drains.start(['a'], now=0)
+    drains.start(['a', 'b'], parallel=None, now=1)
+    assert list(drains.active) == ['a', 'b'] and drains.active['a']['drain'] == 1
+
+
+@pytest.fixture
+def drained(monkeypatch):
+    monkeypatch.setattr(server, 'drains', DrainRegistry())
+    monkeypatch.setattr(server, 'request_queue', server.CommandQueue())
+    monkeypatch.setattr(server, 'ipp_status', {})
+    monkeypatch.setattr(server, 'engine_ids', {})
+    server.drains.start(['a'], deadline=60)
+    return server.drains
+
+
+def test_server_waits_for_status(drained, monkeypatch):
+    # just started, or the controller timed out
+    monkeypatch.setattr(server, 'ipp_monitored', True)
+    server.check_drains()
+    assert drained.is_draining('a') and not server.request_queue.queues.get('a')
+
+
+def test_server_without_ipyparallel(drained, monkeypatch):
+    monkeypatch.setattr(server, 'ipp_monitored', False)
+    server.check_drains()
+    assert not drained.is_draining('a') and server.request_queue.queues.get('a')
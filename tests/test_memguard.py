@@ -0,0 +1,149 @@
+from monitored_ipcluster.memguard import MemoryGuard
+
+GB = 1024**3
+
+
+def engine(rss, host='h1', pid=1, **kw):
+    return dict({'host': host, 'pid': pid, 'rss': rss, 'status': 'running', '_lastreq': 0}, **kw)
+
+
+def feed(guard, workers, now):
+    for uid, w in workers.items():
+        guard.update(uid, w, now=now)
+
+
+def idle(uid):
+    return 0
+
+
+def busy(uid):
+    return 1
+
+
+def test_engine_rss_max():
+    guard = MemoryGuard(engine_rss_max='4GB')
+    workers = {'a': engine(5 * GB), 'b': engine(1 * GB)}
+    feed(guard, workers, 0)
+    assert guard.check(workers, idle, now=0) == [('a', 'engine_rss')]
+    assert guard.summary()['restarts'] == {'engine_rss': 1}
+    assert guard.history[-1]['uid'] == 'a' and guard.history[-1]['rss'] == 5 * GB
+
+
+def test_projected_growth():
+    guard = MemoryGuard(engine_rss_max='4GB', horizon=100, growth_alpha=1.)
+    workers = {'a': engine(2 * GB)}
+    feed(guard, workers, 0)
+    assert guard.check(workers, idle, now=0) == []
+    # 10 MB/s: the limit is not reached within the horizon
+    workers['a']['rss'] += 100 * 1024**2
+    feed(guard, workers, 10)
+    assert guard.check(workers, idle, now=10) == []
+    # 30 MB/s: it is
+    workers['a']['rss'] += 300 * 1024**2
+    feed(guard, workers, 20)
+    assert guard.check(workers, idle, now=20) == [('a', 'engine_projected')]
+
+
+def test_growth_max():
+    guard = MemoryGuard(engine_growth_max='1MB', growth_alpha=1.)
+    workers = {'a': engine(GB)}
+    feed(guard, workers, 0)
+    workers['a']['rss'] += 20 * 1024**2
+    feed(guard, workers, 10)
+    assert guard.check(workers, idle, now=10) == [('a', 'engine_growth')]
+
+
+def test_pid_change_resets_growth():
+    guard = MemoryGuard(engine_growth_max='1MB', growth_alpha=1.)
+    workers = {'a': engine(GB)}
+    feed(guard, workers, 0)
+    # a new engine: the rss difference is not growth
+    workers['a'] = engine(2 * GB, pid=2)
+    feed(guard, workers, 10)
+    assert guard.growth['a'][2] == 0.
+    assert guard.check(workers, busy, now=10) == []
+    # neither is a dead engine followed by a new one
+    guard.update('a', {'pid': 2}, now=20)
+    assert 'a' not in guard.growth
+    feed(guard, {'a': engine(3 * GB, pid=3)}, 30)
+    assert guard.growth['a'][2] == 0.
+
+
+def test_gone_clients_forgotten():
+    guard = MemoryGuard(engine_rss_max='4GB', cooldown=1000)
+    workers = {'a': engine(5 * GB)}
+    feed(guard, workers, 0)
+    assert guard.check(workers, idle, now=0) == [('a', 'engine_rss')]
+    assert guard.check({}, idle, now=1) == []
+    assert not guard.growth and not guard.last_restart
+
+
+def test_idle_wait_and_critical():
+    guard = MemoryGuard(engine_rss_max='4GB', idle_wait=60, critical_factor=1.5)
+    workers = {'a': engine(5 * GB), 'b': engine(7 * GB)}
+    feed(guard, workers, 0)
+    # b is above the limit * critical_factor: no waiting
+    assert guard.check(workers, busy, now=0) == [('b', 'engine_rss')]
+    assert guard.summary()['pending'] == {'a': 'engine_rss'}
+    assert guard.check(workers, busy, now=59) == []
+    assert guard.check(workers, busy, now=60) == [('a', 'engine_rss')]
+    assert guard.pending == {}
+
+
+def test_pending_dropped_when_back_under_limit():
+    guard = MemoryGuard(engine_rss_max='4GB', idle_wait=60)
+    workers = {'a': engine(4.5 * GB)}
+    feed(guard, workers, 0)
+    assert guard.check(workers, busy, now=0) == []
+    workers['a']['rss'] = GB
+    feed(guard, workers, 10)
+    assert guard.check(workers, busy, now=10) == [] and guard.pending == {}
+    workers['a']['rss'] = 4.5 * GB
+    feed(guard, workers, 20)
+    # waits idle_wait again
+    assert guard.check(workers, busy, now=70) == []
+
+
+def test_cooldown():
+    guard = MemoryGuard(engine_rss_max='4GB', cooldown=120)
+    workers = {'a': engine(5 * GB)}
+    feed(guard, workers, 0)
+    assert guard.check(workers, idle, now=0) == [('a', 'engine_rss')]
+    assert guard.check(workers, idle, now=119) == []
+    assert guard.check(workers, idle, now=120) == [('a', 'engine_rss')]
+
+
+def test_host_excess_idle_first():
+    guard = MemoryGuard(host_rss_max='11GB', settle=30)
+    workers = {
+        'big': engine(7 * GB),
+        'idle': engine(3 * GB),
+        'small': engine(2 * GB),
+        'other_host': engine(9 * GB, host='h2'),
+        'dead': dict(engine(0), status='dead'),
+    }
+    queues = {'big': 1, 'idle': 0, 'small': 1, 'other_host': 1}
+    feed(guard, workers, 0)
+    # 12 GB on h1, 1 GB to free: the idle engine goes, although smaller
+    assert guard.check(workers, queues.get, now=0) == [('idle', 'host_memory')]
+    # until the restart shows up in the heartbeats, its memory counts as freed
+    assert guard.check(workers, queues.get, now=10) == []
+    # then the largest busy one, after idle_wait
+    assert guard.check(workers, queues.get, now=30) == []
+    assert guard.check(workers, queues.get, now=90) == [('big', 'host_memory')]
+
+
+def test_host_available_and_swap():
+    guard = MemoryGuard(host_available_min=.1, host_swap_max='1GB', critical_factor=2)
+    host = {'host_mem_total': 100 * GB, 'host_mem_available': 8 * GB, 'host_swap_used': 0}
+    workers = {'a': engine(4 * GB, **host), 'b': engine(1 * GB, **host)}
+    feed(guard, workers, 0)
+    # 2 GB short of the available target: the largest engine
+    assert guard.check(workers, busy, now=0) == []
+    assert guard.summary()['pending'] == {'a': 'host_memory'}
+
+    guard = MemoryGuard(host_available_min=.1, host_swap_max='1GB', critical_factor=2)
+    host = {'host_mem_total': 100 * GB, 'host_mem_available': 20 * GB, 'host_swap_used': 4 * GB}
+    workers = {'a': engine(4 * GB, **host), 'b': engine(1 * GB, **host)}
+    # swap beyond the limit * critical_factor: restart the busy engine now
+    assert guard.check(workers, busy, now=0) == [('a', 'host_memory')]
@@ -0,0 +1,78 @@
+import os
+import json
+
+from monitored_ipcluster.persistence import StateStore, SNAPSHOT_FILE
+
+
+def reopen(path):
+    return StateStore(str(path)).load()
+
+
+def test_empty(tmp_path):
+    assert reopen(tmp_path) == ({}, {}, {})
+
+
+def test_replay(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    for seq in (1, 2, 3):
+        store.log('push', 'a', {'seq': seq, 'code': 'restart'})
+    store.log('push', 'b', {'seq': 4, 'code': 'exit'})
+    store.log('ack', 'a', 1)
+    store.log('drop', 'a', 3)
+    store.log('clear', 'b')
+    store.log('push', 'c', {'seq': 5})
+
+    workers, scheduler, requests = reopen(tmp_path)
+    assert requests == {'a': [{'seq': 2, 'code': 'restart'}], 'c': [{'seq': 5}]}
+
+    # replayed entries are not replayed twice, new ones go after them
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.log('ack', 'a', 2)
+    assert reopen(tmp_path)[2] == {'a': [], 'c': [{'seq': 5}]}
+
+
+def test_snapshot_and_log(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.log('push', 'a', {'seq': 1})
+    store.close({'a': {'host': 'h', '_lastreq': 0}}, {}, {'a': [{'seq': 1}], 'b': []})
+    assert [f for f in os.listdir(tmp_path) if f.startswith('wal.')] == ['wal.000000000001']
+
+    store = StateStore(str(tmp_path))
+    workers, _, requests = store.load()
+    assert workers['a']['host'] == 'h' and workers['a']['_lastreq'] > 0
+    assert requests == {'a': [{'seq': 1}]}
+    store.log('push', 'a', {'seq': 2})
+    assert reopen(tmp_path)[2] == {'a': [{'seq': 1}, {'seq': 2}]}
+
+
+def test_entries_before_snapshot_skipped(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.log('push', 'a', {'seq': 1})
+    store.log('push', 'a', {'seq': 2})
+    with open(os.path.join(str(tmp_path), SNAPSHOT_FILE), 'w') as f:
+        json.dump({'seq': 1, 'workers': {}, 'scheduler': {}, 'requests': {'a': [{'seq': 1}]}}, f)
+    assert reopen(tmp_path)[2] == {'a': [{'seq': 1}, {'seq': 2}]}
+
+
+def test_truncated_log_and_corrupted_snapshot(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.log('push', 'a', {'seq': 1})
+    store._wal.write('[2, "push", "a", {"se')
+    store._wal.flush()
+    with open(os.path.join(str(tmp_path), SNAPSHOT_FILE), 'w') as f:
+        f.write('{"seq": 1, "work')
+    assert reopen(tmp_path)[2] == {'a': [{'seq': 1}]}
+
+
+def test_legacy_entries_without_seq(tmp_path):
+    store = StateStore(str(tmp_path))
+    store.load()
+    store.log('push', 'a', {'code': 'restart'})
+    store.log('push', 'a', {'seq': 5, 'code': 'exit'})
+    store.log('ack', 'a', 3)
+    assert reopen(tmp_path)[2] == {'a': [{'seq': 5, 'code': 'exit'}]}
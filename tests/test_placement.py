@@ -0,0 +1,49 @@
+import pytest
+
+from monitored_ipcluster.placement import compute_placement, n_slots, parse_cpulist, format_cpulist
+
+NODES = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+UNEVEN = {0: [0, 1, 2, 3, 4, 5], 1: [6, 7]}
+
+
+def placements(nodes, policy, cores):
+    out = []
+    for slot in range(20):
+        cpus, node = compute_placement(nodes, slot, policy, cores)
+        if cpus is None:
+            break
+        out.append((cpus, node))
+    return out
+
+
+def test_cpulist():
+    assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert format_cpulist([11, 0, 1, 2, 3, 8, 10]) == '0-3,8,10-11'
+    assert format_cpulist([]) == ''
+
+
+def test_compact():
+    assert placements(NODES, 'compact', 2) == [([0, 1], 0), ([2, 3], 0), ([4, 5], 1), ([6, 7], 1)]
+    # chunks crossing nodes are not bound to a node
+    assert placements(NODES, 'compact', 3) == [([0, 1, 2], 0), ([3, 4, 5], None)]
+    assert n_slots(NODES, 'compact', 3) == 2
+
+
+def test_spread():
+    assert placements(NODES, 'spread', 2) == [([0, 1], 0), ([4, 5], 1), ([2, 3], 0), ([6, 7], 1)]
+    # the smaller node fills first, then the others take the slots
+    assert placements(UNEVEN, 'spread', 2) == [([0, 1], 0), ([6, 7], 1), ([2, 3], 0), ([4, 5], 0)]
+    assert placements(NODES, 'spread', 3) == [([0, 1, 2], 0), ([4, 5, 6], 1)]
+    for nodes, cores in ((NODES, 2), (UNEVEN, 2), (NODES, 3), (UNEVEN, 4)):
+        assert n_slots(nodes, 'spread', cores) == len(placements(nodes, 'spread', cores))
+
+
+def test_per_socket():
+    assert [compute_placement(UNEVEN, slot, 'per-socket') for slot in range(3)] == [
+        ([0, 1, 2, 3, 4, 5], 0), ([6, 7], 1), ([0, 1, 2, 3, 4, 5], 0)]
+    assert n_slots(UNEVEN, 'per-socket') is None
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        compute_placement(NODES, 0, 'random')
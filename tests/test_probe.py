@@ -0,0 +1,203 @@
+import sys
+import json
+import time
+import types
+import uuid
+import threading
+
+import zmq
+import pytest
+
+from monitored_ipcluster.probe import HubProbe, SchedulerSLO, probe_loop
+
+
+class Session:
+    '''
+    JSON stand-in for jupyter_client.Session, enough for HubProbe.
+    '''
+    hub = None
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def send(self, sock, msg_type, content=None):
+        if self.hub.stop_probes:
+            # ends probe_loop
+            raise KeyboardInterrupt
+        msg = {'header': {'msg_id': uuid.uuid4().hex, 'msg_type': msg_type}, 'content': content}
+        sock.send(json.dumps(msg).encode())
+        return msg
+
+    def recv(self, sock, mode=0):
+        return None, json.loads(sock.recv(mode))
+
+
+class FakeHub:
+    '''
+    ROUTER answering queue requests on the registration endpoint, after
+    `delay` seconds, if `answer` is set.
+    '''
+
+    def __init__(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        self.address = 'tcp://127.0.0.1:{}'.format(port)
+        self.answer = True
+        self.delay = 0.
+        self.received = []
+        self.n_clients = 0
+        self.stop_probes = False
+        # HubProbe makes its own session of the same class
+        self.session_class = type('Session', (Session,), {'hub': self})
+        self._stop = False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop:
+            if not self.socket.poll(20):
+                continue
+            ident, raw = self.socket.recv_multipart()
+            msg = json.loads(raw)
+            self.received.append(msg['header']['msg_type'])
+            if self.answer:
+                time.sleep(self.delay)
+                reply = {'parent_header': msg['header'], 'content': {}}
+                self.socket.send_multipart([ident, json.dumps(reply).encode()])
+
+    def client(self, **kwargs):
+        # ipyparallel.Client: the probe only reads the connection info
+        self.n_clients += 1
+        return types.SimpleNamespace(
+            _config={'registration': self.address, 'key': 'secret', 'signature_scheme': 'hmac-sha256',
+                     'pack': 'json', 'unpack': 'json'},
+            session=self.session_class(),
+            close=lambda: None,
+        )
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+        self.socket.close()
+        self.context.term()
+
+
+@pytest.fixture
+def hub():
+    hub = FakeHub()
+    yield hub
+    hub.close()
+
+
+def wait_for(f, timeout=10.):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if f():
+            return
+        time.sleep(.02)
+    raise AssertionError('timed out')
+
+
+def test_ping(hub):
+    probe = HubProbe(hub.client())
+    try:
+        assert probe.session.kwargs['key'] == b'secret'
+        rtt = probe.ping(1.)
+        assert rtt is not None and 0 < rtt < 1.
+        assert hub.received == ['queue_request']
+        hub.answer = False
+        assert probe.ping(.05) is None
+    finally:
+        probe.close()
+
+
+def test_late_reply_discarded(hub):
+    probe = HubProbe(hub.client())
+    try:
+        hub.delay = .3
+        assert probe.ping(.05) is None
+        # the reply to the first probe arrives during the second one
+        hub.answer = False
+        assert probe.ping(.6) is None
+    finally:
+        probe.close()
+
+
+def test_probe_loop(hub, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'ipyparallel', types.SimpleNamespace(Client=hub.client))
+    out = {}
+    options = {'interval': .05, 'timeout': .05, 'reconnect_after': 3, 'percentile': 95}
+    th = threading.Thread(target=probe_loop, args=(out,), kwargs=options, daemon=True)
+    th.start()
+    try:
+        wait_for(lambda: out.get('probe', {}).get('status') == 'ok')
+        assert sorted(out['probe']['rtt_ms']) == ['max', 'p50', 'p90', 'p95', 'p99']
+        assert hub.n_clients == 1
+
+        hub.answer = False
+        wait_for(lambda: out['probe']['timeouts'] >= 4)
+        assert out['probe']['status'] == 'timeout' and out['probe']['last_ms'] is None
+        # reconnected after reconnect_after timeouts
+        assert hub.n_clients >= 2
+        assert out['probe']['rtt_ms']['max'] == pytest.approx(50.)
+
+        hub.answer = True
+        wait_for(lambda: out['probe']['status'] == 'ok')
+    finally:
+        hub.stop_probes = True
+        th.join(5)
+    assert not th.is_alive()
+
+
+def probe(p90, time=0., p99=None):
+    rtt = {'p50': p90 / 2, 'p90': p90, 'p99': p99 if p99 is not None else p90, 'max': p90}
+    return {'time': time, 'rtt_ms': rtt}
+
+
+def test_slo_sustain():
+    slo = SchedulerSLO(slo_ms=100, sustain=30, cooldown=300)
+    assert not slo.check(probe(150, 0), now=0)
+    assert slo.summary(now=10)['breached_for'] == 10
+    assert not slo.check(probe(150, 20), now=20)
+    # back under the SLO: start again
+    assert not slo.check(probe(50, 25), now=25)
+    assert not slo.check(probe(150, 26), now=26)
+    assert not slo.check(probe(150, 55), now=55)
+    assert slo.check(probe(150, 56), now=56)
+    assert slo.n_restarts == 1 and slo.last_restart == 56
+
+
+def test_slo_cooldown():
+    slo = SchedulerSLO(slo_ms=100, sustain=0, cooldown=300)
+    assert slo.check(probe(150, 0), now=0)
+    assert not slo.check(probe(150, 299), now=299)
+    assert slo.check(probe(150, 300), now=300)
+
+
+def test_slo_stuck_probe():
+    slo = SchedulerSLO(slo_ms=100, sustain=30)
+    # the figures look fine, but they are old
+    assert not slo.check(probe(10, 0), now=31)
+    assert slo.check(probe(10, 0), now=61)
+    # no probe yet
+    assert not SchedulerSLO(slo_ms=100, sustain=0).check(None, now=0)
+
+
+def test_slo_disabled():
+    slo = SchedulerSLO(sustain=0)
+    assert not slo.check(probe(1e6, 0), now=0)
+
+
+def test_slo_percentile():
+    slo = SchedulerSLO(slo_ms=100, percentile=95, sustain=0)
+    p = probe(50, 0, p99=500)
+    # not reported by the probe: p99
+    assert slo.latency(p) == 500
+    p['rtt_ms']['p95'] = 80
+    assert slo.latency(p) == 80 and not slo.check(p, now=0)
+    assert SchedulerSLO(percentile=100).latency(dict(p, rtt_ms=dict(p['rtt_ms'], p100=1))) == 1
+    for bad in (0, -5, 101):
+        with pytest.raises(ValueError):
+            SchedulerSLO(percentile=bad)
@@ -0,0 +1,79 @@
+from monitored_ipcluster.registry import WorkerRegistry, FIELDS
+
+
+def beat(uid, host='node01', **kw):
+    data = dict.fromkeys(FIELDS, 0)
+    data.update(uid=uid, host=host, type='worker', _lastreq=100.)
+    data.update(kw)
+    return data
+
+
+def test_heartbeat():
+    workers = WorkerRegistry()
+    assert workers.heartbeat('a', beat('a', rss=10, app={'done': 1}))
+    assert not workers.heartbeat('a', beat('a', rss=20, app={'done': 2}))
+    rec = workers['a']
+    assert rec['rss'] == 20 and rec.get('app') == {'done': 2}
+    assert rec['uid'] == 'a' and rec['type'] == 'worker'
+    assert dict(rec) == beat('a', rss=20, app={'done': 2})
+    assert len(rec) == len(dict(rec))
+    assert 'a' in workers and list(workers) == ['a'] and len(workers) == 1
+
+
+def test_missing_fields_are_cleared():
+    workers = WorkerRegistry()
+    workers.heartbeat('a', beat('a', app={'done': 1}, placement={'node': 0}))
+    partial = beat('a', returncode=1)
+    del partial['rss'], partial['pid']
+    workers.heartbeat('a', partial)
+    rec = workers['a']
+    assert 'rss' not in rec and rec.get('pid', -1) == -1
+    assert 'app' not in rec and 'placement' not in rec
+    assert rec['returncode'] == 1
+    assert dict(rec) == partial
+    workers.heartbeat('a', beat('a'))
+    assert rec.extra is None and 'returncode' not in rec
+
+
+def test_extra_updated_in_place():
+    workers = WorkerRegistry()
+    workers.heartbeat('a', beat('a', app={'done': 1}, timings={}))
+    extra = workers['a'].extra
+    workers.heartbeat('a', beat('a', app={'done': 2}, placement=None))
+    assert workers['a'].extra is extra
+    assert extra == {'app': {'done': 2}, 'placement': None}
+
+
+def test_setitem():
+    workers = WorkerRegistry()
+    workers.heartbeat('a', beat('a'))
+    workers['a']['_lastreq'] = 5.
+    workers['a']['note'] = 'x'
+    assert workers['a']['_lastreq'] == 5. and workers['a']['note'] == 'x'
+
+
+def test_interned_strings():
+    workers = WorkerRegistry()
+    workers.heartbeat('a', beat('a', host=''.join(['node', '01'])))
+    workers.heartbeat('b', beat('b', host=''.join(['node', '01'])))
+    assert workers['a'].host is workers['b'].host
+    workers.heartbeat('b', beat('b', host='node02'))
+    assert workers['b'].host == 'node02'
+
+
+def test_column_total_stale():
+    workers = WorkerRegistry()
+    workers.heartbeat('a', beat('a', pcpu=10., app='x', _lastreq=50.))
+    workers.heartbeat('b', beat('b', pcpu=5., _lastreq=150.))
+    partial = beat('c')
+    del partial['pcpu'], partial['_lastreq']
+    workers.heartbeat('c', partial)
+    assert sorted(workers.column('pcpu')) == [5., 10.]
+    assert workers.total('pcpu') == 15.
+    assert workers.column('app') == ['x']
+    assert workers.column('nothing') == []
+    # c never sent a heartbeat time
+    assert sorted(workers.stale(100.)) == ['a', 'c']
+    assert workers.pop('a')['uid'] == 'a' and workers.pop('a') is None
+    workers.clear()
+    assert len(workers) == 0 and workers.stale(1e9) == []
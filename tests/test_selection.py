@@ -0,0 +1,66 @@
+import pytest
+
+from monitored_ipcluster.selection import parse_selector, WorkerIndex
+
+WORKERS = {
+    'u1': {'host': 'node01.cluster', 'type': 'worker', 'rss': 10e9, 'pcpu': 90., 'app': {'done': 5}},
+    'u2': {'host': 'node02.cluster', 'type': 'worker', 'rss': 1e9, 'pcpu': 2.},
+    'u3': {'host': 'node02.cluster', 'type': 'scheduler', 'rss': 2e9},
+    'u4': {'host': 'gpu01', 'type': 'worker', 'pcpu': 50.},
+}
+
+
+@pytest.fixture
+def index():
+    idx = WorkerIndex()
+    for uid, data in WORKERS.items():
+        idx.add(uid, data)
+    return idx
+
+
+def select(index, text):
+    return index.select(parse_selector(text), WORKERS.get)
+
+
+def test_parse_selector():
+    assert parse_selector('node01*') == [('target', '=', 'node01*')]
+    assert parse_selector('rss>8GB, type=worker') == [('rss', '>', 8 * 1024**3), ('type', '=', 'worker')]
+    assert parse_selector('app.done<10') == [('app.done', '<', 10)]
+    with pytest.raises(ValueError):
+        parse_selector(' , ')
+    with pytest.raises(ValueError):
+        parse_selector('host>node')
+    with pytest.raises(ValueError):
+        parse_selector('rss>lots')
+
+
+def test_select_targets(index):
+    assert select(index, 'u3') == ['u3']
+    assert select(index, 'node02') == ['u2', 'u3']
+    assert select(index, 'node0[1-2]*') == ['u1', 'u2', 'u3']
+    assert select(index, 'host=gpu01') == ['u4']
+    assert select(index, 'nowhere') == []
+
+
+def test_select_indexed_terms(index):
+    assert select(index, 'type=worker') == ['u1', 'u2', 'u4']
+    assert select(index, 'node02,type=worker') == ['u2']
+    assert select(index, 'type!=worker') == ['u3']
+    assert select(index, 'host!=node02') == ['u1', 'u4']
+
+
+def test_select_predicates(index):
+    assert select(index, 'rss>1.5GB') == ['u1', 'u3']
+    # engines without the metric never match
+    assert select(index, 'pcpu<60') == ['u2', 'u4']
+    assert select(index, 'type=worker,pcpu>=50') == ['u1', 'u4']
+    assert select(index, 'app.done<10') == ['u1']
+
+
+def test_index_updates(index):
+    index.add('u4', {'host': 'gpu02', 'type': 'worker'})
+    assert select(index, 'gpu01') == []
+    assert select(index, 'gpu02') == ['u4']
+    index.remove('u4')
+    assert select(index, 'gpu*') == []
+    assert 'gpu02' not in index.by_host
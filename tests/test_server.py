@@ -0,0 +1,99 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import zmq
+import pytest
+
+from monitored_ipcluster import server
+from monitored_ipcluster.archive import MetricsArchive
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    archive = MetricsArchive(str(tmp_path))
+    executor = ThreadPoolExecutor(1)
+    monkeypatch.setattr(server, 'metrics_archive', archive)
+    monkeypatch.setattr(server, 'history_executor', executor)
+    monkeypatch.setattr(server, 'deferred', [])
+    yield archive
+    executor.shutdown()
+
+
+@pytest.fixture
+def rep():
+    ctx = zmq.Context()
+    rep, req = ctx.socket(zmq.REP), ctx.socket(zmq.REQ)
+    rep.bind('inproc://control')
+    req.connect('inproc://control')
+    poller = zmq.Poller()
+    poller.register(rep, zmq.POLLIN)
+    yield rep, req, poller
+    rep.close(0)
+    req.close(0)
+    ctx.term()
+
+
+def test_history_off_the_loop(archive, rep, monkeypatch):
+    sock, client, poller = rep
+    release = threading.Event()
+    query_history = server.query_history
+
+    def slow_query(*args):
+        release.wait(10)
+        return query_history(*args)
+
+    monkeypatch.setattr(server, 'query_history', slow_query)
+    archive.append({'uid': 'e1', 'pcpu': 50.}, now=1000.)
+
+    client.send_json({'type': 'command', 'cmd': 'history', 'start': 900, 'end': 1100})
+    response = server.handle_message(sock.recv_json())
+    server.defer_reply(response['deferred'], sock, None, poller)
+    # the control socket waits for the reply, the loop goes on
+    assert dict(poller.poll(0)) == {}
+    server.send_deferred(poller)
+    assert server.deferred and not client.poll(50)
+
+    release.set()
+    response['deferred'].result(10)
+    server.send_deferred(poller)
+    reply = client.recv_json()
+    assert reply['status'] == 'ok' and reply['pcpu']['sum'] == [50.]
+    assert not server.deferred and sock in dict(poller.sockets)
+
+
+def test_history_routed_reply(archive):
+    # replies to the front-end of a shard carry the route frames
+    ctx = zmq.Context()
+    a, b = ctx.socket(zmq.PAIR), ctx.socket(zmq.PAIR)
+    a.bind('inproc://shard')
+    b.connect('inproc://shard')
+    poller = zmq.Poller()
+    poller.register(a, zmq.POLLIN)
+    try:
+        response = server.handle_message({'type': 'command', 'cmd': 'history', 'start': 0, 'end': 10})
+        server.defer_reply(response['deferred'], a, [b'', b'7'], poller)
+        response['deferred'].result(10)
+        server.send_deferred(poller)
+        route1, route2, msg = b.recv_multipart()
+        assert (route1, route2) == (b'', b'7')
+        assert json.loads(msg)['rows'] == 0
+    finally:
+        a.close(0)
+        b.close(0)
+        ctx.term()
+
+
+def test_history_failure(archive, rep, monkeypatch):
+    sock, client, poller = rep
+
+    def broken(*args):
+        raise ValueError('bad range')
+
+    monkeypatch.setattr(server, 'query_history', broken)
+    client.send_json({'type': 'command', 'cmd': 'history'})
+    response = server.handle_message(sock.recv_json())
+    server.defer_reply(response['deferred'], sock, None, poller)
+    response['deferred'].exception(10)
+    server.send_deferred(poller)
+    assert client.recv_json()['status'] == 'failed'
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+
+from monitored_ipcluster.archive import MetricsArchive, query, merge, DAY
+from monitored_ipcluster.sharding import shard_of, merge_info, merge_stats, merge_replies
+
+
+def info(n_workers, ave_cpu, **kw):
+    return dict({
+        'status': 'ok', 'n_workers': n_workers, 'ave_cpu': ave_cpu, 'host': 'front', 'shost': 'N/A',
+        'scheduler': {}, 'n_crashes': 0, 'n_preempted': 0,
+    }, **kw)
+
+
+def test_shard_of():
+    msg = json.dumps({'uid': 'abc', 'type': 'worker'}).encode()
+    assert shard_of(msg, 4) == shard_of(b'{"type": "worker", "uid": "abc"}', 4)
+    assert {shard_of(json.dumps({'uid': str(i)}).encode(), 4) for i in range(100)} == {0, 1, 2, 3}
+    # commands have no uid
+    assert shard_of(b'{"cmd": "info"}', 4) == shard_of(b'not json', 4)
+
+
+def test_merge_info():
+    data = merge_info([
+        info(30, 10., n_crashes=1, app={'done': 5}, selected={'a': {}}),
+        info(10, 50., shost='sched', scheduler={'s': {}}, n_crashes=2, app={'done': 1, 'x': 2}),
+        info(0, 0.),
+    ])
+    # weighted by the engines of each shard
+    assert data['ave_cpu'] == pytest.approx(20.)
+    assert data['n_workers'] == 40 and data['n_shards'] == 3
+    assert data['shost'] == 'sched' and data['scheduler'] == {'s': {}}
+    assert data['n_crashes'] == 3
+    assert data['app'] == {'done': 6, 'x': 2}
+    assert data['selected'] == {'a': {}}
+    assert merge_info([info(0, 0.)])['ave_cpu'] == 0
+
+
+def test_merge_info_sections():
+    guard = {'restarts': {'engine_rss': 1}, 'pending': {'a': 'host_memory'}, 'recent': [{'time': 2}]}
+    drain = {'draining': {'b': {}}, 'waiting': 2, 'stopping': 1, 'recent': [(5, 'b')]}
+    data = merge_info([
+        info(5, 0., memguard=guard, drain=drain, flags={'a': ['slow']}, peer_stats={'n': 5}),
+        info(10, 0., memguard=dict(guard, recent=[{'time': 1}]), drain=dict(drain, recent=[(3, 'c')]),
+             flags={}, peer_stats={'n': 10}, tasks={'rate': 1}),
+    ])
+    assert data['memguard']['restarts'] == {'engine_rss': 2}
+    assert data['memguard']['recent'] == [{'time': 1}, {'time': 2}]
+    assert data['drain']['waiting'] == 4 and data['drain']['recent'] == [(3, 'c'), (5, 'b')]
+    assert data['n_flagged'] == 1 and data['peer_stats'] == {'n': 10}
+    assert data['tasks'] == {'rate': 1}
+
+
+def client_stats(n, p50, p90, max_ms):
+    return {'clients': n, 'mean_ms_p50': p50, 'mean_ms_p90': p90, 'max_ms': max_ms, 'slowest': 'u{}'.format(max_ms)}
+
+
+def test_merge_stats():
+    replies = [
+        {'status': 'ok', 'enabled': True, 'n_workers': 3, 'queues': {'n': 2, 'max': 4}, 'server': 's1',
+         'clients': {'client.rtt': client_stats(3, 1., 5., 9.)}},
+        {'status': 'ok', 'enabled': True, 'n_workers': 2, 'queues': {'n': 1, 'max': 7}, 'server': 's2',
+         'clients': {'client.rtt': client_stats(2, 3., 4., 20.)}},
+    ]
+    data = merge_stats(replies, front='front')
+    assert data['n_workers'] == 5 and data['queues'] == {'n': 3, 'max': 7}
+    assert data['server'] == 'front' and data['shards'] == ['s1', 's2']
+    assert data['clients']['client.rtt'] == {
+        'clients': 5, 'mean_ms_p50': 3., 'mean_ms_p90': 5., 'max_ms': 20., 'slowest': 'u20.0'}
+    replies[1]['enabled'] = False
+    assert 'clients' not in merge_stats(replies)
+
+
+def test_merge_replies():
+    failed = {'status': 'failed', 'reason': 'No client matches the selector'}
+    data = merge_replies('restart', [{'status': 'ok', 'n_selected': 2}, failed, {'status': 'ok', 'n_selected': 3}])
+    assert data == {'status': 'ok', 'n_selected': 5}
+    # failed shards are ignored, unless all of them failed
+    assert merge_replies('info', [failed, info(4, 25.)])['n_workers'] == 4
+    assert merge_replies('info', [failed, failed]) == failed
+    assert merge_replies('info', [])['status'] == 'failed'
+    data = merge_replies('profile', [{'status': 'ok', 'job': 'j', 'uids': ['a']}, {'status': 'ok', 'job': 'j', 'uids': ['b']}])
+    assert data == {'status': 'ok', 'job': 'j', 'uids': ['a', 'b']}
+
+
+T0 = 20000 * DAY
+
+
+def fill(path, samples):
+    archive = MetricsArchive(str(path))
+    for t, uid, pcpu in samples:
+        archive.append({'uid': uid, 'host': 'h', 'pcpu': pcpu}, now=t)
+    archive.close()
+    return str(path)
+
+
+def test_merge_history(tmp_path):
+    samples = [(T0 + t, 'e{}'.format(t % 3), float(t)) for t in range(0, 60, 2)]
+    parts = [[s for s in samples if s[1] != 'e2'], [s for s in samples if s[1] == 'e2']]
+    shards = [fill(tmp_path / 'shard-{}'.format(k), p) for k, p in enumerate(parts)]
+    whole = fill(tmp_path / 'whole', samples)
+
+    for kw in ({'bucket': 10}, {'bucket': 7}, {'by': 'engine'}, {}):
+        expected = query(whole, T0, T0 + 60, metrics=('pcpu', 'rss'), **kw)
+        data = merge_replies('history', [
+            dict(query(path, T0, T0 + 60, metrics=('pcpu', 'rss'), **kw), status='ok') for path in shards
+        ] + [{'status': 'failed', 'reason': 'Metrics archive not enabled'}])
+        assert data.pop('status') == 'ok'
+        if kw.get('by') == 'engine':
+            # engines in the order of the shards
+            order = [data['groups'].index(g) for g in expected['groups']]
+            data['groups'] = [data['groups'][i] for i in order]
+            for m in ('pcpu', 'rss'):
+                data[m] = {k: [v[i] for i in order] for k, v in data[m].items()}
+        assert data == expected
+
+
+def test_merge_disjoint_buckets(tmp_path):
+    a = query(fill(tmp_path / 'a', [(T0 + 1, 'e1', 1.)]), T0, T0 + 30, metrics=('pcpu',), bucket=10)
+    b = query(fill(tmp_path / 'b', [(T0 + 25, 'e2', 3.)]), T0, T0 + 30, metrics=('pcpu',), bucket=10)
+    data = merge([b, a])
+    assert data['groups'] == [T0, T0 + 20]
+    assert data['pcpu']['sum'] == [1., 3.] and data['rows'] == 2
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from monitored_ipcluster.taskstats import HistoryCursor, TaskStats, KEYS
+
+
+class RemoteError(Exception):
+    # as raised by ipyparallel for errors in the hub
+    def __init__(self, ename):
+        super().__init__(ename)
+        self.ename = ename
+
+
+class FakeHub:
+    '''
+    The db_query of an ipyparallel Client, on the records of a hub
+    using aware or naive (older ipyparallel) timestamps.
+    '''
+
+    def __init__(self, naive=False):
+        self.naive = naive
+        self.records = []
+        self.queries = []
+        self.t0 = datetime.now(timezone.utc)
+
+    def complete(self, msg_id, seconds, engine='e1'):
+        completed = self.t0 + timedelta(seconds=seconds)
+        if self.naive:
+            completed = completed.replace(tzinfo=None)
+        self.records.append({
+            'msg_id': msg_id, 'engine_uuid': engine, 'submitted': completed - timedelta(seconds=3),
+            'started': completed - timedelta(seconds=2), 'completed': completed, 'buffers': [b'x' * 100],
+        })
+
+    def db_query(self, query, keys=None):
+        since = query['completed']['$gte']
+        self.queries.append(since)
+        if (since.tzinfo is None) != self.naive:
+            raise RemoteError('TypeError')
+        return [{k: r[k] for k in keys} for r in self.records if r['completed'] >= since]
+
+
+def ids(records):
+    return sorted(r['msg_id'] for r in records)
+
+
+@pytest.mark.parametrize('naive', [False, True])
+def test_fetch_each_record_once(naive):
+    hub = FakeHub(naive)
+    cursor = HistoryCursor(backfill=60)
+    hub.complete('old', -120)
+    hub.complete('a', -10)
+    hub.complete('b', -5)
+    assert ids(cursor.fetch(hub)) == ['a', 'b']
+    assert cursor.fetch(hub) == []
+    # completed at the cursor: asked again, skipped by msg_id
+    hub.complete('c', -5)
+    hub.complete('d', 1)
+    assert ids(cursor.fetch(hub)) == ['c', 'd']
+    assert cursor.fetch(hub) == []
+    assert cursor.cursor == hub.records[-1]['completed']
+    assert cursor._at_cursor == {'d'}
+
+
+def test_only_needed_fields():
+    hub = FakeHub()
+    hub.complete('a', -1)
+    record, = HistoryCursor().fetch(hub)
+    assert sorted(record) == sorted(KEYS)
+
+
+def test_naive_fallback():
+    hub = FakeHub(naive=True)
+    hub.complete('a', -1)
+    cursor = HistoryCursor()
+    assert ids(cursor.fetch(hub)) == ['a']
+    assert [q.tzinfo is None for q in hub.queries] == [False, True]
+    hub.complete('b', 1)
+    assert ids(cursor.fetch(hub)) == ['b']
+    assert hub.queries[-1].tzinfo is None
+
+
+def test_other_errors_raised():
+    class Broken:
+        def db_query(self, query, keys=None):
+            raise RemoteError('KeyError')
+
+    with pytest.raises(RemoteError):
+        HistoryCursor().fetch(Broken())
+    # a TypeError once the cursor is set is not the timestamps
+    hub = FakeHub()
+    hub.complete('a', -1)
+    cursor = HistoryCursor()
+    cursor.fetch(hub)
+    hub.naive = True
+    with pytest.raises(RemoteError):
+        cursor.fetch(hub)
+
+
+def test_task_stats():
+    hub = FakeHub()
+    for i in range(10):
+        hub.complete('t{}'.format(i), i, engine='uuid-a' if i < 7 else 'uuid-b')
+    stats = TaskStats(window=100)
+    stats.add(hub.records, {'uuid-a': 0}, now=0)
+    s = stats.summary(now=1)
+    assert s['completed'] == 10 and s['rate'] == .1
+    assert s['wait_s']['p50'] == 1. and s['runtime_s']['max'] == 2.
+    assert [(e['engine'], e['tasks']) for e in s['engines']] == [(0, 7), ('uuid-b', 3)]
+    assert stats.summary(now=101)['rate'] == 0 and stats.n_total == 10